@@ -41,11 +41,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'trading.instrumentation.RequestStatsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'trading.profiler.ProfilerMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -54,7 +56,8 @@ ROOT_URLCONF = 'hfr.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django templates, with render times for the request stats
+        'BACKEND': 'trading.instrumentation.TimedDjangoTemplates',
         'DIRS': [
             os.path.join(BASE_DIR, 'templates'),
         ],
@@ -126,3 +129,49 @@ STATIC_URL = '/static/'
 LOGIN_REDIRECT_URL = '/'
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+# Background trade jobs: worker processes in the local pool (None = one per
+# CPU) and whether to run jobs inline in the request instead
+TRADING_JOB_WORKERS = None
+TRADING_JOBS_EAGER = False
+
+# Worker processes used by a batch (multi-portfolio) trade job (None = one
+# per CPU)
+TRADING_BATCH_WORKERS = None
+
+# Cache for the dashboard and other expensive pages. Entries are invalidated
+# by version keys bumped on uploads, so use a shared backend (e.g.
+# memcached) when running more than one process.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'hfr-trading',
+    }
+}
+
+# Lifetime of cached page context in seconds (None = until invalidated)
+TRADING_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Budgets of the request stats middleware, per view name ('default' for
+# every view): query count and database/render/wall time in milliseconds.
+# Requests over budget are logged as warnings.
+TRADING_REQUEST_BUDGETS = {
+    'default': {'queries': 50, 'wall_ms': 2000},
+    'upload-file': {'queries': None, 'wall_ms': None},
+    'upload-positions': {'queries': None, 'wall_ms': None},
+    'upload-bbg-data': {'queries': None, 'wall_ms': None},
+    'upload-calendars': {'queries': None, 'wall_ms': None},
+    'export': {'queries': None, 'wall_ms': None},
+}
+
+# Latest requests kept per view for the percentiles of the stats page
+TRADING_REQUEST_STATS_WINDOW = 500
+
+# Staff can profile a request by adding ?_profile=1 to its URL (or an
+# X-Profile: 1 header); the latest TRADING_PROFILE_KEEP profiles are kept
+TRADING_PROFILER = True
+TRADING_PROFILE_KEEP = 200
+
+# Directory of the memory-mapped BBGData store (rebuilt from the database
+# when missing)
+BBG_STORE_DIR = os.path.join(BASE_DIR, 'bbg_store')
@@ -1,6 +1,8 @@
 from django.contrib import admin
 from trading.models import Fund, Portfolio, Position, TradeItem, BBGData
-from trading.models import Calendar, CalendarDate
+from trading.models import Calendar, CalendarDate, TradeJob
+from trading.models import BlockOrder, BlockAllocation, ProfileCapture
+from trading.models import PortfolioDrift, TargetModel
 
 # Register models
 admin.site.register(Fund)
@@ -10,3 +12,9 @@ admin.site.register(TradeItem)
 admin.site.register(BBGData)
 admin.site.register(Calendar)
 admin.site.register(CalendarDate)
+admin.site.register(TradeJob)
+admin.site.register(BlockOrder)
+admin.site.register(BlockAllocation)
+admin.site.register(ProfileCapture)
+admin.site.register(TargetModel)
+admin.site.register(PortfolioDrift)
@@ -0,0 +1,169 @@
+"""
+Incrementally maintained aggregates over Position.
+
+Loaders collect the contribution of the rows they write into a delta object
+and apply it once at the end of the load, so the aggregate tables never need
+to rescan Position.
+"""
+from collections import Counter, defaultdict
+
+from .models import FundHolding, PortfolioValuation
+
+
+class ValuationDeltas:
+    """
+    Per (account_number, valuation_date) changes to PortfolioValuation
+    """
+
+    def __init__(self):
+        # key -> [total_value, cash_value, position_count]
+        self.deltas = defaultdict(lambda: [0.0, 0.0, 0])
+
+    # Methods
+    def add(self, positions, sign=1):
+        """
+        Add (sign=1) or remove (sign=-1) the contribution of `positions`
+        """
+        for position in positions:
+            delta = self.deltas[(position.account_number_id,
+                                 position.valuation_date)]
+            delta[0] += sign * position.value
+            if position.flag_cash:
+                delta[1] += sign * position.value
+            delta[2] += sign
+
+    def apply(self):
+        """
+        Write the deltas to PortfolioValuation (one read, batched writes)
+        """
+        if not self.deltas:
+            return
+
+        accounts = {account for account, _ in self.deltas}
+        dates = {date for _, date in self.deltas}
+        existing = {
+            (v.account_number_id, v.valuation_date): v
+            for v in PortfolioValuation.objects.filter(
+                account_number__in=accounts, valuation_date__in=dates)}
+
+        created, updated = [], []
+        for key, (total, cash, count) in self.deltas.items():
+            valuation = existing.get(key)
+            if valuation is None:
+                valuation = PortfolioValuation(account_number_id=key[0],
+                                               valuation_date=key[1])
+                created.append(valuation)
+            else:
+                updated.append(valuation)
+            valuation.total_value += total
+            valuation.cash_value += cash
+            valuation.invested_value = (valuation.total_value -
+                                        valuation.cash_value)
+            valuation.position_count += count
+
+        PortfolioValuation.objects.bulk_create(created)
+        PortfolioValuation.objects.bulk_update(
+            updated, ['total_value', 'cash_value', 'invested_value',
+                      'position_count'])
+        self.deltas.clear()
+
+
+class HoldingDeltas:
+    """
+    Per (isin, valuation_date) changes to the firm-wide FundHolding (cash
+    lines are not counted as fund holdings)
+    """
+
+    def __init__(self):
+        # key -> [total_value, total_shares, position_count]
+        self.deltas = defaultdict(lambda: [0.0, 0.0, 0])
+
+    # Methods
+    def add(self, positions, sign=1):
+        """
+        Add (sign=1) or remove (sign=-1) the contribution of `positions`
+        """
+        for position in positions:
+            if position.flag_cash or position.isin_id is None:
+                continue
+            delta = self.deltas[(position.isin_id, position.valuation_date)]
+            delta[0] += sign * position.value
+            delta[1] += sign * position.shares
+            delta[2] += sign
+
+    def apply(self):
+        """
+        Write the deltas to FundHolding (one read, batched writes)
+        """
+        if not self.deltas:
+            return
+
+        isins = {isin for isin, _ in self.deltas}
+        dates = {date for _, date in self.deltas}
+        existing = {
+            (h.isin_id, h.valuation_date): h
+            for h in FundHolding.objects.filter(
+                isin__in=isins, valuation_date__in=dates)}
+
+        created, updated = [], []
+        for key, (value, shares, count) in self.deltas.items():
+            holding = existing.get(key)
+            if holding is None:
+                holding = FundHolding(isin_id=key[0], valuation_date=key[1])
+                created.append(holding)
+            else:
+                updated.append(holding)
+            holding.total_value += value
+            holding.total_shares += shares
+            holding.position_count += count
+
+        FundHolding.objects.bulk_create(created)
+        FundHolding.objects.bulk_update(
+            updated, ['total_value', 'total_shares', 'position_count'])
+        self.deltas.clear()
+
+
+class AccountChanges:
+    """
+    Accounts whose positions really changed: rows removed and rows written
+    with the same values cancel out, so reloading an unchanged partition
+    leaves its account out
+    """
+
+    def __init__(self):
+        # account -> Counter of position rows (+1 written, -1 removed)
+        self.rows = defaultdict(Counter)
+
+    # Methods
+    def add(self, positions, sign=1):
+        for position in positions:
+            self.rows[position.account_number_id][(
+                position.valuation_date, position.isin_id,
+                position.flag_cash, position.value, position.shares,
+                position.price)] += sign
+
+    def changed(self):
+        return {account for account, rows in self.rows.items()
+                if any(rows.values())}
+
+
+class PositionDeltas:
+    """
+    Changes to every aggregate maintained from Position, and the accounts
+    they touched
+    """
+
+    def __init__(self):
+        self.valuations = ValuationDeltas()
+        self.holdings = HoldingDeltas()
+        self.accounts = AccountChanges()
+
+    # Methods
+    def add(self, positions, sign=1):
+        self.valuations.add(positions, sign)
+        self.holdings.add(positions, sign)
+        self.accounts.add(positions, sign)
+
+    def apply(self):
+        self.valuations.apply()
+        self.holdings.apply()
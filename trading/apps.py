@@ -1,5 +1,11 @@
+from importlib import import_module
+
 from django.apps import AppConfig
 
 
 class TradingConfig(AppConfig):
     name = 'trading'
+
+    def ready(self):
+        # Connect the cache invalidation receivers
+        import_module('.signals', self.name)
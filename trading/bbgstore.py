@@ -0,0 +1,296 @@
+"""
+Columnar, memory-mapped store of the BBGData time series.
+
+Every row is kept in NumPy arrays sorted by (ISIN, date). `keys` packs the
+ISIN's position in the sorted `isins` array with the date into one int64, so
+each ISIN's history is a contiguous, date-sorted slice and as-of lookups for
+any number of (ISIN, date) pairs are a single binary search.
+
+The arrays are saved as .npy files in a version directory of BBG_STORE_DIR
+and memory-mapped by every process. A refresh only reads the BBGData rows
+added since the last build and switches the CURRENT pointer atomically.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from django.conf import settings
+
+from .models import BBGData
+
+
+logger = logging.getLogger(__name__)
+
+# Dates are stored as days since EPOCH in the low DATE_BITS of the keys
+EPOCH = np.datetime64('1900-01-01', 'D')
+DATE_BITS = 32
+DATE_MASK = (1 << DATE_BITS) - 1
+
+COLUMNS = ('keys', 'assets', 'shares_issued')
+CURRENT = 'CURRENT'
+
+# Version directories kept besides the current one (processes may still
+# have them mapped)
+KEEP_VERSIONS = 1
+
+
+def store_dir():
+    return getattr(settings, 'BBG_STORE_DIR', None) or os.path.join(
+        settings.BASE_DIR, 'bbg_store')
+
+
+def pack(codes, dates):
+    days = (np.asarray(dates, dtype='datetime64[D]') - EPOCH).astype(np.int64)
+    return (np.asarray(codes, dtype=np.int64) << DATE_BITS) | days
+
+
+class BBGStore:
+    """
+    BBGData rows (up to `last_id`) as sorted columnar arrays
+    """
+
+    def __init__(self, isins, keys, assets, shares_issued, last_id=0,
+                 source_rows=0, version=None):
+        self.isins = isins
+        self.keys = keys
+        self.assets = assets
+        self.shares_issued = shares_issued
+        self.last_id = last_id
+        self.source_rows = source_rows
+        self.version = version
+
+    @classmethod
+    def empty(cls):
+        return cls(np.array([], dtype=str), np.zeros(0, dtype=np.int64),
+                   np.zeros(0), np.zeros(0))
+
+    @classmethod
+    def open(cls, path, version=None):
+        """
+        Store saved in `path`, columns memory-mapped read-only
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if not meta['rows']:
+            columns = (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0))
+        else:
+            columns = [np.load(os.path.join(path, name + '.npy'),
+                               mmap_mode='r') for name in COLUMNS]
+        return cls(np.load(os.path.join(path, 'isins.npy')), *columns,
+                   last_id=meta['last_id'], source_rows=meta['source_rows'],
+                   version=version)
+
+    # Methods
+    @property
+    def rows(self):
+        return len(self.keys)
+
+    def codes(self, isins):
+        """
+        Position of each ISIN in `isins`, -1 for ISINs without data
+        """
+        isins = np.asarray(isins, dtype=str)
+        if not len(self.isins):
+            return np.full(isins.shape, -1)
+        codes = np.minimum(np.searchsorted(self.isins, isins),
+                           len(self.isins) - 1)
+        return np.where(self.isins[codes] == isins, codes, -1)
+
+    def as_of(self, isins, dates):
+        """
+        (dates, assets, shares_issued) arrays of the latest row on or before
+        each date of each ISIN (vectorized; `dates` may be a single date).
+        Missing data is NaT/NaN.
+        """
+        isins = np.atleast_1d(np.asarray(isins, dtype=str))
+        dates = np.broadcast_to(np.asarray(dates, dtype='datetime64[D]'),
+                                isins.shape)
+        codes = self.codes(isins)
+        found = codes >= 0
+        if not self.rows:
+            rows = np.zeros(isins.shape, dtype=int)
+        else:
+            rows = np.searchsorted(self.keys, pack(np.maximum(codes, 0),
+                                                   dates), side='right') - 1
+            found &= rows >= 0
+            rows = np.maximum(rows, 0)
+            found &= (self.keys[rows] >> DATE_BITS) == codes
+
+        if not found.any():
+            return (np.full(isins.shape, np.datetime64('NaT'),
+                            dtype='datetime64[D]'),
+                    np.full(isins.shape, np.nan),
+                    np.full(isins.shape, np.nan))
+        keys = self.keys[rows]
+        return (np.where(found, EPOCH + (keys & DATE_MASK),
+                         np.datetime64('NaT')).astype('datetime64[D]'),
+                np.where(found, self.assets[rows], np.nan),
+                np.where(found, self.shares_issued[rows], np.nan))
+
+    def history(self, isin):
+        """
+        (dates, assets, shares_issued) of one ISIN, date sorted
+        """
+        code = self.codes([isin])[0]
+        if code < 0:
+            rows = slice(0, 0)
+        else:
+            start, end = np.searchsorted(
+                self.keys, [code << DATE_BITS, (code + 1) << DATE_BITS])
+            rows = slice(start, end)
+        keys = np.asarray(self.keys[rows])
+        return (EPOCH + (keys & DATE_MASK), np.asarray(self.assets[rows]),
+                np.asarray(self.shares_issued[rows]))
+
+    def merged(self, ids, isins, dates, assets, shares_issued, source_rows):
+        """
+        New store with the given BBGData rows (ids above last_id) added; a
+        later row replaces an earlier one for the same ISIN and date
+        """
+        all_isins = np.union1d(self.isins, isins)
+        remap = np.searchsorted(all_isins, self.isins)
+        old_keys = np.asarray(self.keys)
+        old_keys = (remap[old_keys >> DATE_BITS].astype(np.int64)
+                    << DATE_BITS) | (old_keys & DATE_MASK)
+
+        # New rows in id order after the old ones: a stable sort keeps that
+        # order within equal keys, and the last of each key is kept
+        order = np.argsort(ids, kind='stable')
+        keys = np.concatenate([old_keys, pack(
+            np.searchsorted(all_isins, isins[order]), dates[order])])
+        values = (np.concatenate([self.assets, assets[order]]),
+                  np.concatenate([self.shares_issued, shares_issued[order]]))
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        last = np.r_[keys[1:] != keys[:-1], True] if len(keys) else \
+            np.zeros(0, dtype=bool)
+        return BBGStore(all_isins, keys[last],
+                        *(column[order][last] for column in values),
+                        last_id=max(self.last_id, int(ids.max())),
+                        source_rows=source_rows)
+
+    def save(self, root):
+        """
+        Write the store to a new version directory of `root` and make it
+        current (atomic rename of the CURRENT pointer)
+        """
+        os.makedirs(root, exist_ok=True)
+        path = tempfile.mkdtemp(prefix='v', dir=root)
+        np.save(os.path.join(path, 'isins.npy'), self.isins)
+        for name in COLUMNS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'rows': self.rows, 'last_id': self.last_id,
+                       'source_rows': self.source_rows}, f)
+
+        self.version = os.path.basename(path)
+        pointer = os.path.join(root, CURRENT + '.tmp')
+        with open(pointer, 'w') as f:
+            f.write(self.version)
+        os.replace(pointer, os.path.join(root, CURRENT))
+        remove_old_versions(root, self.version)
+
+
+def remove_old_versions(root, current):
+    versions = sorted(
+        (entry for entry in os.scandir(root)
+         if entry.is_dir() and entry.name != current),
+        key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in versions[KEEP_VERSIONS:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def current_version(root):
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def build_store(store=None):
+    """
+    `store` updated with the BBGData rows added since it was built, or a
+    full build when there is no store or rows were deleted since
+    """
+    source_rows = BBGData.objects.filter(isin__isnull=False).count()
+    if store is not None and BBGData.objects.filter(
+            isin__isnull=False, id__lte=store.last_id).count() != \
+            store.source_rows:
+        logger.info('BBGData rows were removed, rebuilding the BBG store')
+        store = None
+    store = store or BBGStore.empty()
+
+    rows = list(BBGData.objects.filter(
+        isin__isnull=False, id__gt=store.last_id).values_list(
+            'id', 'isin', 'date', 'assets', 'shares_issued'))
+    if not rows:
+        return store, 0
+
+    ids, isins, dates, assets, shares_issued = zip(*rows)
+    return store.merged(
+        np.array(ids, dtype=np.int64), np.array(isins, dtype=str),
+        np.array(dates, dtype='datetime64[D]'),
+        np.array(assets, dtype=float), np.array(shares_issued, dtype=float),
+        source_rows), len(rows)
+
+
+_store = None
+_stale = False
+_rebuild = False
+
+
+def refresh_bbg_store(full=False):
+    """
+    Add the new BBGData rows to the saved store (everything when `full`)
+    and return it
+    """
+    global _store, _stale, _rebuild
+    root = store_dir()
+    store = None
+    if not (full or _rebuild):
+        version = current_version(root)
+        if version is not None:
+            store = BBGStore.open(os.path.join(root, version), version)
+
+    store, added = build_store(store)
+    if added or store.version is None:
+        store.save(root)
+        store = BBGStore.open(os.path.join(root, store.version),
+                              store.version)
+        logger.info('BBG store %s: %d rows added, %d rows, %d ISINs',
+                    store.version, added, store.rows, len(store.isins))
+    _store, _stale, _rebuild = store, False, False
+    return store
+
+
+def get_bbg_store():
+    """
+    Process wide BBGStore: built on first use, refreshed after BBGData
+    changes in this process and reopened when another process saved a newer
+    version
+    """
+    global _store
+    if _stale or _rebuild:
+        return refresh_bbg_store()
+    version = current_version(store_dir())
+    if version is None:
+        return refresh_bbg_store()
+    if _store is None or _store.version != version:
+        _store = BBGStore.open(os.path.join(store_dir(), version), version)
+    return _store
+
+
+def bbg_data_changed(created):
+    """
+    Mark the store out of date: new rows are added incrementally, edited or
+    deleted rows need a full rebuild
+    """
+    global _stale, _rebuild
+    if created:
+        _stale = True
+    else:
+        _rebuild = True
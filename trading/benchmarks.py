@@ -0,0 +1,192 @@
+"""
+Benchmark suite: uploads, trade calculation and page latency over a
+SyntheticBook (see the run_benchmarks command).
+
+Every benchmark is a function taking the BenchmarkRun; it times its work
+with run.measure() and may attach extra numbers (rows, queries) to its
+result. Benchmarks run in order, as the later ones use the data loaded by
+the earlier ones. Pages are also checked against their request budgets
+(settings.TRADING_REQUEST_BUDGETS).
+"""
+import io
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import Client
+from django.urls import resolve, reverse
+
+from .drift import refresh_drift
+from .ingest import REPLACE, ingest_bbg_data, ingest_calendar_dates
+from .ingest import ingest_funds, ingest_positions
+from .instrumentation import BudgetExceeded, assert_budget
+from .models import Portfolio, Position
+from .targets import PERCENT, get_target_model
+from .trading import calculate_trades
+
+
+class BenchmarkRun:
+    """
+    The book, settings and collected results of one benchmark run
+    """
+
+    def __init__(self, book, repeat=3, trade_portfolios=20, log=None):
+        self.book = book
+        self.repeat = repeat
+        self.trade_portfolios = trade_portfolios
+        self.log = log or (lambda message: None)
+        self.results = []
+        self.over_budget = []
+        self._client = None
+
+    # Methods
+    def measure(self, name, function, repeat=None, **extra):
+        """
+        Time `function` `repeat` times and record the result; returns the
+        value of the last call
+        """
+        seconds = []
+        for _ in range(repeat or self.repeat):
+            started = time.perf_counter()
+            value = function()
+            seconds.append(time.perf_counter() - started)
+        result = {
+            'name': name,
+            'runs': seconds,
+            'min': min(seconds),
+            'median': statistics.median(seconds),
+            'max': max(seconds),
+        }
+        result.update(extra)
+        self.results.append(result)
+        self.log('%-28s median %8.4fs  min %8.4fs' % (
+            name, result['median'], result['min']))
+        return value
+
+    @property
+    def client(self):
+        if self._client is None:
+            user = User.objects.create_superuser(
+                'benchmark', 'benchmark@example.com', None)
+            self._client = Client()
+            self._client.force_login(user)
+        return self._client
+
+    def get(self, name, url, cold=False):
+        """
+        Time GET requests of `url` (clearing the cache first when `cold`),
+        after a first request checked against the view's budget
+        """
+        def request():
+            if cold:
+                cache.clear()
+            response = self.client.get(url)
+            if response.status_code != 200:
+                raise AssertionError('%s returned %d' % (
+                    url, response.status_code))
+            return response
+
+        view_name = resolve(url.split('?')[0]).view_name
+        budget_error = None
+        try:
+            with assert_budget(view_name) as collector:
+                response = request()
+        except BudgetExceeded as e:
+            budget_error = str(e)
+            self.over_budget.append('%s: %s' % (name, e))
+        self.measure(name, request, bytes=len(response.content),
+                     budget_error=budget_error, **collector.as_dict())
+
+
+def bench_fund_upload(run):
+    data = run.book.funds_csv()
+    rows = run.book.fund_count + 1
+    run.measure('fund_upload_insert',
+                lambda: ingest_funds(io.StringIO(data)), repeat=1, rows=rows)
+    run.measure('fund_upload_unchanged',
+                lambda: ingest_funds(io.StringIO(data)), rows=rows)
+
+
+def bench_reference_data(run):
+    Portfolio.objects.bulk_create(run.book.portfolios())
+    data = run.book.calendars_csv()
+    run.measure('calendar_upload', lambda: ingest_calendar_dates(
+        io.StringIO(data), create_calendars=True), repeat=1)
+    data = run.book.bbg_csv()
+    run.measure('bbg_upload', lambda: ingest_bbg_data(io.StringIO(data)),
+                repeat=1, rows=run.book.fund_count * run.book.bbg_months)
+
+
+def bench_position_upload(run):
+    data = run.book.positions_csv()
+    rows = run.book.positions
+    run.measure('position_upload_insert', lambda: ingest_positions(
+        io.StringIO(data), mode=REPLACE), repeat=1, rows=rows)
+    run.measure('position_upload_replace', lambda: ingest_positions(
+        io.StringIO(data), mode=REPLACE), rows=rows)
+
+
+def bench_calculate_trades(run):
+    book = run.book
+    accounts = book.accounts[:run.trade_portfolios]
+    portfolios = list(Portfolio.objects.filter(account_number__in=accounts))
+    model = get_target_model(book.target_weights_csv().encode(), PERCENT)
+
+    def calculate():
+        trades = 0
+        for portfolio in portfolios:
+            trades += len(calculate_trades(
+                portfolio, Position.objects.as_of(book.valuation_date,
+                                                  [portfolio]),
+                model, 'Both', 1000000, book.valuation_date))
+        return trades
+
+    run.measure('calculate_trades', calculate, portfolios=len(portfolios),
+                trades=calculate())
+
+
+def bench_drift(run):
+    book = run.book
+    model = get_target_model(book.target_weights_csv().encode(), PERCENT)
+    Portfolio.objects.update(target_model=model)
+    run.measure('drift_refresh_full', refresh_drift, repeat=1,
+                portfolios=book.portfolio_count)
+
+    # Reloading an unchanged file leaves nothing to refresh
+    data = book.positions_csv()
+    ingest_positions(io.StringIO(data), mode=REPLACE)
+    refreshed = run.measure('drift_refresh_unchanged', refresh_drift,
+                            repeat=1)
+    run.results[-1]['portfolios'] = refreshed
+
+
+def bench_views(run):
+    run.get('view_index_cold', reverse('index'), cold=True)
+    run.get('view_index_warm', reverse('index'))
+    run.get('view_portfolios', reverse('portfolios'))
+    run.get('view_drift', reverse('drift') + '?all=1')
+    run.get('view_portfolios_json', reverse('portfolios-json') +
+            '?draw=1&start=0&length=50&order[0][column]=0'
+            '&columns[0][data]=value&order[0][dir]=desc')
+
+
+BENCHMARKS = (
+    bench_fund_upload,
+    bench_reference_data,
+    bench_position_upload,
+    bench_calculate_trades,
+    bench_drift,
+    bench_views,
+)
+
+
+def run_benchmarks(book, repeat=3, trade_portfolios=20, log=None):
+    """
+    Run every benchmark over `book` (in an empty database) and return the
+    BenchmarkRun with the results
+    """
+    run = BenchmarkRun(book, repeat, trade_portfolios, log)
+    for benchmark in BENCHMARKS:
+        benchmark(run)
+    return run
@@ -0,0 +1,82 @@
+"""
+Versioned caching of expensive page context.
+
+Each kind of data (calendars, funds, portfolios, positions) has a version
+number in the cache. Cached entries are keyed on the versions of the data
+they were built from, so bumping a version (on uploads and model changes)
+invalidates every entry built from it without having to know their keys.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+
+CALENDARS = 'calendars'
+FUNDS = 'funds'
+PORTFOLIOS = 'portfolios'
+POSITIONS = 'positions'
+
+VERSION_KEY = 'trading:version:%s'
+
+
+def new_version():
+    # Time based, so a version lost from the cache never restarts at a
+    # number an older entry was built with
+    return int(time.time() * 1000)
+
+
+def get_versions(names):
+    keys = [VERSION_KEY % name for name in names]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, new_version(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def adopt_versions(versions):
+    """
+    Take on the newer of the given versions (e.g. those of the process that
+    submitted a job), so the process caches of a pool worker with its own
+    cache backend notice changes made elsewhere
+    """
+    current = dict(zip(versions, get_versions(list(versions))))
+    cache.set_many({VERSION_KEY % name: version
+                    for name, version in versions.items()
+                    if version > current[name]}, None)
+
+
+def bump(*names):
+    """
+    Invalidate everything cached from the named data
+    """
+    for name in names:
+        try:
+            cache.incr(VERSION_KEY % name)
+        except ValueError:
+            cache.set(VERSION_KEY % name, new_version(), None)
+
+
+def bump_on_commit(*names):
+    """
+    Bump once the current transaction commits, so a concurrent request
+    cannot cache the old data under the new version
+    """
+    transaction.on_commit(lambda: bump(*names))
+
+
+def cached(name, depends_on, build):
+    """
+    Value of `build()` cached for the current versions of `depends_on`
+    """
+    key = 'trading:%s:%s' % (
+        name, ':'.join(str(v) for v in get_versions(depends_on)))
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, getattr(settings, 'TRADING_CACHE_TIMEOUT',
+                                      None))
+    return value
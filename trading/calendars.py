@@ -0,0 +1,199 @@
+"""
+Business-day calendar engine for notice, trade and settlement dates.
+
+Every Calendar's holidays are loaded once; each distinct combination of
+calendars (Fund.terms_calendars) is merged into a sorted array of business
+days, so date arithmetic is a binary search plus an index offset.
+"""
+import datetime
+import logging
+import re
+
+import numpy as np
+
+from .cache import CALENDARS, get_versions
+from .models import CalendarDate
+
+
+logger = logging.getLogger(__name__)
+
+# Range covered by the business-day arrays
+FIRST_DAY = np.datetime64('1990-01-01', 'D')
+LAST_DAY = np.datetime64('2100-12-31', 'D')
+
+# Separators accepted between calendar codes in Fund.terms_calendars
+CALENDAR_SEPARATORS = re.compile(r'[\s,;/|+]+')
+
+
+def parse_calendar_codes(terms_calendars):
+    """
+    Split a Fund.terms_calendars string into a sorted tuple of codes
+    """
+    codes = CALENDAR_SEPARATORS.split(terms_calendars or '')
+    return tuple(sorted(set(code.upper() for code in codes if code)))
+
+
+def to_dates(dates):
+    return np.asarray(dates, dtype='datetime64[D]')
+
+
+class BusinessCalendar:
+    """
+    Business days (weekdays that are not holidays in any of the merged
+    calendars) as a sorted datetime64 array.
+    """
+
+    def __init__(self, holidays=()):
+        days = np.arange(FIRST_DAY, LAST_DAY + 1)
+        weekdays = np.is_busday(days)
+        if len(holidays):
+            weekdays &= ~np.isin(days, to_dates(holidays))
+        self.days = days[weekdays]
+
+    # Methods
+    def _check_range(self, dates):
+        if len(dates) and (dates.min() < FIRST_DAY or dates.max() > LAST_DAY):
+            raise ValueError('Date outside the supported calendar range '
+                             '(%s to %s)' % (FIRST_DAY, LAST_DAY))
+
+    def is_business_day(self, dates):
+        dates = to_dates(dates)
+        position = np.searchsorted(self.days, dates)
+        position = np.minimum(position, len(self.days) - 1)
+        return self.days[position] == dates
+
+    def add_business_days(self, dates, offsets):
+        """
+        Add `offsets` business days to `dates` (vectorized).
+
+        Non business days are first rolled forward for positive/zero
+        offsets and backward for negative offsets (numpy busday_offset
+        'following'/'preceding' semantics).
+        """
+        dates = np.atleast_1d(to_dates(dates))
+        offsets = np.broadcast_to(np.asarray(offsets, dtype=int), dates.shape)
+        self._check_range(dates)
+
+        following = np.searchsorted(self.days, dates, side='left')
+        preceding = np.searchsorted(self.days, dates, side='right') - 1
+        position = np.where(offsets >= 0, following, preceding) + offsets
+        if len(position) and (position.min() < 0 or
+                              position.max() >= len(self.days)):
+            raise ValueError('Business day offset outside the supported '
+                             'calendar range')
+        return self.days[position]
+
+    def roll_forward(self, dates):
+        """
+        First business day at or after each date
+        """
+        return self.add_business_days(dates, 0)
+
+    def next_dealing_day(self, when, cutoff_time=None):
+        """
+        First business day on which an order placed at `when` can deal.
+
+        A datetime after `cutoff_time` misses that day's cut-off and rolls
+        to the next day before looking for a business day.
+        """
+        day = when.date() if isinstance(when, datetime.datetime) else when
+        if (cutoff_time is not None and isinstance(when, datetime.datetime)
+                and when.time() > cutoff_time):
+            day += datetime.timedelta(days=1)
+        return self.roll_forward(day)[0].item()
+
+    def add(self, date, offset):
+        """
+        Scalar version of add_business_days returning a datetime.date
+        """
+        return self.add_business_days(date, offset)[0].item()
+
+
+class CalendarIndex:
+    """
+    Holidays of every Calendar (loaded with a single query) and a cache of
+    merged BusinessCalendars per distinct combination of calendar codes.
+    """
+
+    def __init__(self, holidays_by_code, version=None):
+        self.holidays_by_code = holidays_by_code
+        self.version = version
+        self._merged = {}
+
+    @classmethod
+    def from_db(cls, version=None):
+        holidays = {}
+        for code, date in CalendarDate.objects.filter(
+                code__isnull=False).values_list('code__code', 'date'):
+            holidays.setdefault(code.upper(), []).append(date)
+        return cls({code: to_dates(dates)
+                    for code, dates in holidays.items()}, version)
+
+    # Methods
+    def for_calendars(self, terms_calendars):
+        """
+        Merged BusinessCalendar for a Fund.terms_calendars value
+        """
+        codes = parse_calendar_codes(terms_calendars)
+        calendar = self._merged.get(codes)
+        if calendar is None:
+            unknown = [c for c in codes if c not in self.holidays_by_code]
+            if unknown:
+                logger.warning('Unknown calendar code(s) %s, treated as '
+                               'weekends only', ', '.join(unknown))
+            holidays = [self.holidays_by_code[c] for c in codes
+                        if c in self.holidays_by_code]
+            calendar = BusinessCalendar(
+                np.concatenate(holidays) if holidays else ())
+            self._merged[codes] = calendar
+        return calendar
+
+    def add_business_days(self, terms_calendars, dates, offsets):
+        """
+        Batch version of BusinessCalendar.add_business_days over arrays of
+        calendars (one per fund/row), dates and offsets.
+        """
+        dates = to_dates(dates)
+        terms_calendars = np.broadcast_to(
+            np.asarray(terms_calendars, dtype=object), dates.shape)
+        offsets = np.broadcast_to(np.asarray(offsets, dtype=int), dates.shape)
+
+        keys = np.array(['|'.join(parse_calendar_codes(t))
+                         for t in terms_calendars.tolist()], dtype=str)
+        result = np.empty(dates.shape, dtype='datetime64[D]')
+        if not len(keys):
+            return result
+
+        # One vectorized call per distinct calendar combination
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        for i, key in enumerate(unique_keys):
+            rows = inverse == i
+            result[rows] = self.for_calendars(key).add_business_days(
+                dates[rows], offsets[rows])
+        return result
+
+    def roll_forward(self, terms_calendars, dates):
+        return self.add_business_days(terms_calendars, dates, 0)
+
+
+_calendar_index = None
+
+
+def get_calendar_index():
+    """
+    Process wide CalendarIndex, reloaded when the CALENDARS cache version
+    has changed (so pool workers see holidays uploaded elsewhere)
+    """
+    global _calendar_index
+    version, = get_versions([CALENDARS])
+    if _calendar_index is None or _calendar_index.version != version:
+        _calendar_index = CalendarIndex.from_db(version)
+    return _calendar_index
+
+
+def clear_calendar_cache():
+    """
+    Drop the cached CalendarIndex (called when calendars/holidays change)
+    """
+    global _calendar_index
+    _calendar_index = None
@@ -0,0 +1,157 @@
+"""
+Pre-trade compliance checks.
+
+Every proposed trade of a run is checked at once on NumPy arrays. Breaches
+are stored on TradeItem as a bit mask (breach_flags) so they can be
+filtered, plus the matching codes as text for display.
+"""
+import numpy as np
+
+from .bbgstore import get_bbg_store
+from .models import Fund, Portfolio
+
+
+# Breach codes and their bit in TradeItem.breach_flags
+MAX_WEIGHT = 1
+SHARES_OWNED = 2
+ASSETS_OWNED = 4
+RESTRICTED = 8
+SUB_MINIMUM = 16
+
+BREACH_CODES = (
+    (MAX_WEIGHT, 'MAX_WEIGHT', 'Post-trade weight above max weight'),
+    (SHARES_OWNED, 'SHARES_OWNED', 'Share of fund shares owned above limit'),
+    (ASSETS_OWNED, 'ASSETS_OWNED', 'Share of fund assets owned above limit'),
+    (RESTRICTED, 'RESTRICTED', 'Subscription into a restricted fund'),
+    (SUB_MINIMUM, 'SUB_MINIMUM', 'Subscription below the fund minimum'),
+)
+
+
+def breach_codes(flags):
+    """
+    Comma separated breach codes of a breach_flags value
+    """
+    return ','.join(code for bit, code, _ in BREACH_CODES if flags & bit)
+
+
+def _lookup(keys, table_keys, values, default=np.nan):
+    """
+    Values of `table_keys` (sorted) rows matching `keys`, default if absent
+    """
+    if not len(table_keys):
+        return np.full(len(keys), default, dtype=float)
+    rows = np.minimum(np.searchsorted(table_keys, keys), len(table_keys) - 1)
+    return np.where(table_keys[rows] == keys, values[rows], default)
+
+
+def load_fund_limits(isins, as_of):
+    """
+    Restriction flag, subscription minimum and as-of BBG assets/shares of
+    `isins` as arrays sorted by ISIN (one query, BBG data from the store)
+    """
+    rows = list(Fund.objects.filter(isin__in=list(isins)).order_by(
+        'isin').values_list('isin', 'flag_restricted', 'terms_sub_minimum'))
+    if not rows:
+        return (np.array([], dtype=str),) + (np.zeros(0),) * 4
+
+    isins, restricted, minimum = zip(*rows)
+    isins = np.array(isins, dtype=str)
+    _, assets, shares_issued = get_bbg_store().as_of(isins, as_of)
+    return (isins,
+            np.array(restricted, dtype=float),
+            np.array(minimum, dtype=float),
+            assets,
+            shares_issued)
+
+
+def load_portfolio_limits(accounts):
+    """
+    Guideline limits (in %, NaN when not set) of `accounts` sorted by
+    account number (one query)
+    """
+    rows = list(Portfolio.objects.filter(
+        account_number__in=list(accounts)).order_by(
+            'account_number').values_list(
+                'account_number', 'guideline_max_weight',
+                'guideline_shares_owned', 'guideline_assets_owned'))
+    if not rows:
+        return (np.array([], dtype=str),) + (np.zeros(0),) * 3
+
+    accounts, max_weight, shares_owned, assets_owned = zip(*rows)
+    return (np.array(accounts, dtype=str),
+            np.array(max_weight, dtype=float),
+            np.array(shares_owned, dtype=float),
+            np.array(assets_owned, dtype=float))
+
+
+def check_trades(trades, as_of):
+    """
+    Breach flags (int array aligned on `trades`) of a run's trade dicts.
+
+    Checks the post-trade weight against the portfolio max weight, the
+    post-trade share of the fund's shares/assets owned by the portfolio
+    against its guidelines (BBG data as of `as_of`), subscriptions into
+    restricted funds and subscriptions below the fund minimum.
+    """
+    if not trades:
+        return np.zeros(0, dtype=int)
+
+    return breach_flags(
+        np.array([t['account_number'] for t in trades], dtype=str),
+        np.array([t['isin'] for t in trades], dtype=str),
+        np.array([t['traded_amount'] for t in trades], dtype=float),
+        np.array([t['traded_shares'] for t in trades], dtype=float),
+        np.array([t['current_value'] for t in trades], dtype=float),
+        np.array([t.get('current_shares', 0) for t in trades], dtype=float),
+        np.array([t.get('post_trade_weight', 0) for t in trades],
+                 dtype=float),
+        as_of)
+
+
+def check_scenarios(account_number, scenarios, as_of):
+    """
+    Breach flags (S x F int matrix) of the trades of a scenario sweep (see
+    trading.calculate_scenarios); funds without a trade are never flagged
+    """
+    amounts = scenarios['amounts']
+    flags = breach_flags(
+        np.array([account_number], dtype=str), scenarios['isins'],
+        amounts, scenarios['shares'], scenarios['current'],
+        scenarios['held_shares'], scenarios['post_weights'], as_of)
+    return np.where(amounts != 0, flags, 0)
+
+
+def breach_flags(accounts, isins, amount, shares, value, held, weight,
+                 as_of):
+    """
+    Breach flags of trades given as broadcastable arrays of account numbers,
+    ISINs, traded amounts and shares, current values and shares held, and
+    post-trade weights
+    """
+    fund_isins, restricted, minimum, assets, shares_issued = \
+        load_fund_limits(np.unique(isins), as_of)
+    portfolio_accounts, max_weight, shares_limit, assets_limit = \
+        load_portfolio_limits(np.unique(accounts))
+
+    restricted = _lookup(isins, fund_isins, restricted, 0)
+    minimum = _lookup(isins, fund_isins, minimum, 0)
+    assets = _lookup(isins, fund_isins, assets)
+    shares_issued = _lookup(isins, fund_isins, shares_issued)
+    max_weight = _lookup(accounts, portfolio_accounts, max_weight)
+    shares_limit = _lookup(accounts, portfolio_accounts, shares_limit)
+    assets_limit = _lookup(accounts, portfolio_accounts, assets_limit)
+
+    subscription = amount > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares_owned = 100 * (held + shares) / shares_issued
+        assets_owned = 100 * (value + amount) / assets
+
+    # Comparisons with NaN (limit or BBG data missing) are False
+    flags = np.zeros(np.broadcast(amount, weight, restricted,
+                                  max_weight).shape, dtype=int)
+    flags |= np.where(100 * weight > max_weight, MAX_WEIGHT, 0)
+    flags |= np.where(shares_owned > shares_limit, SHARES_OWNED, 0)
+    flags |= np.where(assets_owned > assets_limit, ASSETS_OWNED, 0)
+    flags |= np.where(subscription & (restricted > 0), RESTRICTED, 0)
+    flags |= np.where(subscription & (amount < minimum), SUB_MINIMUM, 0)
+    return flags
@@ -0,0 +1,71 @@
+"""
+Firm-wide ownership concentration: total holdings of every fund across all
+portfolios (FundHolding) against the fund's as-of BBGData.
+"""
+import numpy as np
+from django.db.models import Max, Min
+
+from .bbgstore import get_bbg_store
+from .models import FundHolding, Portfolio
+
+
+def latest_holding_date():
+    return FundHolding.objects.aggregate(Max('valuation_date'))[
+        'valuation_date__max']
+
+
+def ownership_report(valuation_date=None):
+    """
+    Ownership of every fund held on `valuation_date` (default: latest).
+
+    Returns (valuation_date, rows, limits): rows are dicts sorted by the
+    share of the fund owned, largest first (percentages are None when no
+    BBGData exists on or before the valuation date) and limits are the
+    strictest Active portfolio guidelines, used to flag the rows.
+    """
+    # Strictest portfolio guidelines, as a reference for the firm-wide level
+    limits = Portfolio.objects.filter(status='Active').aggregate(
+        shares=Min('guideline_shares_owned'),
+        assets=Min('guideline_assets_owned'))
+
+    valuation_date = valuation_date or latest_holding_date()
+    if valuation_date is None:
+        return None, [], limits
+
+    holdings = list(FundHolding.objects.filter(
+        valuation_date=valuation_date).values(
+            'isin', 'isin__name', 'total_value', 'total_shares',
+            'position_count'))
+
+    # As-of BBG data of every held fund in one vectorized lookup
+    dates, assets, shares_issued = get_bbg_store().as_of(
+        [holding['isin'] for holding in holdings], valuation_date)
+    assets = np.where(np.isnan(assets), None, assets)
+    shares_issued = np.where(np.isnan(shares_issued), None, shares_issued)
+    for holding, date, fund_assets, fund_shares in zip(
+            holdings, dates.tolist(), assets.tolist(),
+            shares_issued.tolist()):
+        holding['bbg_date'] = date
+        holding['bbg_assets'] = fund_assets
+        holding['bbg_shares_issued'] = fund_shares
+
+    rows = []
+    for holding in holdings:
+        shares_issued = holding['bbg_shares_issued']
+        assets = holding['bbg_assets']
+        holding['shares_owned_pct'] = (
+            100 * holding['total_shares'] / shares_issued
+            if shares_issued else None)
+        holding['assets_owned_pct'] = (
+            100 * holding['total_value'] / assets if assets else None)
+        holding['breach'] = bool(
+            (limits['shares'] and holding['shares_owned_pct'] and
+             holding['shares_owned_pct'] > limits['shares']) or
+            (limits['assets'] and holding['assets_owned_pct'] and
+             holding['assets_owned_pct'] > limits['assets']))
+        rows.append(holding)
+
+    rows.sort(key=lambda row: max(row['shares_owned_pct'] or 0,
+                                  row['assets_owned_pct'] or 0),
+              reverse=True)
+    return valuation_date, rows, limits
@@ -0,0 +1,210 @@
+"""
+Incremental drift monitor.
+
+Every portfolio with a target model (Portfolio.target_model) has a
+PortfolioDrift row holding its drift from the model and the Rebalance
+trades back to it. Rows are marked dirty when something they were built
+from changes:
+
+- the portfolio's positions (position loads mark the accounts whose rows
+  actually changed, see aggregates.AccountChanges),
+- the portfolio itself (its target model or tolerance),
+- the funds it holds or targets (fund master and BBG price changes).
+
+refresh_drift() only recomputes the dirty rows, so the cost of a daily
+position load is proportional to the portfolios that changed, not to the
+size of the book.
+"""
+import json
+import logging
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from .fundindex import get_fund_index
+from .models import Portfolio, PortfolioDrift, Position, TargetModel
+from .targets import model_arrays
+from .trading import (
+    Book, FundTerms, TargetCandidates, load_books, portfolio_arrays,
+    portfolio_trades)
+
+
+logger = logging.getLogger(__name__)
+
+# Keys per UPDATE statement (keeps under the sqlite parameter limit)
+MARK_BATCH_SIZE = 500
+
+# Above this many changed funds every portfolio is marked dirty rather than
+# looking up the holders of each fund
+MAX_FUNDS_LOOKED_UP = 2000
+
+DRIFT_FIELDS = ('dirty', 'target_model', 'valuation_date', 'nav', 'drift',
+                'max_drift', 'max_drift_isin', 'outside_tolerance',
+                'trade_count', 'turnover', 'trades', 'error', 'updated_at')
+
+
+def mark_dirty(accounts):
+    """
+    Mark the drift of the portfolios in `accounts` for recalculation
+    """
+    accounts = list(accounts)
+    marked = 0
+    for i in range(0, len(accounts), MARK_BATCH_SIZE):
+        marked += PortfolioDrift.objects.filter(
+            account_number__in=accounts[i:i + MARK_BATCH_SIZE],
+            dirty=False).update(dirty=True)
+    return marked
+
+
+def mark_models_dirty(index_isins):
+    """
+    Mark the portfolios whose target model includes any of `index_isins`
+    """
+    index_isins = np.asarray(list(index_isins), dtype=str)
+    if not len(index_isins):
+        return 0
+    models = [model.pk for model in TargetModel.objects.filter(
+        portfolios__isnull=False).distinct()
+        if np.isin(model_arrays(model)[0], index_isins).any()]
+    if not models:
+        return 0
+    return PortfolioDrift.objects.filter(
+        account_number__target_model__in=models, dirty=False).update(
+            dirty=True)
+
+
+def mark_funds_dirty(isins, index_isins=()):
+    """
+    Mark the portfolios holding any of the funds `isins` or targeting the
+    index ISINs they track (plus `index_isins`, e.g. ones the funds have
+    just left), after fund terms or prices changed
+    """
+    isins = sorted(set(isins))
+    if not isins and not index_isins:
+        return 0
+    if len(isins) > MAX_FUNDS_LOOKED_UP:
+        return PortfolioDrift.objects.filter(dirty=False).update(dirty=True)
+
+    fund_index = get_fund_index()
+    tracked = fund_index.index_isins[np.isin(fund_index.isins, isins)]
+    marked = mark_models_dirty(np.union1d(
+        tracked, np.asarray(list(index_isins), dtype=str)))
+    for i in range(0, len(isins), MARK_BATCH_SIZE):
+        marked += mark_dirty(Position.objects.as_of().filter(
+            isin__in=isins[i:i + MARK_BATCH_SIZE]).values_list(
+                'account_number', flat=True).distinct())
+    return marked
+
+
+def sync_portfolio(portfolio):
+    """
+    Create (dirty) or delete the PortfolioDrift of a saved portfolio
+    """
+    if portfolio.target_model_id is None:
+        PortfolioDrift.objects.filter(account_number=portfolio).delete()
+    else:
+        PortfolioDrift.objects.update_or_create(
+            account_number=portfolio, defaults={'dirty': True})
+
+
+def sync_drift_rows():
+    """
+    Add the rows of portfolios given a target model without signals (e.g.
+    bulk updates) and drop the rows of portfolios that lost theirs
+    """
+    PortfolioDrift.objects.filter(
+        account_number__target_model__isnull=True).delete()
+    missing = Portfolio.objects.filter(
+        target_model__isnull=False, drift__isnull=True).values_list(
+            'pk', flat=True)
+    PortfolioDrift.objects.bulk_create(
+        [PortfolioDrift(account_number_id=pk) for pk in missing])
+
+
+def drift_measures(book, index_isins, weights, candidates, terms):
+    """
+    (drift, max_drift, max_drift_isin) of a portfolio, in % of its NAV
+    """
+    universe, current, _, _, target = portfolio_arrays(
+        book, index_isins, weights, candidates, terms)
+    nav = book.nav
+    if nav <= 0 or not len(universe):
+        return 0.0, 0.0, ''
+    differences = np.abs(current / nav - target)
+    cash_difference = abs(book.cash / nav - (1 - target.sum()))
+    largest = int(differences.argmax())
+    return (50 * (differences.sum() + cash_difference),
+            100 * differences[largest], universe[largest])
+
+
+def refresh_group(drifts, books, model, valuation_date):
+    """
+    Recompute the drift rows of the portfolios sharing a target model and
+    valuation date (candidates and fund terms are loaded once)
+    """
+    index_isins, weights = model_arrays(model)
+    candidates = TargetCandidates.load(index_isins)
+    held = [books[drift.account_number_id].isins for drift in drifts]
+    terms = FundTerms.load(
+        np.union1d(np.concatenate(held), candidates.isins), valuation_date)
+
+    for drift in drifts:
+        book = books[drift.account_number_id]
+        drift.nav = book.nav
+        try:
+            drift.drift, drift.max_drift, drift.max_drift_isin = \
+                drift_measures(book, index_isins, weights, candidates, terms)
+            trades = portfolio_trades(
+                drift.account_number_id, book, index_isins, weights,
+                candidates, terms, 'Rebalance', 0)
+            drift.error = ''
+        except ValueError as e:
+            drift.drift = drift.max_drift = 0
+            drift.max_drift_isin = ''
+            trades, drift.error = [], str(e)
+        drift.trades = json.dumps(trades)
+        drift.trade_count = len(trades)
+        drift.turnover = sum(abs(t['traded_amount']) for t in trades)
+
+
+def refresh_drift():
+    """
+    Recompute the drift and Rebalance trades of every dirty portfolio
+    against its target model, on its latest positions.
+
+    Returns the number of portfolios refreshed.
+    """
+    with transaction.atomic():
+        sync_drift_rows()
+        drifts = list(PortfolioDrift.objects.filter(
+            dirty=True).select_related('account_number__target_model'))
+        if not drifts:
+            return 0
+
+        books = load_books(Position.objects.as_of(
+            None, [drift.account_number_id for drift in drifts]))
+        groups = {}
+        for drift in drifts:
+            portfolio = drift.account_number
+            book = books.setdefault(portfolio.pk, Book.empty())
+            drift.target_model = portfolio.target_model
+            drift.valuation_date = book.valuation_date
+            groups.setdefault((portfolio.target_model_id,
+                               book.valuation_date), []).append(drift)
+
+        for (_, valuation_date), group in groups.items():
+            refresh_group(group, books, group[0].target_model,
+                          valuation_date or timezone.localdate())
+
+        now = timezone.now()
+        for drift in drifts:
+            drift.dirty = False
+            drift.outside_tolerance = (
+                not drift.error and
+                drift.max_drift > float(drift.account_number.drift_tolerance))
+            drift.updated_at = now
+        PortfolioDrift.objects.bulk_update(drifts, DRIFT_FIELDS)
+
+    logger.debug('Drift of %d portfolios refreshed', len(drifts))
+    return len(drifts)
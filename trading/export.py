@@ -0,0 +1,213 @@
+"""
+Streaming exports of positions, trades and Bloomberg data for downstream
+systems, as CSV or (when pyarrow is installed) Parquet.
+
+Rows are read with queryset.iterator() and written out a chunk at a time,
+so memory stays flat whatever the size of the export.
+"""
+import csv
+import itertools
+
+from .models import BBGData, Position, TradeItem
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Rows fetched per database round trip (and written per CSV chunk)
+CHUNK_SIZE = 2000
+
+# Rows per Parquet row group
+ROW_GROUP_SIZE = 50000
+
+FORMATS = {
+    # format -> (content type, file extension)
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+class Dataset:
+    """
+    An exportable model: its columns as (name, ORM lookup, type) and the
+    fields its date range, account and ISIN filters apply to
+    """
+
+    def __init__(self, model, columns, date_field, account_field=None,
+                 isin_field='isin'):
+        self.model = model
+        self.columns = columns
+        self.date_field = date_field
+        self.account_field = account_field
+        self.isin_field = isin_field
+
+    # Methods
+    @property
+    def names(self):
+        return [name for name, _, _ in self.columns]
+
+    def queryset(self, date_from=None, date_to=None, account=None,
+                 isin=None):
+        queryset = self.model.objects.all()
+        if date_from:
+            queryset = queryset.filter(**{self.date_field + '__gte':
+                                          date_from})
+        if date_to:
+            queryset = queryset.filter(**{self.date_field + '__lte': date_to})
+        if account:
+            if self.account_field is None:
+                raise ValueError("%s cannot be filtered by account" %
+                                 self.model._meta.verbose_name)
+            queryset = queryset.filter(**{self.account_field: account})
+        if isin:
+            queryset = queryset.filter(**{self.isin_field: isin})
+        return queryset.order_by(self.date_field, 'pk').values_list(
+            *[lookup for _, lookup, _ in self.columns])
+
+    def rows(self, **filters):
+        return self.queryset(**filters).iterator(chunk_size=CHUNK_SIZE)
+
+
+DATASETS = {
+    'positions': Dataset(Position, (
+        ('valuation_date', 'valuation_date', 'date'),
+        ('account_number', 'account_number_id', 'string'),
+        ('isin', 'isin_id', 'string'),
+        ('flag_cash', 'flag_cash', 'bool'),
+        ('value', 'value', 'float'),
+        ('shares', 'shares', 'float'),
+        ('price', 'price', 'float'),
+    ), 'valuation_date', 'account_number'),
+    'trades': Dataset(TradeItem, (
+        ('id', 'id', 'int'),
+        ('run', 'run_id', 'int'),
+        ('account_number', 'account_number_id', 'string'),
+        ('isin', 'isin_id', 'string'),
+        ('notice_date', 'notice_date', 'date'),
+        ('trade_date', 'trade_date', 'date'),
+        ('settlement_date', 'settlement_date', 'date'),
+        ('traded_amount', 'traded_amount', 'float'),
+        ('traded_shares', 'traded_shares', 'float'),
+        ('trade_note', 'trade_note', 'string'),
+        ('breaches', 'breaches', 'string'),
+    ), 'trade_date', 'account_number'),
+    'bbg': Dataset(BBGData, (
+        ('date', 'date', 'date'),
+        ('isin', 'isin_id', 'string'),
+        ('assets', 'assets', 'float'),
+        ('shares_issued', 'shares_issued', 'float'),
+    ), 'date'),
+}
+
+
+def chunked(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Echo:
+    """
+    File-like object returning what is written to it, so csv.writer can
+    produce strings for a generator
+    """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(dataset, **filters):
+    writer = csv.writer(Echo())
+    yield writer.writerow(dataset.names)
+    for chunk in chunked(dataset.rows(**filters), CHUNK_SIZE):
+        yield ''.join(writer.writerow(row) for row in chunk)
+
+
+class ByteSink:
+    """
+    Write-only file collecting the bytes written to it until drained
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+        self.closed = False
+
+    # Methods
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def arrow_schema(dataset):
+    types = {
+        'string': pyarrow.string(),
+        'date': pyarrow.date32(),
+        'float': pyarrow.float64(),
+        'bool': pyarrow.bool_(),
+        'int': pyarrow.int64(),
+    }
+    return pyarrow.schema([(name, types[kind])
+                           for name, _, kind in dataset.columns])
+
+
+def stream_parquet(dataset, **filters):
+    """
+    Parquet file written one row group at a time, each yielded as soon as
+    it is encoded
+    """
+    schema = arrow_schema(dataset)
+    sink = ByteSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression='snappy')
+    for chunk in chunked(dataset.rows(**filters), ROW_GROUP_SIZE):
+        columns = zip(*chunk)
+        writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=field.type)
+             for values, field in zip(columns, schema)], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export(name, fmt='csv', **filters):
+    """
+    Check an export request and return (chunks generator, content type,
+    file name). Raises ValueError for an unknown dataset or format, or
+    when Parquet is asked for without pyarrow installed.
+    """
+    if name not in DATASETS:
+        raise ValueError("unknown dataset '%s'" % name)
+    if fmt not in FORMATS:
+        raise ValueError("unknown format '%s'" % fmt)
+    if fmt == 'parquet' and pyarrow is None:
+        raise ValueError("the parquet format needs the pyarrow package")
+
+    dataset = DATASETS[name]
+    # Build the queryset now so filter errors are raised before streaming
+    dataset.queryset(**filters)
+
+    content_type, extension = FORMATS[fmt]
+    stream = stream_parquet if fmt == 'parquet' else stream_csv
+    return (stream(dataset, **filters), content_type,
+            '%s.%s' % (name, extension))
@@ -1,13 +1,42 @@
 import io
-import csv
-import trading
 
+import numpy as np
 from django import forms
-from .models import Fund, Portfolio, Position
+from django.db.models import F
+from .models import Portfolio
+from .ingest import LOAD_MODES, REPLACE, ingest_funds, ingest_positions
+from .ingest import ingest_bbg_data, ingest_calendar_dates
+from .compliance import BREACH_CODES
+from .export import export
+from .jobs import submit_job
+from .targets import WEIGHT_UNITS, get_target_model
 from django.core.validators import ValidationError
 
 
-class GenerateTradesForm(forms.Form):
+class TargetWeightsMixin:
+    """
+    Reading of the uploaded target weights file (target_weights_file field)
+    """
+
+    def read_target_model(self):
+        """
+        TargetModel of the uploaded file; a file uploaded before is not
+        parsed again. Bad files raise ValueError, reported on the form.
+        """
+        f = self.check_file_csv()
+        return get_target_model(f.read(), self.cleaned_data['weight_unit'],
+                                f.name)
+
+    def check_file_csv(self):
+        f = self.cleaned_data['target_weights_file']
+        if f:
+            ext = f.name.split('.')[-1]
+            if ext != 'csv':
+                raise forms.ValidationError('File type not supported')
+        return f
+
+
+class GenerateTradesForm(TargetWeightsMixin, forms.Form):
 
     # Fields (inputs)
     account = forms.ModelChoiceField(queryset=None)
@@ -19,6 +48,9 @@ class GenerateTradesForm(forms.Form):
         choices=(
             ('Cash', 'Cash'), ('Rebalance', 'Rebalance'), ('Both', 'Both')))
     target_weights_file = forms.FileField()
+    weight_unit = forms.ChoiceField(
+        widget=forms.RadioSelect, choices=WEIGHT_UNITS,
+        label='Weights are in')
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -39,47 +71,183 @@ class GenerateTradesForm(forms.Form):
         # Remember to always return the cleaned data.
         return data
 
-    def read_target_weights(self):
-        f = io.TextIOWrapper(self.check_file_csv().file)
-        reader = csv.DictReader(f)
+    def process_data(self):
+        portfolio = self.cleaned_data['account']
+        target_model = self.read_target_model()
 
-        data = []
-        for line_position in reader:
-            target_position = dict(line_position)
-            data = data.append({
-                "index_isin": target_position['ISIN'],
-                "target_weight": target_position['Weight']})
+        # Generate Trades in the background job pool - returns the TradeJob
+        return submit_job('trades', {
+            'account': portfolio.pk,
+            'trade_type': self.cleaned_data['trade_type'],
+            'net_flows': self.cleaned_data['net_flows'],
+            'trade_date': self.cleaned_data['trade_date'].isoformat(),
+            'model': target_model.pk,
+        })
 
-        return data
 
-    def check_file_csv(self):
-        f = self.cleaned_data['file']
-        if f:
-            ext = f.name.split('.')[-1]
-            if ext != 'csv':
-                raise forms.ValidationError('File type not supported')
-        return f
+class BatchGenerateTradesForm(TargetWeightsMixin, forms.Form):
+    """
+    Trades for a set of portfolios (or all Active ones) against one target
+    weights file
+    """
+
+    # Fields (inputs)
+    portfolios = forms.ModelMultipleChoiceField(queryset=None, required=False)
+    all_active = forms.BooleanField(
+        required=False, label='All Active portfolios')
+    trade_date = forms.DateField(
+        widget=forms.widgets.DateInput(attrs={'type': 'date'}))
+    net_flows = forms.FloatField(
+        initial=0, help_text='Applied to each portfolio')
+    trade_type = forms.ChoiceField(
+        widget=forms.RadioSelect,
+        choices=(
+            ('Cash', 'Cash'), ('Rebalance', 'Rebalance'), ('Both', 'Both')))
+    target_weights_file = forms.FileField()
+    weight_unit = forms.ChoiceField(
+        widget=forms.RadioSelect, choices=WEIGHT_UNITS,
+        label='Weights are in')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['portfolios'].queryset = Portfolio.objects.all()
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('portfolios') and \
+                not cleaned_data.get('all_active'):
+            raise ValidationError(
+                'Select portfolios or tick All Active portfolios')
+        return cleaned_data
 
     def process_data(self):
-        portfolio = self.cleaned_data['account']
-        trade_type = self.cleaned_data['trade_type']
-        trade_amount = self.cleaned_data['net_flows']
-        trade_date = self.cleaned_data['trade_date']
-        rebalance_weights = self.read_target_weights()
+        if self.cleaned_data['all_active']:
+            portfolios = Portfolio.objects.filter(status='Active')
+        else:
+            portfolios = self.cleaned_data['portfolios']
+        target_model = self.read_target_model()
+
+        # Generate Trades in the background job pool - returns the TradeJob
+        return submit_job('batch', {
+            'accounts': [str(pk) for pk in
+                         portfolios.values_list('pk', flat=True)],
+            'trade_type': self.cleaned_data['trade_type'],
+            'net_flows': self.cleaned_data['net_flows'],
+            'trade_date': self.cleaned_data['trade_date'].isoformat(),
+            'model': target_model.pk,
+        })
+
+
+class ScenarioForm(TargetWeightsMixin, forms.Form):
+    """
+    What-if sweep of one portfolio's trades over an evenly spaced grid of
+    net flows
+    """
+
+    MAX_SCENARIOS = 5000
 
-        # Get fund info - get all funds that have Index ISINd that match
-        # what is in the rbalance_weights data
+    # Fields (inputs)
+    account = forms.ModelChoiceField(queryset=None)
+    trade_date = forms.DateField(
+        widget=forms.widgets.DateInput(attrs={'type': 'date'}))
+    trade_type = forms.ChoiceField(
+        widget=forms.RadioSelect,
+        choices=(
+            ('Cash', 'Cash'), ('Rebalance', 'Rebalance'), ('Both', 'Both')))
+    flows_from = forms.FloatField(label='Net flows from')
+    flows_to = forms.FloatField(label='Net flows to')
+    scenarios = forms.IntegerField(
+        min_value=2, max_value=MAX_SCENARIOS, initial=101,
+        help_text='Number of net flows from/to (inclusive)')
+    target_weights_file = forms.FileField()
+    weight_unit = forms.ChoiceField(
+        widget=forms.RadioSelect, choices=WEIGHT_UNITS,
+        label='Weights are in')
 
-        # Get the current portfolio from what is already stored in Position set
-        positions = portfolio.position_set.all()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['account'].queryset = Portfolio.objects.all()
 
-        # Generate Trades here - returned as dict()
-        sim_trades = trading.calculate_trades(
-            portfolio, positions, rebalance_weights,
-            trade_type, trade_amount, trade_date)
+    def clean(self):
+        cleaned_data = super().clean()
+        flows_from = cleaned_data.get('flows_from')
+        flows_to = cleaned_data.get('flows_to')
+        if flows_from is not None and flows_to is not None and \
+                flows_from > flows_to:
+            raise ValidationError('Net flows from is above net flows to')
+        return cleaned_data
 
-        # Return trading data
-        return sim_trades
+    def process_data(self):
+        portfolio = self.cleaned_data['account']
+        target_model = self.read_target_model()
+
+        return submit_job('scenario', {
+            'account': portfolio.pk,
+            'trade_type': self.cleaned_data['trade_type'],
+            'flows': np.linspace(self.cleaned_data['flows_from'],
+                                 self.cleaned_data['flows_to'],
+                                 self.cleaned_data['scenarios']).tolist(),
+            'trade_date': self.cleaned_data['trade_date'].isoformat(),
+            'model': target_model.pk,
+        })
+
+
+class TradeFilterForm(forms.Form):
+    """
+    Filters/sort of the trade blotter (GET parameters)
+    """
+
+    SORTS = (
+        ('-trade_date', 'Trade date (newest)'),
+        ('trade_date', 'Trade date (oldest)'),
+        ('account_number', 'Account'),
+        ('isin', 'ISIN'),
+        ('-traded_amount', 'Amount (largest)'),
+        ('traded_amount', 'Amount (smallest)'),
+    )
+
+    # Fields (inputs)
+    run = forms.IntegerField(required=False, widget=forms.HiddenInput)
+    account = forms.CharField(required=False)
+    isin = forms.CharField(required=False)
+    date_from = forms.DateField(
+        required=False,
+        widget=forms.widgets.DateInput(attrs={'type': 'date'}))
+    date_to = forms.DateField(
+        required=False,
+        widget=forms.widgets.DateInput(attrs={'type': 'date'}))
+    breach = forms.ChoiceField(
+        required=False,
+        choices=(('', 'Any'), ('all', 'All breaches')) + tuple(
+            (code, code) for _, code, _ in BREACH_CODES))
+    sort = forms.ChoiceField(choices=SORTS, required=False)
+
+    def filter(self, queryset):
+        if not self.is_valid():
+            return queryset.order_by('-trade_date', '-id')
+
+        data = self.cleaned_data
+        if data['run']:
+            queryset = queryset.filter(run_id=data['run'])
+        if data['account']:
+            queryset = queryset.filter(account_number_id=data['account'])
+        if data['isin']:
+            queryset = queryset.filter(isin_id=data['isin'])
+        if data['date_from']:
+            queryset = queryset.filter(trade_date__gte=data['date_from'])
+        if data['date_to']:
+            queryset = queryset.filter(trade_date__lte=data['date_to'])
+        if data['breach'] == 'all':
+            queryset = queryset.filter(breach_flags__gt=0)
+        elif data['breach']:
+            bit = {code: bit for bit, code, _ in BREACH_CODES}[data['breach']]
+            queryset = queryset.annotate(
+                breach_bit=F('breach_flags').bitand(bit)).filter(
+                    breach_bit__gt=0)
+
+        # id as tie breaker keeps the pages stable
+        sort = data['sort'] or '-trade_date'
+        return queryset.order_by(sort, '-id' if sort[0] == '-' else 'id')
 
 
 class UploadFileForm(forms.Form):
@@ -96,40 +264,42 @@ class UploadFileForm(forms.Form):
         return f
 
     def processs_data(self):
-        f = io.TextIOWrapper(self.clean_data_file().file)
-        reader = csv.DictReader(f)
-
-        for fund in reader:
-            new_fund = dict(fund)
-            Fund.objects.create(
-                status='Active',
-                isin=new_fund['isin'],
-                index_isin=new_fund['index_isin'],
-                name=new_fund['name'],
-                firm=new_fund['firm'],
-                style=new_fund['style'],
-                strategy=new_fund['strategy'],
-                flag_restrcited=new_fund['flag_restricted'],
-                flag_late_cutoff=new_fund['flag_late_cutoff'],
-                flag_units_trading=new_fund["flag_units_trading"],
-                terms_rank=new_fund["terms_rank"],
-                terms_rank_amount=new_fund["terms_rank_amount"],
-                terms_sub_notice=new_fund["terms_sub_notice"],
-                terms_sub_settlement=new_fund["terms_sub_settlement"],
-                terms_sub_minimum=new_fund["terms_sub_minimum"],
-                terms_red_notice=new_fund["terms_red_notice"],
-                terms_red_settlement=new_fund["terms_red_settlement"],
-                terms_cutoff_time=new_fund["terms_cutoff_time"],
-                terms_calendars=new_fund["terms_calendars"],
-                terms_man_fee=new_fund["terms_man_fee"],
-                terms_perf_fee=new_fund["terms_perf_fee"]
-            )
+        f = io.TextIOWrapper(self.clean_data_file().file,
+                             encoding='utf-8-sig')
+
+        # Insert new funds and update the changed ones in bulk
+        return ingest_funds(f)
 
 
 class UploadDailyPositionForm(forms.Form):
 
     # Fields
     file = forms.FileField()
+    mode = forms.ChoiceField(choices=LOAD_MODES, initial=REPLACE,
+                             label='Load mode')
+
+    # Methods
+    def clean_data_file(self):
+        f = self.cleaned_data['file']
+        if f:
+            ext = f.name.split('.')[-1]
+            if ext != 'csv':
+                raise forms.ValidationError('File type not supported')
+        return f
+
+    def processs_data(self):
+        f = io.TextIOWrapper(self.clean_data_file().file,
+                             encoding='utf-8-sig')
+
+        # Stream the file into Position with batched writes
+        return ingest_positions(f, mode=self.cleaned_data['mode'])
+
+
+class UploadBBGDataForm(forms.Form):
+
+    # Fields
+    file = forms.FileField(
+        help_text='CSV with isin, date, assets and shares_issued columns')
 
     # Methods
     def clean_data_file(self):
@@ -141,31 +311,77 @@ class UploadDailyPositionForm(forms.Form):
         return f
 
     def processs_data(self):
-        f = io.TextIOWrapper(self.clean_data_file().file)
-        reader = csv.DictReader(f)
-
-        for line_position in reader:
-            new_position = dict(line_position)
-
-            # Get corresponding Fund (by ISIN) object
-            fund_link = Fund.objects.get(pk=new_position['ISIN Number'])
-
-            # Get corresponding Portfolio (by Acount Number) object
-            portfolio_link = Portfolio.objects.get(pk=new_position['Fund'])
-
-            # check if position line item is cash
-            if new_position['Fund Asset Class'] == 'CURRENCY':
-                is_cash = True
-            else:
-                is_cash = False
-
-            Position.objects.create(
-                account_number=portfolio_link,
-                isin=fund_link,
-                value=float(
-                    new_position['Base Market Value'].replace(',', '')),
-                shares=float(
-                    new_position['Shares/Par Value'].replace(",", '')),
-                price=new_position['Base Price Amount'],
-                valuation_date=new_position['Period End Date'],
-                flag_cash=is_cash)
+        f = io.TextIOWrapper(self.clean_data_file().file,
+                             encoding='utf-8-sig')
+        return ingest_bbg_data(f)
+
+
+class UploadCalendarDatesForm(forms.Form):
+
+    # Fields
+    file = forms.FileField(
+        help_text='CSV with code and date columns (and optionally name)')
+    create_calendars = forms.BooleanField(
+        required=False, initial=True,
+        label='Create calendars missing from the system')
+
+    # Methods
+    def clean_data_file(self):
+        f = self.cleaned_data['file']
+        if f:
+            ext = f.name.split('.')[-1]
+            if ext != 'csv':
+                raise forms.ValidationError('File type not supported')
+        return f
+
+    def processs_data(self):
+        f = io.TextIOWrapper(self.clean_data_file().file,
+                             encoding='utf-8-sig')
+        return ingest_calendar_dates(
+            f, create_calendars=self.cleaned_data['create_calendars'])
+
+
+class ExportForm(forms.Form):
+    """
+    Dataset, format and filters of a data export (GET parameters)
+    """
+
+    # Fields (inputs)
+    dataset = forms.ChoiceField(choices=(
+        ('positions', 'Positions'),
+        ('trades', 'Trades'),
+        ('bbg', 'Bloomberg data'),
+    ))
+    format = forms.ChoiceField(choices=(
+        ('csv', 'CSV'),
+        ('parquet', 'Parquet'),
+    ), initial='csv', required=False)
+    date_from = forms.DateField(
+        required=False,
+        widget=forms.widgets.DateInput(attrs={'type': 'date'}))
+    date_to = forms.DateField(
+        required=False,
+        widget=forms.widgets.DateInput(attrs={'type': 'date'}))
+    account = forms.CharField(required=False,
+                              help_text='Not available for Bloomberg data')
+    isin = forms.CharField(required=False)
+
+    # Methods
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get('date_from')
+        date_to = cleaned_data.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            raise ValidationError('The start date is after the end date')
+        return cleaned_data
+
+    def export(self):
+        """
+        (chunks generator, content type, file name) of the export, raises
+        ValueError when it cannot be produced
+        """
+        data = self.cleaned_data
+        return export(data['dataset'], data['format'] or 'csv',
+                      date_from=data['date_from'], date_to=data['date_to'],
+                      account=data['account'].strip(),
+                      isin=data['isin'].strip())
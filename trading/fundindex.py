@@ -0,0 +1,93 @@
+"""
+Index ISIN -> fund resolution index.
+
+The fields needed to resolve target index ISINs to funds (ISIN, index ISIN,
+status, terms_rank) of every fund are loaded with a single query into arrays
+sorted by index ISIN, so the candidates of a set of index ISINs are found
+by binary search instead of a Fund query per calculation.
+
+The index is kept per process and rebuilt when the FUNDS cache version
+changes (fund uploads and Fund saves/deletes bump it).
+"""
+import numpy as np
+
+from .cache import FUNDS, get_versions
+from .models import Fund
+
+
+class FundIndex:
+    """
+    Resolution fields of every fund as parallel arrays sorted by index ISIN
+    """
+
+    def __init__(self, isins, index_isins, inactive, ranks, version=None):
+        order = np.argsort(index_isins, kind='stable')
+        self.isins = isins[order]
+        self.index_isins = index_isins[order]
+        self.inactive = inactive[order]
+        self.ranks = ranks[order]
+        self.version = version
+
+    @classmethod
+    def from_db(cls, version=None):
+        funds = list(Fund.objects.values_list(
+            'isin', 'index_isin', 'status', 'terms_rank'))
+        if not funds:
+            return cls(np.array([], dtype=str), np.array([], dtype=str),
+                       np.zeros(0, dtype=bool), np.zeros(0, dtype=int),
+                       version)
+
+        isins, index_isins, statuses, ranks = zip(*funds)
+        return cls(np.array(isins, dtype=str),
+                   np.array(index_isins, dtype=str),
+                   np.array(statuses, dtype=object) != 'Active',
+                   np.array(ranks, dtype=int), version)
+
+    # Methods
+    def _ranges(self, index_isins):
+        index_isins = np.asarray(index_isins, dtype=str)
+        return (np.searchsorted(self.index_isins, index_isins, 'left'),
+                np.searchsorted(self.index_isins, index_isins, 'right'))
+
+    def candidates(self, index_isins):
+        """
+        (isins, index_isins, inactive, ranks) arrays of the funds tracking
+        any of `index_isins`
+        """
+        starts, ends = self._ranges(index_isins)
+        rows = np.concatenate([np.arange(0)] + [
+            np.arange(start, end)
+            for start, end in zip(starts.tolist(), ends.tolist())])
+        return (self.isins[rows], self.index_isins[rows],
+                self.inactive[rows], self.ranks[rows])
+
+    def missing(self, index_isins):
+        """
+        Index ISINs of `index_isins` that no Active fund tracks
+        """
+        index_isins = np.asarray(index_isins, dtype=str)
+        active = self.index_isins[~self.inactive]
+        return index_isins[np.searchsorted(active, index_isins, 'left') ==
+                           np.searchsorted(active, index_isins, 'right')]
+
+
+_fund_index = None
+
+
+def get_fund_index():
+    """
+    Process wide FundIndex, rebuilt when the fund master has changed
+    """
+    global _fund_index
+    version, = get_versions([FUNDS])
+    if _fund_index is None or _fund_index.version != version:
+        _fund_index = FundIndex.from_db(version)
+    return _fund_index
+
+
+def clear_fund_index():
+    """
+    Drop the cached FundIndex
+    """
+    global _fund_index
+    _fund_index = None
@@ -0,0 +1,571 @@
+"""
+Streaming bulk loaders for the files uploaded through the trading forms
+"""
+import csv
+import itertools
+import logging
+import time
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+
+from .aggregates import PositionDeltas
+from .bbgstore import refresh_bbg_store
+from .cache import CALENDARS, FUNDS, POSITIONS, bump_on_commit
+from .calendars import clear_calendar_cache
+from .drift import mark_dirty, mark_funds_dirty
+from .models import BBGData, Calendar, CalendarDate, Fund, Portfolio, Position
+
+
+logger = logging.getLogger(__name__)
+
+# Number of csv lines parsed and written per round trip
+CHUNK_SIZE = 5000
+
+# Number of rejected lines kept (with reason) for the summary
+MAX_REJECTS_KEPT = 100
+
+# Ids per DELETE statement (keeps under the sqlite parameter limit)
+DELETE_BATCH_SIZE = 500
+
+# Reload modes of a position file. A partition is all the positions of one
+# account on one valuation date; 'replace' swaps every partition found in
+# the file, 'diff' only writes the rows that changed.
+APPEND = 'append'
+REPLACE = 'replace'
+DIFF = 'diff'
+LOAD_MODES = (
+    (REPLACE, 'Replace the uploaded dates'),
+    (DIFF, 'Replace the uploaded dates (changed rows only)'),
+    (APPEND, 'Append'),
+)
+
+
+class IngestResult:
+    """
+    Running summary of a file load: counts, throughput and rejected lines
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.rejected = 0
+        self.rejects = []
+        self.elapsed = 0.0
+        self._started = time.perf_counter()
+
+    # Methods
+    def reject(self, line_number, reason):
+        self.rejected += 1
+        if len(self.rejects) < MAX_REJECTS_KEPT:
+            self.rejects.append((line_number, reason))
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self._started
+        logger.info(self.summary())
+        return self
+
+    @property
+    def rows_per_sec(self):
+        if not self.elapsed:
+            return 0.0
+        return self.rows / self.elapsed
+
+    def summary(self):
+        counts = ["%d rows read" % self.rows, "%d inserted" % self.inserted]
+        for name in ('updated', 'unchanged', 'deleted'):
+            if getattr(self, name):
+                counts.append("%d %s" % (getattr(self, name), name))
+        counts.append("%d rejected" % self.rejected)
+        return "%s: %s in %.2fs (%.0f rows/sec)" % (
+            self.name, ", ".join(counts), self.elapsed, self.rows_per_sec)
+
+    def __str__(self):
+        return self.summary()
+
+
+def read_chunks(f, size=CHUNK_SIZE):
+    """
+    Stream a csv file as lists of (line_number, row dict), `size` at a time
+    """
+    reader = csv.DictReader(f)
+    # Line 1 is the header, so data starts on line 2
+    numbered = enumerate(reader, start=2)
+    while True:
+        chunk = list(itertools.islice(numbered, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def to_float(value):
+    """
+    Convert a custodian formatted number (e.g. '1,000.50') to float
+    """
+    return float(str(value).replace(',', '').strip())
+
+
+def to_date(value):
+    date = parse_date(str(value).strip())
+    if date is None:
+        raise ValueError("invalid date '%s'" % value)
+    return date
+
+
+def parse_position(row, fund_isins, account_numbers):
+    """
+    Convert one custodian file line into an (unsaved) Position.
+
+    Raises ValueError with the reason when the line cannot be loaded.
+    """
+    # Short lines have None for their missing fields
+    isin = (row.get('ISIN Number') or '').strip()
+    if isin not in fund_isins:
+        raise ValueError("unknown ISIN '%s'" % isin)
+
+    account = (row.get('Fund') or '').strip()
+    if account not in account_numbers:
+        raise ValueError("unknown account '%s'" % account)
+
+    try:
+        return Position(
+            account_number_id=account,
+            isin_id=isin,
+            value=to_float(row['Base Market Value']),
+            shares=to_float(row['Shares/Par Value']),
+            price=to_float(row['Base Price Amount']),
+            valuation_date=to_date(row['Period End Date']),
+            flag_cash=row.get('Fund Asset Class') == 'CURRENCY')
+    except KeyError as e:
+        raise ValueError("missing column %s" % e)
+
+
+# Fund master columns, by model field name
+FUND_COLUMNS = (
+    'isin', 'index_isin', 'name', 'firm', 'style', 'strategy',
+    'flag_restricted', 'flag_late_cutoff', 'flag_units_trading',
+    'terms_rank', 'terms_rank_amount', 'terms_sub_notice',
+    'terms_sub_settlement', 'terms_sub_minimum', 'terms_red_notice',
+    'terms_red_settlement', 'terms_cutoff_time', 'terms_calendars',
+    'terms_man_fee', 'terms_perf_fee',
+)
+
+# Columns only loaded when the file has them (model default otherwise)
+OPTIONAL_FUND_COLUMNS = ('status', 'terms_currency')
+
+
+def parse_fund(row, fields):
+    """
+    Convert one fund master line into a dict of values of the Fund `fields`.
+
+    Raises ValueError with the reason when the line cannot be loaded.
+    """
+    values = {}
+    for field in fields:
+        name = field.name
+        try:
+            value = row[name].strip()
+        except KeyError:
+            raise ValueError("missing column '%s'" % name)
+        except AttributeError:
+            raise ValueError("missing value for '%s'" % name)
+        if not value and not field.blank:
+            raise ValueError("missing value for '%s'" % name)
+        try:
+            # Also checks choices and max_length
+            values[name] = field.clean(value, None)
+        except ValidationError as e:
+            raise ValueError("invalid %s '%s': %s" % (name, value,
+                                                      ' '.join(e.messages)))
+    return values
+
+
+def terms_hash(values):
+    """
+    Hash of a fund's column values (python values, so e.g. 0.02 and 0.020
+    hash the same)
+    """
+    return hash(tuple(values))
+
+
+def update_rows(model, objs, columns):
+    """
+    Write `columns` of the changed `objs` with a single executemany
+    UPDATE (bulk_update's CASE expressions get slow for many/wide rows)
+    """
+    if not objs:
+        return
+    fields = [model._meta.get_field(name) for name in columns]
+    quote = connection.ops.quote_name
+    sql = "UPDATE %s SET %s WHERE %s = %%s" % (
+        quote(model._meta.db_table),
+        ", ".join("%s = %%s" % quote(field.column) for field in fields),
+        quote(model._meta.pk.column))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [
+            [field.get_db_prep_save(getattr(obj, field.attname), connection)
+             for field in fields] + [obj.pk]
+            for obj in objs])
+
+
+def ingest_funds(f, chunk_size=CHUNK_SIZE):
+    """
+    Insert or update the Fund master from a vendor file.
+
+    The stored funds are hashed once (over the columns in the file); each
+    line's hash tells whether its fund is new, changed or unchanged, and new
+    and changed funds are written with one bulk insert and one bulk update
+    per chunk. Counts are returned in an IngestResult.
+    """
+    result = IngestResult('Funds')
+    columns = fields = stored = None
+    # isin -> index_isin of the funds inserted or updated
+    written = {}
+
+    with transaction.atomic():
+        for chunk in read_chunks(f, chunk_size):
+            if columns is None:
+                header = chunk[0][1]
+                columns = FUND_COLUMNS + tuple(
+                    name for name in OPTIONAL_FUND_COLUMNS if name in header)
+                fields = [Fund._meta.get_field(name) for name in columns]
+                stored = {row[0]: terms_hash(row)
+                          for row in Fund.objects.values_list(*columns)}
+
+            created, changed = {}, {}
+            for line_number, row in chunk:
+                result.rows += 1
+                try:
+                    values = parse_fund(row, fields)
+                except ValueError as e:
+                    result.reject(line_number, str(e))
+                    continue
+
+                # A fund repeated in the file: the last line wins
+                isin = values['isin']
+                digest = terms_hash(values.values())
+                if isin in created or isin not in stored:
+                    created[isin] = Fund(**values)
+                elif digest != stored[isin]:
+                    changed[isin] = Fund(**values)
+                else:
+                    result.unchanged += 1
+                    continue
+                stored[isin] = digest
+
+            written.update((isin, fund.index_isin) for isin, fund in
+                           itertools.chain(created.items(), changed.items()))
+            Fund.objects.bulk_create(created.values())
+            update_rows(Fund, list(changed.values()), columns[1:])
+            result.inserted += len(created)
+            result.updated += len(changed)
+            logger.debug("%s: %d rows loaded", result.name, result.rows)
+
+        # Portfolios holding or targeting the funds need a new drift
+        mark_funds_dirty(written, written.values())
+        bump_on_commit(FUNDS)
+
+    return result.finish()
+
+
+def partition_key(position):
+    return position.account_number_id, position.valuation_date
+
+
+def row_key(position):
+    return (position.account_number_id, position.valuation_date,
+            position.isin_id, position.flag_cash)
+
+
+def partitions(keys):
+    """
+    Positions of the (account_number, valuation_date) partitions in `keys`
+    (one condition per date, read through the composite index)
+    """
+    accounts_by_date = {}
+    for account, date in keys:
+        accounts_by_date.setdefault(date, set()).add(account)
+    condition = Q()
+    for date, accounts in accounts_by_date.items():
+        condition |= Q(valuation_date=date, account_number__in=accounts)
+    return Position.objects.filter(condition)
+
+
+def delete_positions(positions):
+    ids = [p.id for p in positions]
+    for i in range(0, len(ids), DELETE_BATCH_SIZE):
+        Position.objects.filter(id__in=ids[i:i + DELETE_BATCH_SIZE]).delete()
+
+
+def diff_positions(positions, stored, aggregates, result):
+    """
+    Match file positions with the stored rows of their partition: changed
+    rows are updated in place, unchanged ones skipped. Returns the
+    positions that have no stored row and need inserting.
+    """
+    new, changed = [], []
+    for position in positions:
+        rows = stored.get(row_key(position))
+        if not rows:
+            new.append(position)
+            continue
+
+        old = rows.pop()
+        if (old.value, old.shares, old.price) == (
+                position.value, position.shares, position.price):
+            result.unchanged += 1
+            continue
+
+        aggregates.add([old], sign=-1)
+        old.value, old.shares, old.price = (position.value, position.shares,
+                                            position.price)
+        aggregates.add([old])
+        changed.append(old)
+
+    Position.objects.bulk_update(changed, ['value', 'shares', 'price'])
+    result.updated += len(changed)
+    return new
+
+
+def ingest_positions(f, chunk_size=CHUNK_SIZE, mode=APPEND):
+    """
+    Load a daily custodian position file with batched inserts.
+
+    Funds and portfolios are resolved once into in-memory lookup sets, the
+    file is parsed `chunk_size` lines at a time and the whole load runs in a
+    single transaction. Lines that cannot be loaded are skipped and reported
+    in the returned IngestResult. The PortfolioValuation and FundHolding
+    aggregates are updated incrementally with the written rows.
+
+    With mode REPLACE every (account, valuation_date) partition in the file
+    is bulk deleted the first time it is seen, so reloading a corrected file
+    leaves no duplicates. DIFF compares the file with the stored partitions
+    and only inserts, updates and deletes the rows that changed.
+    """
+    if mode not in dict(LOAD_MODES):
+        raise ValueError("unknown load mode '%s'" % mode)
+    result = IngestResult('Positions')
+
+    fund_isins = set(Fund.objects.values_list('isin', flat=True))
+    account_numbers = set(
+        Portfolio.objects.values_list('account_number', flat=True))
+    aggregates = PositionDeltas()
+
+    # Partitions already seen and, in DIFF mode, their stored rows not yet
+    # matched by a file line (row key -> positions)
+    seen = set()
+    stored = {}
+
+    with transaction.atomic():
+        for chunk in read_chunks(f, chunk_size):
+            positions = []
+            for line_number, row in chunk:
+                result.rows += 1
+                try:
+                    positions.append(
+                        parse_position(row, fund_isins, account_numbers))
+                except ValueError as e:
+                    result.reject(line_number, str(e))
+
+            new_keys = {partition_key(p) for p in positions} - seen
+            if mode != APPEND and new_keys:
+                seen |= new_keys
+                if mode == REPLACE:
+                    old = list(partitions(new_keys))
+                    aggregates.add(old, sign=-1)
+                    partitions(new_keys).delete()
+                    result.deleted += len(old)
+                else:
+                    for old in partitions(new_keys):
+                        stored.setdefault(row_key(old), []).append(old)
+
+            if mode == DIFF:
+                positions = diff_positions(positions, stored, aggregates,
+                                           result)
+
+            Position.objects.bulk_create(positions)
+            aggregates.add(positions)
+            result.inserted += len(positions)
+            logger.debug("%s: %d rows loaded", result.name, result.rows)
+
+        # Stored rows no longer in the file
+        removed = [p for rows in stored.values() for p in rows]
+        aggregates.add(removed, sign=-1)
+        delete_positions(removed)
+        result.deleted += len(removed)
+
+        aggregates.apply()
+        mark_dirty(aggregates.accounts.changed())
+        bump_on_commit(POSITIONS)
+
+    return result.finish()
+
+
+def parse_bbg_data(row, fund_isins):
+    """
+    Convert one BBG file line into (isin, date, assets, shares_issued).
+
+    Raises ValueError with the reason when the line cannot be loaded.
+    """
+    isin = (row.get('isin') or '').strip()
+    if isin not in fund_isins:
+        raise ValueError("unknown ISIN '%s'" % isin)
+    try:
+        return (isin, to_date(row['date']), to_float(row['assets']),
+                to_float(row['shares_issued']))
+    except KeyError as e:
+        raise ValueError("missing column %s" % e)
+
+
+def ingest_bbg_data(f, chunk_size=CHUNK_SIZE):
+    """
+    Load a BBG file (isin, date, assets, shares_issued) into BBGData.
+
+    ISINs are checked against a preloaded set of funds and the stored rows
+    of each date are read once, so an (isin, date) is never duplicated: a
+    line for a stored row updates it when the values changed, and the last
+    of repeated lines wins. The BBG store is refreshed once the load
+    commits.
+    """
+    result = IngestResult('BBG data')
+    fund_isins = set(Fund.objects.values_list('isin', flat=True))
+
+    # (isin, date) -> [id, assets, shares_issued] of the rows stored for the
+    # dates seen so far (id None for rows inserted by this load)
+    stored = {}
+    dates_read = set()
+    # Funds with new or changed prices
+    priced = set()
+
+    with transaction.atomic():
+        for chunk in read_chunks(f, chunk_size):
+            lines = {}
+            for line_number, row in chunk:
+                result.rows += 1
+                try:
+                    isin, date, assets, shares = parse_bbg_data(row,
+                                                                fund_isins)
+                except ValueError as e:
+                    result.reject(line_number, str(e))
+                    continue
+                lines[(isin, date)] = [assets, shares]
+
+            new_dates = {date for _, date in lines} - dates_read
+            if new_dates:
+                dates_read |= new_dates
+                for pk, isin, date, assets, shares in BBGData.objects.filter(
+                        date__in=new_dates).values_list(
+                            'id', 'isin', 'date', 'assets', 'shares_issued'):
+                    stored[(isin, date)] = [pk, assets, shares]
+
+            created, changed = [], []
+            for (isin, date), values in lines.items():
+                row = stored.get((isin, date))
+                if row is None:
+                    created.append(BBGData(isin_id=isin, date=date,
+                                           assets=values[0],
+                                           shares_issued=values[1]))
+                    stored[(isin, date)] = [None] + values
+                    priced.add(isin)
+                    continue
+                if row[1:] == values:
+                    result.unchanged += 1
+                    continue
+
+                row[1:] = values
+                priced.add(isin)
+                if row[0] is None:
+                    # Inserted from an earlier chunk of this file
+                    BBGData.objects.filter(isin=isin, date=date).update(
+                        assets=values[0], shares_issued=values[1])
+                else:
+                    changed.append(BBGData(id=row[0], assets=values[0],
+                                           shares_issued=values[1]))
+                result.updated += 1
+
+            BBGData.objects.bulk_create(created)
+            update_rows(BBGData, changed, ['assets', 'shares_issued'])
+            result.inserted += len(created)
+            logger.debug("%s: %d rows loaded", result.name, result.rows)
+
+        mark_funds_dirty(priced)
+
+        # Updated rows keep their ids, so the store needs a full rebuild
+        full = result.updated > 0
+        transaction.on_commit(lambda: refresh_bbg_store(full=full))
+
+    return result.finish()
+
+
+def parse_calendar_date(row):
+    """
+    Convert one holiday file line into (calendar code, date).
+
+    Raises ValueError with the reason when the line cannot be loaded.
+    """
+    code = (row.get('code') or '').strip().upper()
+    if not code:
+        raise ValueError("missing calendar code")
+    try:
+        return code, to_date(row['date'])
+    except KeyError as e:
+        raise ValueError("missing column %s" % e)
+
+
+def ingest_calendar_dates(f, chunk_size=CHUNK_SIZE, create_calendars=False):
+    """
+    Load a holiday file (code, date) into CalendarDate.
+
+    Calendar codes are resolved through a preloaded map (unknown codes are
+    created when `create_calendars`, with the file's name column if any) and
+    the stored holidays are read once, so holidays already loaded or
+    repeated in the file are skipped. The calendar cache is cleared once
+    the load commits.
+    """
+    result = IngestResult('Holidays')
+    calendars = {}
+    for pk, code in Calendar.objects.order_by('id').values_list('id', 'code'):
+        calendars.setdefault(code.strip().upper(), pk)
+    stored = set(CalendarDate.objects.filter(
+        code__isnull=False).values_list('code_id', 'date'))
+
+    with transaction.atomic():
+        for chunk in read_chunks(f, chunk_size):
+            created = []
+            for line_number, row in chunk:
+                result.rows += 1
+                try:
+                    code, date = parse_calendar_date(row)
+                except ValueError as e:
+                    result.reject(line_number, str(e))
+                    continue
+
+                if code not in calendars:
+                    if not create_calendars:
+                        result.reject(line_number,
+                                      "unknown calendar '%s'" % code)
+                        continue
+                    calendars[code] = Calendar.objects.create(
+                        code=code, name=(row.get('name') or code).strip()).pk
+
+                key = (calendars[code], date)
+                if key in stored:
+                    result.unchanged += 1
+                    continue
+                stored.add(key)
+                created.append(CalendarDate(code_id=key[0], date=key[1]))
+
+            CalendarDate.objects.bulk_create(created)
+            result.inserted += len(created)
+            logger.debug("%s: %d rows loaded", result.name, result.rows)
+
+        transaction.on_commit(clear_calendar_cache)
+        bump_on_commit(CALENDARS)
+
+    return result.finish()
@@ -0,0 +1,250 @@
+"""
+Per-request instrumentation: SQL query count, database time, template
+render time and wall time of every view, with budgets.
+
+RequestStatsMiddleware measures each request with a Collector and keeps the
+latest requests of every view (in process memory) for the percentiles of
+the stats page. A request over its budget (settings.TRADING_REQUEST_BUDGETS)
+is logged as a warning. assert_budget() applies the same budgets to any
+block of code, e.g. in the benchmark suite.
+
+Template render time is measured by TimedDjangoTemplates, the template
+backend (see settings.TEMPLATES). Queries run lazily while rendering count
+towards both the database and the render time.
+"""
+import collections
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.db import connections
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template
+from django.template.backends.django import reraise
+
+
+logger = logging.getLogger(__name__)
+
+# Budget keys: query count and milliseconds
+BUDGET_KEYS = ('queries', 'db_ms', 'render_ms', 'wall_ms')
+
+DEFAULT_WINDOW = 500
+
+_local = threading.local()
+
+
+def active_collectors():
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    return _local.collectors
+
+
+class Collector:
+    """
+    Queries, database time and template render time of the code run
+    within it (in this thread), and its wall time
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.wall_seconds = 0.0
+        self._stack = None
+        self._started = None
+
+    # Methods
+    def __call__(self, execute, sql, params, many, context):
+        # Database execute wrapper
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - started
+            self.queries += 1
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        for connection in connections.all():
+            self._stack.enter_context(connection.execute_wrapper(self))
+        active_collectors().append(self)
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_seconds = time.perf_counter() - self._started
+        active_collectors().remove(self)
+        self._stack.close()
+
+    def as_dict(self):
+        return {
+            'queries': self.queries,
+            'db_ms': 1000 * self.db_seconds,
+            'render_ms': 1000 * self.render_seconds,
+            'wall_ms': 1000 * self.wall_seconds,
+        }
+
+
+class TimedTemplate(Template):
+
+    def render(self, context=None, request=None):
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            elapsed = time.perf_counter() - started
+            for collector in active_collectors():
+                collector.render_seconds += elapsed
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    Django template backend adding the render time of its templates to the
+    active Collectors
+    """
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name),
+                                 self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+def get_budget(view_name=None):
+    """
+    Budget of a view: its entry of TRADING_REQUEST_BUDGETS over 'default'
+    """
+    budgets = getattr(settings, 'TRADING_REQUEST_BUDGETS', {})
+    budget = dict(budgets.get('default', {}))
+    if view_name:
+        budget.update(budgets.get(view_name, {}))
+    return {key: value for key, value in budget.items()
+            if value is not None}
+
+
+def over_budget(measured, budget):
+    """
+    Messages for every measurement (Collector.as_dict) above the budget
+    """
+    return ['%s %.0f > %s' % (key, measured[key], budget[key])
+            for key in BUDGET_KEYS
+            if key in budget and measured[key] > budget[key]]
+
+
+class BudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def assert_budget(view_name=None, **budget):
+    """
+    Raise BudgetExceeded when the block runs over the budget: the keyword
+    arguments (queries, db_ms, render_ms, wall_ms), over the settings
+    budget of `view_name` when given.
+
+        with assert_budget(queries=10, wall_ms=200):
+            client.get(url)
+    """
+    limits = get_budget(view_name) if view_name else {}
+    limits.update(budget)
+    with Collector() as collector:
+        yield collector
+    exceeded = over_budget(collector.as_dict(), limits)
+    if exceeded:
+        raise BudgetExceeded('%s over budget: %s' % (
+            view_name or 'code', ', '.join(exceeded)))
+
+
+class RequestStats:
+    """
+    The latest `window` measurements of each view
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self.views = {}
+        self.over_budget = collections.Counter()
+        self._lock = threading.Lock()
+
+    # Methods
+    def add(self, view_name, measured, exceeded=False):
+        with self._lock:
+            if view_name not in self.views:
+                self.views[view_name] = collections.deque(maxlen=self.window)
+            self.views[view_name].append(
+                [measured[key] for key in BUDGET_KEYS])
+            if exceeded:
+                self.over_budget[view_name] += 1
+
+    def clear(self):
+        with self._lock:
+            self.views.clear()
+            self.over_budget.clear()
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """
+        Per view: request count, requests over budget, the budget and the
+        percentiles (and max) of every measurement, slowest views first
+        """
+        with self._lock:
+            views = {name: np.array(rows) for name, rows in
+                     self.views.items()}
+            over = dict(self.over_budget)
+        names = ['p%d' % p for p in percentiles] + ['max']
+        rows = []
+        for name, values in views.items():
+            points = np.vstack([np.percentile(values, percentiles, axis=0),
+                                values.max(axis=0)])
+            rows.append({
+                'view': name,
+                'requests': len(values),
+                'over_budget': over.get(name, 0),
+                'budget': get_budget(name),
+                'stats': {key: dict(zip(names, points[:, i].tolist()))
+                          for i, key in enumerate(BUDGET_KEYS)},
+            })
+        rows.sort(key=lambda row: row['stats']['wall_ms']['p95'],
+                  reverse=True)
+        return rows
+
+
+request_stats = RequestStats(
+    getattr(settings, 'TRADING_REQUEST_STATS_WINDOW', DEFAULT_WINDOW))
+
+
+class RequestStatsMiddleware:
+    """
+    Measure every request routed to a view, add a Server-Timing header and
+    warn when the view is over budget
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with Collector() as collector:
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return response
+        view_name = match.view_name
+        measured = collector.as_dict()
+        exceeded = over_budget(measured, get_budget(view_name))
+        if exceeded:
+            logger.warning('%s %s over budget: %s', view_name,
+                           request.path, ', '.join(exceeded))
+        request_stats.add(view_name, measured, bool(exceeded))
+
+        response['Server-Timing'] = ', '.join(
+            '%s;dur=%.1f' % (name, measured[key]) for name, key in (
+                ('db', 'db_ms'), ('render', 'render_ms'),
+                ('total', 'wall_ms')))
+        return response
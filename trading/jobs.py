@@ -0,0 +1,259 @@
+"""
+Background job execution for trade calculations.
+
+Jobs are recorded in TradeJob and executed in a local process pool (no
+external broker). Each job kind maps to a function taking the TradeJob and
+returning a JSON serialisable result summary; the trades themselves are
+written to TradeItem under the job (run) id.
+"""
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import worker
+from .cache import CALENDARS, FUNDS, adopt_versions, get_versions
+from .compliance import breach_codes, check_scenarios, check_trades
+from .models import Portfolio, Position, TargetModel, TradeItem, TradeJob
+from .trading import (
+    calculate_batch_trades, calculate_scenarios, calculate_trades)
+
+
+logger = logging.getLogger(__name__)
+
+# Smaller batches are calculated inline: starting the pool costs more
+MIN_PARALLEL_PORTFOLIOS = 50
+
+# Cache versions handed to the workers with each job (see adopt_versions)
+JOB_CACHE_VERSIONS = (CALENDARS, FUNDS)
+
+_executor = None
+
+
+def make_pool(workers=None):
+    """
+    New process pool whose workers have Django set up.
+
+    Workers are spawned rather than forked so they never inherit open
+    database connections.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=worker.init)
+
+
+def get_executor():
+    """
+    Process pool shared by the jobs of this (web) process
+    """
+    global _executor
+    if _executor is None:
+        _executor = make_pool(getattr(settings, 'TRADING_JOB_WORKERS', None))
+    return _executor
+
+
+def dispatch(job_id):
+    """
+    Hand a job to the pool, replacing the pool if a worker died
+    """
+    global _executor
+    try:
+        return get_executor().submit(worker.run, job_id)
+    except BrokenProcessPool:
+        logger.warning('Job pool broken, starting a new one')
+        _executor = None
+        return get_executor().submit(worker.run, job_id)
+
+
+def save_trades(job, trades):
+    """
+    Check generated trade dicts for compliance breaches and write them to
+    TradeItem (batched) under the job's run
+    """
+    flags = check_trades(
+        trades, datetime.date.fromisoformat(job.get_params()['trade_date']))
+
+    TradeItem.objects.bulk_create([
+        TradeItem(
+            run=job,
+            account_number_id=trade['account_number'],
+            isin_id=trade['isin'],
+            notice_date=trade['notice_date'],
+            trade_date=trade['trade_date'],
+            settlement_date=trade['settlement_date'],
+            traded_amount=trade['traded_amount'],
+            traded_shares=trade['traded_shares'],
+            trade_note=trade['trade_note'],
+            breach_flags=breach_flags,
+            breaches=breach_codes(breach_flags))
+        for trade, breach_flags in zip(trades, flags.tolist())])
+
+    return {
+        'trades': len(trades),
+        'subscriptions': sum(t['traded_amount'] for t in trades
+                             if t['traded_amount'] > 0),
+        'redemptions': sum(t['traded_amount'] for t in trades
+                           if t['traded_amount'] < 0),
+        'breaches': int((flags > 0).sum()),
+    }
+
+
+def job_weights(params):
+    """
+    TargetModel of a job
+    """
+    if 'model' not in params:
+        # Jobs queued with raw weights, whose unit is unknown
+        raise ValueError('Job has no target model, submit it again')
+    return TargetModel.objects.get(pk=params['model'])
+
+
+def run_trades(job):
+    """
+    Job kind 'trades': trades for a single portfolio
+    """
+    params = job.get_params()
+    portfolio = Portfolio.objects.get(pk=params['account'])
+    trade_date = datetime.date.fromisoformat(params['trade_date'])
+    trades = calculate_trades(
+        portfolio, Position.objects.as_of(trade_date, [portfolio]),
+        job_weights(params), params['trade_type'], params['net_flows'],
+        trade_date)
+    return save_trades(job, trades)
+
+
+def run_batch(job):
+    """
+    Job kind 'batch': trades for many portfolios against one set of weights,
+    with the per-portfolio calculation fanned out over a process pool
+    """
+    params = job.get_params()
+    accounts = params['accounts']
+    workers = min(getattr(settings, 'TRADING_BATCH_WORKERS', None) or
+                  os.cpu_count() or 1, len(accounts))
+    if len(accounts) < MIN_PARALLEL_PORTFOLIOS:
+        workers = 1
+    args = (accounts, job_weights(params), params['trade_type'],
+            {account: params['net_flows'] for account in accounts},
+            datetime.date.fromisoformat(params['trade_date']))
+
+    if workers > 1:
+        with make_pool(workers) as pool:
+            # A few chunks per worker evens out differently sized books
+            trades, results, timings = calculate_batch_trades(
+                *args, map_chunks=pool.map, chunks=workers * 4)
+    else:
+        trades, results, timings = calculate_batch_trades(*args)
+
+    started = time.perf_counter()
+    summary = save_trades(job, trades)
+    timings['workers'] = workers
+    timings['write_seconds'] = time.perf_counter() - started
+    summary.update({'portfolios': results, 'timings': timings})
+    return summary
+
+
+def run_scenarios(job):
+    """
+    Job kind 'scenario': trades of one portfolio for a grid of net flows.
+    Nothing is written to TradeItem; the scenarios x funds matrices of
+    traded amounts and breach flags are the job result.
+    """
+    params = job.get_params()
+    portfolio = Portfolio.objects.get(pk=params['account'])
+    trade_date = datetime.date.fromisoformat(params['trade_date'])
+
+    started = time.perf_counter()
+    grid = calculate_scenarios(
+        portfolio, Position.objects.as_of(trade_date, [portfolio]),
+        job_weights(params), params['trade_type'], params['flows'],
+        trade_date)
+    calculated = time.perf_counter()
+    flags = check_scenarios(portfolio.pk, grid, trade_date)
+    checked = time.perf_counter()
+
+    amounts = grid['amounts']
+    summary = np.column_stack([
+        grid['flows'],
+        np.where(amounts > 0, amounts, 0).sum(axis=1),
+        np.where(amounts < 0, amounts, 0).sum(axis=1),
+        (amounts != 0).sum(axis=1),
+        (flags > 0).sum(axis=1),
+    ])
+    return {
+        'flows': grid['flows'].tolist(),
+        'isins': grid['isins'].tolist(),
+        'amounts': amounts.round(2).tolist(),
+        'flags': flags.tolist(),
+        # flow, subscriptions, redemptions, trades, breaches per scenario
+        'summary': summary.round(2).tolist(),
+        'timings': {
+            'calculate_seconds': calculated - started,
+            'check_seconds': checked - calculated,
+        },
+    }
+
+
+JOB_KINDS = {
+    'trades': run_trades,
+    'batch': run_batch,
+    'scenario': run_scenarios,
+}
+
+
+def run_job(job_id):
+    """
+    Execute a queued job and record its status, timings and result
+    """
+    job = TradeJob.objects.get(pk=job_id)
+    adopt_versions(job.get_params().get('cache_versions', {}))
+    job.status = 'Running'
+    job.started_at = timezone.now()
+    job.save(update_fields=['status', 'started_at'])
+
+    try:
+        with transaction.atomic():
+            result = JOB_KINDS[job.kind](job)
+        job.result = json.dumps(result)
+        job.status = 'Done'
+    except Exception as e:
+        logger.exception('Job %s failed', job_id)
+        job.error = str(e) or e.__class__.__name__
+        job.status = 'Failed'
+    finally:
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'result', 'error', 'finished_at'])
+
+    return job_id
+
+
+def submit_job(kind, params):
+    """
+    Record a new job and hand it to the process pool once committed.
+
+    With settings.TRADING_JOBS_EAGER the job runs inline instead (tests,
+    benchmarks and single-process deployments).
+    """
+    if kind not in JOB_KINDS:
+        raise ValueError("Unknown job kind '%s'" % kind)
+
+    params = dict(params, cache_versions=dict(zip(
+        JOB_CACHE_VERSIONS, get_versions(JOB_CACHE_VERSIONS))))
+    job = TradeJob.objects.create(kind=kind, params=json.dumps(params))
+
+    if getattr(settings, 'TRADING_JOBS_EAGER', False):
+        run_job(job.pk)
+        job.refresh_from_db()
+    else:
+        transaction.on_commit(lambda: dispatch(job.pk))
+    return job
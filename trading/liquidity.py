@@ -0,0 +1,148 @@
+"""
+Redemption liquidity ladder: when the cash from redeeming every position
+would arrive, per portfolio and time bucket.
+
+Notice is given on the first business day after the valuation date, or the
+one after when it is placed later than the fund's cut-off time. The fund
+deals terms_red_notice business days later and pays terms_red_settlement
+business days after dealing, all on the fund's merged calendars
+(terms_calendars). Cash positions are available straight away.
+"""
+import datetime
+
+import numpy as np
+from django.db.models import Max
+
+from .cache import CALENDARS, FUNDS, POSITIONS, cached
+from .calendars import get_calendar_index
+from .models import Fund, PortfolioValuation, Position
+
+
+# (label, calendar days after the valuation date the cash arrives by); the
+# last bucket takes everything later
+BUCKETS = (
+    ('Cash', 0),
+    ('1 week', 7),
+    ('1 month', 31),
+    ('3 months', 92),
+    ('6 months', 183),
+    ('1 year', 366),
+    ('Over 1 year', None),
+)
+BUCKET_DAYS = np.array([days for _, days in BUCKETS[:-1]])
+
+
+class LiquidityLadder:
+    """
+    Value of each portfolio (`accounts`, sorted) redeemable in each bucket:
+    an accounts x BUCKETS matrix
+    """
+
+    def __init__(self, valuation_date, accounts, amounts):
+        self.valuation_date = valuation_date
+        self.accounts = accounts
+        self.amounts = amounts
+
+    # Methods
+    @property
+    def labels(self):
+        return [label for label, _ in BUCKETS]
+
+    @property
+    def totals(self):
+        return self.amounts.sum(axis=0).tolist()
+
+    @property
+    def nav(self):
+        return float(self.amounts.sum())
+
+    def rows(self):
+        """
+        Per portfolio dicts: account, nav and cells, the (amount, cumulative
+        percentage of the NAV available by then) of each bucket
+        """
+        navs = self.amounts.sum(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cumulative = np.where(
+                navs != 0, 100 * self.amounts.cumsum(axis=1) / navs, 0)
+        return [{'account': account, 'nav': nav,
+                 'cells': list(zip(amounts, pct))}
+                for account, nav, amounts, pct in zip(
+                    self.accounts.tolist(), navs[:, 0].tolist(),
+                    self.amounts.tolist(), cumulative.tolist())]
+
+
+def latest_valuation_date():
+    return PortfolioValuation.objects.aggregate(Max('valuation_date'))[
+        'valuation_date__max']
+
+
+def redemption_cash_dates(isins, valuation_date, notice_time=None):
+    """
+    Date the cash of a redemption of each fund in `isins` (sorted, unique)
+    arrives, for a notice placed after `valuation_date` (at `notice_time`,
+    before every cut-off when None)
+    """
+    terms = list(Fund.objects.filter(isin__in=list(isins)).order_by(
+        'isin').values_list('terms_calendars', 'terms_red_notice',
+                            'terms_red_settlement', 'terms_cutoff_time'))
+    if not terms:
+        return np.array([], dtype='datetime64[D]')
+
+    calendars, red_notice, red_settle, cutoff = (
+        np.array(column, dtype=object) for column in zip(*terms))
+    late = np.array([notice_time is not None and notice_time > time
+                     for time in cutoff.tolist()], dtype=int)
+
+    index = get_calendar_index()
+    first_day = valuation_date + datetime.timedelta(days=1)
+    notice = index.add_business_days(
+        calendars, np.full(len(terms), first_day), late)
+    dealing = index.add_business_days(calendars, notice,
+                                      red_notice.astype(int))
+    return index.add_business_days(calendars, dealing,
+                                   red_settle.astype(int))
+
+
+def build_ladder(valuation_date, notice_time=None):
+    """
+    LiquidityLadder of every portfolio's positions as of `valuation_date`
+    """
+    positions = list(Position.objects.as_of(valuation_date).exclude(
+        isin=None).values_list('account_number', 'isin', 'value',
+                               'flag_cash'))
+    if not positions:
+        return LiquidityLadder(valuation_date, np.array([], dtype=str),
+                               np.zeros((0, len(BUCKETS))))
+
+    accounts, isins, values, flag_cash = zip(*positions)
+    accounts, account_codes = np.unique(np.array(accounts, dtype=str),
+                                        return_inverse=True)
+    isins, fund_codes = np.unique(np.array(isins, dtype=str),
+                                  return_inverse=True)
+
+    # Dates are computed once per fund, then spread over the positions
+    cash_dates = redemption_cash_dates(isins, valuation_date, notice_time)
+    days = (cash_dates - np.datetime64(valuation_date, 'D')).astype(int)
+    days = np.where(np.array(flag_cash, dtype=bool), 0, days[fund_codes])
+    buckets = np.searchsorted(BUCKET_DAYS, days, side='left')
+
+    cells = len(accounts) * len(BUCKETS)
+    amounts = np.bincount(account_codes * len(BUCKETS) + buckets,
+                          np.array(values, dtype=float), cells)
+    return LiquidityLadder(valuation_date, accounts,
+                           amounts.reshape(len(accounts), len(BUCKETS)))
+
+
+def liquidity_ladder(valuation_date=None, notice_time=None):
+    """
+    Cached LiquidityLadder for `valuation_date` (default: latest), rebuilt
+    when funds, positions or calendars change
+    """
+    valuation_date = valuation_date or latest_valuation_date()
+    if valuation_date is None:
+        return None
+    name = 'liquidity-ladder:%s:%s' % (
+        valuation_date, notice_time.strftime('%H%M') if notice_time else '')
+    return cached(name, [FUNDS, POSITIONS, CALENDARS],
+                  lambda: build_ladder(valuation_date, notice_time))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from trading.models import BlockOrder
+from trading.orders import build_block_orders
+from .export_data import date_argument
+
+
+class Command(BaseCommand):
+    help = 'Net the trades of a dealing date into block orders per fund ' \
+           'and currency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('trade_date', type=date_argument,
+                            help='dealing date (YYYY-MM-DD)')
+        parser.add_argument('--run', type=int, action='append', dest='runs',
+                            help='only rebuild the blocks of the funds the '
+                                 'portfolios of this job trade (repeatable)')
+
+    def handle(self, *args, **options):
+        orders = build_block_orders(options['trade_date'], options['runs'])
+        held = BlockOrder.objects.filter(
+            trade_date=options['trade_date'], status='Below minimum').count()
+        self.stdout.write('%d block orders (%d below minimum)' % (
+            orders, held))
@@ -0,0 +1,55 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from trading.export import DATASETS, FORMATS, export
+
+
+def date_argument(value):
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(value)
+    return date
+
+
+class Command(BaseCommand):
+    help = 'Stream positions, trades or Bloomberg data to a CSV or Parquet ' \
+           'file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(DATASETS))
+        parser.add_argument('--format', choices=sorted(FORMATS),
+                            default='csv')
+        parser.add_argument('--from', dest='date_from', type=date_argument,
+                            help='first date (YYYY-MM-DD)')
+        parser.add_argument('--to', dest='date_to', type=date_argument,
+                            help='last date (YYYY-MM-DD)')
+        parser.add_argument('--account')
+        parser.add_argument('--isin')
+        parser.add_argument('--output', '-o',
+                            help='output file (default: standard output)')
+
+    def handle(self, *args, **options):
+        try:
+            chunks, _, _ = export(
+                options['dataset'], options['format'],
+                date_from=options['date_from'], date_to=options['date_to'],
+                account=options['account'], isin=options['isin'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        binary = options['format'] == 'parquet'
+        if options['output']:
+            out = open(options['output'], 'wb' if binary else 'w',
+                       newline=None if binary else '')
+        elif binary:
+            out = sys.stdout.buffer
+        else:
+            out = sys.stdout
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if options['output']:
+                out.close()
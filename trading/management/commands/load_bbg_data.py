@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from trading.ingest import ingest_bbg_data
+
+
+class Command(BaseCommand):
+    help = 'Load a BBG csv file (isin, date, assets, shares_issued)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+
+    def handle(self, *args, **options):
+        with open(options['file'], encoding='utf-8-sig', newline='') as f:
+            result = ingest_bbg_data(f)
+        for line_number, reason in result.rejects:
+            self.stderr.write('Line %d rejected: %s' % (line_number, reason))
+        self.stdout.write(result.summary())
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from trading.ingest import ingest_calendar_dates
+
+
+class Command(BaseCommand):
+    help = 'Load a calendar holidays csv file (code, date and optional name)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument('--create-calendars', action='store_true',
+                            help='create the calendars not in the system')
+
+    def handle(self, *args, **options):
+        with open(options['file'], encoding='utf-8-sig', newline='') as f:
+            result = ingest_calendar_dates(
+                f, create_calendars=options['create_calendars'])
+        for line_number, reason in result.rejects:
+            self.stderr.write('Line %d rejected: %s' % (line_number, reason))
+        self.stdout.write(result.summary())
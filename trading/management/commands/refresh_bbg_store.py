@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from trading.bbgstore import refresh_bbg_store
+
+
+class Command(BaseCommand):
+    help = 'Add the new BBGData rows to the memory-mapped BBG store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='rebuild the store from all BBGData rows')
+
+    def handle(self, *args, **options):
+        store = refresh_bbg_store(full=options['full'])
+        self.stdout.write('BBG store %s: %d rows, %d ISINs, last id %d' % (
+            store.version, store.rows, len(store.isins), store.last_id))
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from trading.drift import refresh_drift
+from trading.models import PortfolioDrift
+
+
+class Command(BaseCommand):
+    help = 'Recompute the drift and rebalance trades of the portfolios ' \
+           'changed since the last refresh'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        refreshed = refresh_drift()
+        outside = PortfolioDrift.objects.filter(
+            outside_tolerance=True).count()
+        self.stdout.write('%d portfolios refreshed in %.2fs, %d outside '
+                          'tolerance' % (refreshed,
+                                         time.perf_counter() - started,
+                                         outside))
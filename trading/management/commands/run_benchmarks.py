@@ -0,0 +1,104 @@
+import datetime
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (
+    override_settings, setup_test_environment, teardown_test_environment)
+
+from trading.benchmarks import run_benchmarks
+from trading.synthetic import SyntheticBook
+
+
+def git_commit():
+    """
+    Commit of the working tree (with -dirty when it has changes), None
+    outside a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty', '--abbrev=40'],
+            cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Load a synthetic book into a test database and time uploads, ' \
+           'trade calculation and pages; results are written as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--positions', type=int, default=10000,
+                            help='positions in the book (1k to 1M)')
+        parser.add_argument('--per-portfolio', type=int, default=30,
+                            help='positions per portfolio')
+        parser.add_argument('--funds', type=int,
+                            help='funds in the universe (default: one per '
+                                 '20 positions)')
+        parser.add_argument('--bbg-months', type=int, default=12)
+        parser.add_argument('--trade-portfolios', type=int, default=20,
+                            help='portfolios timed by calculate_trades')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', '-o', default='benchmarks.json',
+                            help='results file (JSON)')
+        parser.add_argument('--check-budgets', action='store_true',
+                            help='fail when a page is over its request '
+                                 'budget')
+
+    def handle(self, *args, **options):
+        try:
+            book = SyntheticBook(
+                positions=options['positions'],
+                per_portfolio=options['per_portfolio'],
+                funds=options['funds'], bbg_months=options['bbg_months'],
+                seed=options['seed'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        self.stdout.write('Synthetic book: %s' % ', '.join(
+            '%s %s' % (value, name) for name, value in book.scale().items()))
+
+        # Never touch the real database or BBG store
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        store_dir = tempfile.mkdtemp(prefix='bbg-store-')
+        started = datetime.datetime.now()
+        try:
+            with override_settings(BBG_STORE_DIR=store_dir,
+                                   TRADING_JOBS_EAGER=True):
+                run = run_benchmarks(
+                    book, options['repeat'], options['trade_portfolios'],
+                    log=self.stdout.write)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+        report = {
+            'commit': git_commit(),
+            'started': started.isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'scale': book.scale(),
+            'repeat': options['repeat'],
+            'results': run.results,
+            'over_budget': run.over_budget,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write('Results written to %s' % options['output'])
+
+        for message in run.over_budget:
+            self.stderr.write('Over budget: %s' % message)
+        if options['check_budgets'] and run.over_budget:
+            raise CommandError('%d pages over budget' % len(run.over_budget))
@@ -0,0 +1,53 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:54
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+import django.db.models.deletion
+
+
+def build_valuations(apps, schema_editor):
+    """Backfill the snapshots from the positions already loaded."""
+    Position = apps.get_model('trading', 'Position')
+    PortfolioValuation = apps.get_model('trading', 'PortfolioValuation')
+
+    rows = Position.objects.filter(account_number__isnull=False).values(
+        'account_number', 'valuation_date').annotate(
+            total=Sum('value'),
+            cash=Sum('value', filter=Q(flag_cash=True)),
+            count=Count('id'))
+
+    PortfolioValuation.objects.bulk_create([
+        PortfolioValuation(
+            account_number_id=row['account_number'],
+            valuation_date=row['valuation_date'],
+            total_value=row['total'],
+            cash_value=row['cash'] or 0,
+            invested_value=row['total'] - (row['cash'] or 0),
+            position_count=row['count'])
+        for row in rows])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0004_calendar_calendardate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioValuation',
+            fields=[
+                ('id', models.AutoField(editable=False, primary_key=True, serialize=False)),
+                ('valuation_date', models.DateField()),
+                ('total_value', models.FloatField(default=0)),
+                ('cash_value', models.FloatField(default=0)),
+                ('invested_value', models.FloatField(default=0)),
+                ('position_count', models.PositiveIntegerField(default=0)),
+                ('account_number', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='trading.Portfolio')),
+            ],
+            options={
+                'unique_together': {('account_number', 'valuation_date')},
+            },
+        ),
+        migrations.RunPython(build_valuations, migrations.RunPython.noop),
+    ]
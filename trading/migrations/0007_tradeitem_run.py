@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-18 07:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0006_tradejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tradeitem',
+            name='run',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='trading.TradeJob'),
+        ),
+        migrations.AlterField(
+            model_name='tradeitem',
+            name='breaches',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddIndex(
+            model_name='tradeitem',
+            index=models.Index(fields=['trade_date', 'id'], name='trading_tra_trade_d_350eff_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tradeitem',
+            index=models.Index(fields=['account_number', 'trade_date'], name='trading_tra_account_b9ae87_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tradeitem',
+            index=models.Index(fields=['isin', 'trade_date'], name='trading_tra_isin_id_69db88_idx'),
+        ),
+    ]
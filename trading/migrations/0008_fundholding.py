@@ -0,0 +1,59 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:00
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+def build_holdings(apps, schema_editor):
+    """Backfill the firm-wide holdings from the positions already loaded."""
+    Position = apps.get_model('trading', 'Position')
+    FundHolding = apps.get_model('trading', 'FundHolding')
+
+    rows = Position.objects.filter(
+        flag_cash=False, isin__isnull=False).values(
+            'isin', 'valuation_date').annotate(
+                value=Sum('value'), shares=Sum('shares'), count=Count('id'))
+
+    FundHolding.objects.bulk_create([
+        FundHolding(
+            isin_id=row['isin'],
+            valuation_date=row['valuation_date'],
+            total_value=row['value'],
+            total_shares=row['shares'],
+            position_count=row['count'])
+        for row in rows])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0007_tradeitem_run'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FundHolding',
+            fields=[
+                ('id', models.AutoField(editable=False, primary_key=True, serialize=False)),
+                ('valuation_date', models.DateField()),
+                ('total_value', models.FloatField(default=0)),
+                ('total_shares', models.FloatField(default=0)),
+                ('position_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='bbgdata',
+            index=models.Index(fields=['isin', 'date'], name='trading_bbg_isin_id_4a2c04_idx'),
+        ),
+        migrations.AddField(
+            model_name='fundholding',
+            name='isin',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='trading.Fund'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='fundholding',
+            unique_together={('isin', 'valuation_date')},
+        ),
+        migrations.RunPython(build_holdings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0008_fundholding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tradeitem',
+            name='breach_flags',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='tradeitem',
+            index=models.Index(fields=['run', 'breach_flags'], name='trading_tra_run_id_dd0444_idx'),
+        ),
+    ]
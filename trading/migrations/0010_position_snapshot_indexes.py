@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0009_tradeitem_breach_flags'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='position',
+            index=models.Index(fields=['account_number', 'valuation_date'], name='trading_pos_account_f392a4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='position',
+            index=models.Index(fields=['isin', 'valuation_date'], name='trading_pos_isin_id_2281c5_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0010_position_snapshot_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fund',
+            name='firm',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='fund',
+            name='status',
+            field=models.CharField(choices=[('Active', 'Active'), ('Inactive', 'Inactive')], db_index=True, default='Active', max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='fund',
+            name='strategy',
+            field=models.CharField(choices=[('Equity Long/Short', 'Equity Long/Short'), ('Equity Market Neutral', 'Equity Market Neutral'), ('Equity Long Bias', 'Equity Long Bias'), ('Activist', 'Activist'), ('Value-wth-catalyst', 'Value-with-catalyst'), ('ED Multi Strategy', 'ED Multi Strategy')], db_index=True, max_length=200),
+        ),
+        migrations.AlterField(
+            model_name='fund',
+            name='style',
+            field=models.CharField(choices=[('Equity Hedge', 'Equity Hedge'), ('Event Driven', 'Event Driven'), ('Global Macro', 'Global Macro'), ('Relative Value', 'Relative Value')], db_index=True, max_length=200),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0011_fund_list_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockOrder',
+            fields=[
+                ('id', models.AutoField(editable=False, primary_key=True, serialize=False)),
+                ('trade_date', models.DateField()),
+                ('currency', models.CharField(max_length=3)),
+                ('side', models.CharField(choices=[('Subscription', 'Subscription'), ('Redemption', 'Redemption'), ('None', 'None')], max_length=20)),
+                ('status', models.CharField(choices=[('Open', 'Open'), ('Below minimum', 'Below minimum'), ('Crossed', 'Crossed')], default='Open', max_length=20)),
+                ('units_trading', models.BooleanField(default=False)),
+                ('gross_subscriptions', models.FloatField(default=0)),
+                ('gross_redemptions', models.FloatField(default=0)),
+                ('net_amount', models.FloatField(default=0)),
+                ('net_shares', models.FloatField(default=0)),
+                ('accounts', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('isin', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='trading.Fund')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BlockAllocation',
+            fields=[
+                ('id', models.AutoField(editable=False, primary_key=True, serialize=False)),
+                ('traded_amount', models.FloatField()),
+                ('traded_shares', models.FloatField()),
+                ('crossed_amount', models.FloatField(default=0)),
+                ('crossed_shares', models.FloatField(default=0)),
+                ('external_amount', models.FloatField(default=0)),
+                ('external_shares', models.FloatField(default=0)),
+                ('account_number', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='trading.Portfolio')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='allocations', to='trading.BlockOrder')),
+                ('trade', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='trading.TradeItem')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='blockorder',
+            index=models.Index(fields=['trade_date', 'isin'], name='trading_blo_trade_d_9dbb34_idx'),
+        ),
+    ]
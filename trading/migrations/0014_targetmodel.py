@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0013_profilecapture'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TargetModel',
+            fields=[
+                ('id', models.AutoField(editable=False, primary_key=True, serialize=False)),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('name', models.CharField(blank=True, default='', max_length=200)),
+                ('weights', models.TextField(default='[]')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='fund',
+            name='index_isin',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+    ]
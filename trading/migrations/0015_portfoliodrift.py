@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:40
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0014_targetmodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolio',
+            name='drift_tolerance',
+            field=models.DecimalField(decimal_places=2, default=2, max_digits=5, validators=[django.core.validators.MaxValueValidator(100), django.core.validators.MinValueValidator(0)]),
+        ),
+        migrations.AddField(
+            model_name='portfolio',
+            name='target_model',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='portfolios', to='trading.TargetModel'),
+        ),
+        migrations.CreateModel(
+            name='PortfolioDrift',
+            fields=[
+                ('account_number', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='drift', serialize=False, to='trading.Portfolio')),
+                ('dirty', models.BooleanField(db_index=True, default=True)),
+                ('valuation_date', models.DateField(blank=True, null=True)),
+                ('nav', models.FloatField(default=0)),
+                ('drift', models.FloatField(default=0)),
+                ('max_drift', models.FloatField(default=0)),
+                ('max_drift_isin', models.CharField(blank=True, default='', max_length=200)),
+                ('outside_tolerance', models.BooleanField(db_index=True, default=False)),
+                ('trade_count', models.PositiveIntegerField(default=0)),
+                ('turnover', models.FloatField(default=0)),
+                ('trades', models.TextField(default='[]')),
+                ('error', models.TextField(blank=True, default='')),
+                ('updated_at', models.DateTimeField(blank=True, null=True)),
+                ('target_model', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='trading.TargetModel')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0015_portfoliodrift'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='blockorder',
+            name='status',
+            field=models.CharField(choices=[('Open', 'Open'), ('Below minimum', 'Below minimum'), ('Crossed', 'Crossed'), ('No price', 'No price')], default='Open', max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trading', '0016_blockorder_no_price'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fund',
+            name='terms_calendars',
+            field=models.CharField(blank=True, default='', max_length=500),
+        ),
+    ]
@@ -1,9 +1,11 @@
+from django.conf import settings
 from django.db import models
 from django.urls import reverse_lazy
 from datetime import time
 from django.core.validators import MaxValueValidator, MinValueValidator
 import datetime
-from django.db.models import Sum
+import json
+from django.db.models import Max, OuterRef, Subquery
 
 
 STATUSES = (
@@ -11,6 +13,48 @@ STATUSES = (
     ("Inactive", "Inactive"),
 )
 
+ORDER_SIDES = (
+    ("Subscription", "Subscription"),
+    ("Redemption", "Redemption"),
+    ("None", "None"),
+)
+
+ORDER_STATUSES = (
+    ("Open", "Open"),
+    ("Below minimum", "Below minimum"),
+    ("Crossed", "Crossed"),
+    ("No price", "No price"),
+)
+
+JOB_STATUSES = (
+    ("Queued", "Queued"),
+    ("Running", "Running"),
+    ("Done", "Done"),
+    ("Failed", "Failed"),
+)
+
+
+class PortfolioQuerySet(models.QuerySet):
+
+    def with_latest_valuation(self):
+        """
+        Annotate each portfolio with its latest PortfolioValuation snapshot
+        (latest_valuation_date, latest_value, latest_cash, latest_invested,
+        latest_positions) in the same query.
+        """
+        latest = PortfolioValuation.objects.filter(
+            account_number=OuterRef('pk')).order_by('-valuation_date')
+        return self.annotate(**{
+            'latest_' + name: Subquery(latest.values(field)[:1])
+            for name, field in (
+                ('valuation_date', 'valuation_date'),
+                ('value', 'total_value'),
+                ('cash', 'cash_value'),
+                ('invested', 'invested_value'),
+                ('positions', 'position_count'),
+            )
+        })
+
 
 class Portfolio(models.Model):
     # Fields
@@ -43,15 +87,37 @@ class Portfolio(models.Model):
             MinValueValidator(1)
         ]
     )
+    target_model = models.ForeignKey('TargetModel', on_delete=models.SET_NULL,
+                                     null=True, blank=True,
+                                     related_name='portfolios')
+    # Largest weight difference from the target model (%) before the
+    # portfolio is reported as outside tolerance
+    drift_tolerance = models.DecimalField(
+        max_digits=5, decimal_places=2, default=2,
+        validators=[
+            MaxValueValidator(100),
+            MinValueValidator(0)
+        ]
+    )
+
+    objects = PortfolioQuerySet.as_manager()
 
     # Methods
     def get_absolute_url(self):
         """Returns the url to access a particular instance of Fund."""
         return reverse_lazy('portfolio-detail', args=[str(self.pk)])
 
+    def get_latest_valuation(self):
+        return self.portfoliovaluation_set.order_by('-valuation_date').first()
+
+    def get_positions(self, as_of=None):
+        """Positions of the latest valuation date on or before `as_of`."""
+        return Position.objects.as_of(as_of, [self])
+
     def get_position_sum(self):
-        sum = "%.2f" % list(
-            self.position_set.aggregate(Sum('value')).values())[0]
+        """Total value of the latest valuation date."""
+        valuation = self.get_latest_valuation()
+        sum = "%.2f" % (valuation.total_value if valuation else 0)
         return sum
 
     def __str__(self):
@@ -78,15 +144,17 @@ class Fund(models.Model):
 
     # Fields
     status = models.CharField(max_length=200, choices=STATUSES,
-                              default='Active', blank=False)
+                              default='Active', blank=False, db_index=True)
     isin = models.CharField(max_length=200, primary_key=True, unique=True,
                             blank=False)
-    index_isin = models.CharField(max_length=200, blank=False)
+    index_isin = models.CharField(max_length=200, blank=False,
+                                  db_index=True)
     name = models.CharField(max_length=200, blank=False)
-    firm = models.CharField(max_length=200, blank=False)
-    style = models.CharField(max_length=200, choices=STYLES, blank=False)
+    firm = models.CharField(max_length=200, blank=False, db_index=True)
+    style = models.CharField(max_length=200, choices=STYLES, blank=False,
+                             db_index=True)
     strategy = models.CharField(max_length=200, choices=STRATEGIES,
-                                blank=False)
+                                blank=False, db_index=True)
     flag_restricted = models.BooleanField(default=False)
     flag_late_cutoff = models.BooleanField(default=False)
     flag_units_trading = models.BooleanField(default=False)
@@ -98,7 +166,8 @@ class Fund(models.Model):
     terms_red_notice = models.PositiveSmallIntegerField()
     terms_red_settlement = models.PositiveSmallIntegerField()
     terms_cutoff_time = models.TimeField(default=time(17, 30))
-    terms_calendars = models.CharField(max_length=500, default='')
+    terms_calendars = models.CharField(max_length=500, default='',
+                                       blank=True)
     terms_man_fee = models.DecimalField(max_digits=6, decimal_places=5)
     terms_perf_fee = models.DecimalField(max_digits=6, decimal_places=5)
     terms_currency = models.CharField(max_length=3, default='USD', blank=False)
@@ -112,6 +181,36 @@ class Fund(models.Model):
         return self.isin
 
 
+class PositionQuerySet(models.QuerySet):
+
+    def as_of(self, date=None, portfolios=None):
+        """
+        Positions of each portfolio on its latest valuation date on or
+        before `date` (the latest overall when None), in a single query.
+
+        `portfolios` (Portfolio instances or account numbers) restricts the
+        snapshot to those portfolios. The latest dates are looked up in the
+        PortfolioValuation snapshots, so the Position rows are only ever
+        read through the (account_number, valuation_date) index.
+        """
+        valuations = PortfolioValuation.objects.all()
+        if date is not None:
+            valuations = valuations.filter(valuation_date__lte=date)
+        positions = self
+        if portfolios is not None:
+            accounts = [str(p) for p in portfolios]
+            valuations = valuations.filter(account_number__in=accounts)
+            positions = positions.filter(account_number__in=accounts)
+
+        latest_dates = valuations.values('account_number').annotate(
+            latest=Max('valuation_date')).values('latest')
+        latest = valuations.filter(
+            account_number=OuterRef('account_number')).order_by(
+            '-valuation_date').values('valuation_date')[:1]
+        return positions.filter(valuation_date__in=latest_dates,
+                                valuation_date=Subquery(latest))
+
+
 class Position(models.Model):
     """
     Class/ORM for every past/current/future position (uploaded via file)
@@ -129,11 +228,64 @@ class Position(models.Model):
     price = models.FloatField()
     valuation_date = models.DateField(blank=False, default=datetime.date.today)
 
+    objects = PositionQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['account_number', 'valuation_date']),
+            models.Index(fields=['isin', 'valuation_date']),
+        ]
+
     # Methods
     def __str__(self):
         return str(self.id)
 
 
+class PortfolioValuation(models.Model):
+    """
+    Class/ORM for the valuation snapshot of a portfolio on a valuation date,
+    maintained incrementally by the position uploads
+    """
+
+    # Fields
+    id = models.AutoField(primary_key=True, editable=False)
+    account_number = models.ForeignKey('Portfolio', on_delete=models.CASCADE)
+    valuation_date = models.DateField()
+    total_value = models.FloatField(default=0)
+    cash_value = models.FloatField(default=0)
+    invested_value = models.FloatField(default=0)
+    position_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('account_number', 'valuation_date'),)
+
+    # Methods
+    def __str__(self):
+        return "%s %s" % (self.account_number_id, self.valuation_date)
+
+
+class FundHolding(models.Model):
+    """
+    Class/ORM for the firm-wide holding of a fund (all portfolios) on a
+    valuation date, maintained incrementally by the position uploads
+    """
+
+    # Fields
+    id = models.AutoField(primary_key=True, editable=False)
+    isin = models.ForeignKey('Fund', on_delete=models.CASCADE)
+    valuation_date = models.DateField()
+    total_value = models.FloatField(default=0)
+    total_shares = models.FloatField(default=0)
+    position_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('isin', 'valuation_date'),)
+
+    # Methods
+    def __str__(self):
+        return "%s %s" % (self.isin_id, self.valuation_date)
+
+
 class TradeItem(models.Model):
     """
     Class/ORM for every trade line item generated
@@ -151,12 +303,214 @@ class TradeItem(models.Model):
     traded_amount = models.FloatField()
     traded_shares = models.FloatField()
     trade_note = models.TextField()
-    breaches = models.TextField()
+    breaches = models.TextField(blank=True, default='')
+    breach_flags = models.PositiveIntegerField(default=0)
+    run = models.ForeignKey('TradeJob', on_delete=models.CASCADE, null=True,
+                            blank=True)
+
+    class Meta:
+        # Blotter filters (account/ISIN/breaches) combined with the trade
+        # date sort
+        indexes = [
+            models.Index(fields=['trade_date', 'id']),
+            models.Index(fields=['account_number', 'trade_date']),
+            models.Index(fields=['isin', 'trade_date']),
+            models.Index(fields=['run', 'breach_flags']),
+        ]
+
+    # Methods
+
+    def __str__(self):
+        return str(self.id)
+
+
+class TradeJob(models.Model):
+    """
+    Class/ORM for a trade calculation executed by the background job pool
+    """
+
+    # Fields
+    id = models.AutoField(primary_key=True, editable=False)
+    kind = models.CharField(max_length=50, default='trades')
+    status = models.CharField(max_length=20, choices=JOB_STATUSES,
+                              default='Queued')
+    params = models.TextField(default='{}')
+    result = models.TextField(blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
 
     # Methods
+    def get_params(self):
+        return json.loads(self.params)
+
+    def get_result(self):
+        return json.loads(self.result) if self.result else None
+
+    @property
+    def is_finished(self):
+        return self.status in ('Done', 'Failed')
+
+    @property
+    def queued_seconds(self):
+        if self.started_at is None:
+            return None
+        return (self.started_at - self.created_at).total_seconds()
+
+    @property
+    def run_seconds(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at).total_seconds()
 
     def __str__(self):
-        return self.id
+        return "%s #%s (%s)" % (self.kind, self.id, self.status)
+
+
+class TargetModel(models.Model):
+    """
+    Class/ORM for an uploaded target weights file, stored once per distinct
+    file content with its weights validated and normalised
+    """
+
+    # Fields
+    id = models.AutoField(primary_key=True, editable=False)
+    content_hash = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=200, blank=True, default='')
+    # JSON list of [index_isin, weight] pairs, weights as fractions of NAV
+    weights = models.TextField(default='[]')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    # Methods
+    def get_weights(self):
+        return json.loads(self.weights)
+
+    def __str__(self):
+        return self.name or self.content_hash[:12]
+
+
+class PortfolioDrift(models.Model):
+    """
+    Class/ORM for the drift of a portfolio from its target model and the
+    trades back to it; only rows marked dirty are recomputed (see
+    trading.drift)
+    """
+
+    # Fields
+    account_number = models.OneToOneField('Portfolio',
+                                          on_delete=models.CASCADE,
+                                          primary_key=True,
+                                          related_name='drift')
+    dirty = models.BooleanField(default=True, db_index=True)
+    target_model = models.ForeignKey('TargetModel', on_delete=models.SET_NULL,
+                                     null=True, blank=True)
+    valuation_date = models.DateField(blank=True, null=True)
+    nav = models.FloatField(default=0)
+    # Half the sum of the absolute weight differences (cash included) and
+    # the largest one over the funds, in %
+    drift = models.FloatField(default=0)
+    max_drift = models.FloatField(default=0)
+    max_drift_isin = models.CharField(max_length=200, blank=True, default='')
+    outside_tolerance = models.BooleanField(default=False, db_index=True)
+    trade_count = models.PositiveIntegerField(default=0)
+    turnover = models.FloatField(default=0)
+    # JSON list of the rebalance trade dicts (see trading.portfolio_trades)
+    trades = models.TextField(default='[]')
+    error = models.TextField(blank=True, default='')
+    updated_at = models.DateTimeField(blank=True, null=True)
+
+    # Methods
+    def get_trades(self):
+        return json.loads(self.trades)
+
+    def __str__(self):
+        return "%s (%.2f%%)" % (self.account_number_id, self.max_drift)
+
+
+class BlockOrder(models.Model):
+    """
+    Class/ORM for the order placed with a fund for a dealing date and
+    currency: the net of the trades of every portfolio
+    """
+
+    # Fields
+    id = models.AutoField(primary_key=True, editable=False)
+    isin = models.ForeignKey('Fund', on_delete=models.SET_NULL, null=True)
+    trade_date = models.DateField()
+    currency = models.CharField(max_length=3)
+    side = models.CharField(max_length=20, choices=ORDER_SIDES)
+    status = models.CharField(max_length=20, choices=ORDER_STATUSES,
+                              default='Open')
+    units_trading = models.BooleanField(default=False)
+    gross_subscriptions = models.FloatField(default=0)
+    gross_redemptions = models.FloatField(default=0)
+    net_amount = models.FloatField(default=0)
+    net_shares = models.FloatField(default=0)
+    accounts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['trade_date', 'isin']),
+        ]
+
+    # Methods
+    def __str__(self):
+        return "%s %s %s" % (self.isin_id, self.trade_date, self.side)
+
+
+class BlockAllocation(models.Model):
+    """
+    Class/ORM for the share of a block order allocated back to a trade:
+    the part crossed against opposite trades of other portfolios and the
+    part dealt with the fund
+    """
+
+    # Fields
+    id = models.AutoField(primary_key=True, editable=False)
+    order = models.ForeignKey('BlockOrder', on_delete=models.CASCADE,
+                              related_name='allocations')
+    trade = models.ForeignKey('TradeItem', on_delete=models.CASCADE)
+    account_number = models.ForeignKey('Portfolio', on_delete=models.SET_NULL,
+                                       null=True)
+    traded_amount = models.FloatField()
+    traded_shares = models.FloatField()
+    crossed_amount = models.FloatField(default=0)
+    crossed_shares = models.FloatField(default=0)
+    external_amount = models.FloatField(default=0)
+    external_shares = models.FloatField(default=0)
+
+    # Methods
+    def __str__(self):
+        return "%s %s" % (self.order_id, self.account_number_id)
+
+
+class ProfileCapture(models.Model):
+    """
+    Class/ORM for a request run under the profiler (see trading.profiler)
+    """
+
+    # Fields
+    id = models.AutoField(primary_key=True, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.SET_NULL, null=True,
+                             blank=True)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=2000)
+    view_name = models.CharField(max_length=200, blank=True, default='')
+    status_code = models.PositiveSmallIntegerField()
+    wall_ms = models.FloatField()
+    queries = models.PositiveIntegerField()
+    db_ms = models.FloatField()
+    render_ms = models.FloatField()
+    summary = models.TextField(blank=True, default='')
+    stats = models.BinaryField()
+
+    # Methods
+    def __str__(self):
+        return "%s %s (%.0f ms)" % (self.method, self.path, self.wall_ms)
 
 
 class BBGData(models.Model):
@@ -171,9 +525,15 @@ class BBGData(models.Model):
     assets = models.FloatField()
     shares_issued = models.FloatField()
 
+    class Meta:
+        # As-of lookups: latest date on or before a given date per fund
+        indexes = [
+            models.Index(fields=['isin', 'date']),
+        ]
+
     # Methods
     def __str__(self):
-        return self.id
+        return str(self.id)
 
 
 class Calendar(models.Model):
@@ -0,0 +1,174 @@
+"""
+Block orders: the trades of every portfolio netted per fund, dealing date
+and currency, with the result allocated back to the trades.
+
+Within a block the buys are crossed against the sells, so only the net is
+dealt with the fund. Trades on the side of the net are split pro-rata into
+a crossed and an external part; trades on the other side are fully crossed.
+Funds dealing in units (flag_units_trading) are netted on shares, all
+others on amounts, and net subscriptions below the fund's minimum
+(terms_sub_minimum) are held back as 'Below minimum'. A units block with a
+trade that has an amount but no shares (no price) cannot be netted: it is
+flagged 'No price' and nothing in it is crossed.
+
+Only the trades of the latest run (TradeJob) of each portfolio on a date
+are netted, so running a portfolio again replaces its trades instead of
+adding to them.
+"""
+import numpy as np
+from django.db import transaction
+from django.db.models import Max, OuterRef, Q, Subquery
+
+from .models import BlockAllocation, BlockOrder, TradeItem
+
+
+def group_codes(keys):
+    """
+    Group number of every key (hash-based, in order of first appearance)
+    and the distinct keys
+    """
+    groups = {}
+    codes = np.fromiter((groups.setdefault(key, len(groups)) for key in keys),
+                        dtype=np.int64)
+    return codes, list(groups)
+
+
+def net_blocks(codes, groups, quantity):
+    """
+    Per block gross buys and sells (bincount over the group codes) and, per
+    trade, the fraction of it crossed within its block
+    """
+    buys = np.bincount(codes, np.where(quantity > 0, quantity, 0), groups)
+    sells = -np.bincount(codes, np.where(quantity < 0, quantity, 0), groups)
+
+    # Trades on the net side are crossed up to the opposite side's total,
+    # the others are crossed in full
+    with np.errstate(divide='ignore', invalid='ignore'):
+        buy_crossed = np.where(buys > 0, np.minimum(sells / buys, 1), 1)
+        sell_crossed = np.where(sells > 0, np.minimum(buys / sells, 1), 1)
+    crossed = np.where(quantity > 0, buy_crossed[codes],
+                       sell_crossed[codes])
+    return buys, sells, crossed
+
+
+def dealing_trades(trade_date):
+    """
+    Trades of `trade_date` from the latest run (highest TradeJob id) of each
+    portfolio with trades on that date
+    """
+    latest = TradeItem.objects.filter(
+        trade_date=trade_date,
+        account_number=OuterRef('account_number')).order_by(
+            '-run').values('run')[:1]
+    return TradeItem.objects.filter(trade_date=trade_date,
+                                    run=Subquery(latest))
+
+
+def build_block_orders(trade_date, runs=None):
+    """
+    Replace the block orders of `trade_date` with the net of its trades
+    (see dealing_trades).
+
+    With `runs` (TradeJob ids) only the blocks of the funds that the
+    portfolios of those runs trade, or traded in the current blocks, are
+    rebuilt, each from all of its trades.
+
+    Returns the number of block orders created.
+    """
+    trades = dealing_trades(trade_date).exclude(isin=None)
+    old = BlockOrder.objects.filter(trade_date=trade_date)
+    if runs is not None:
+        accounts = TradeItem.objects.filter(
+            trade_date=trade_date, run__in=runs).values('account_number')
+        funds = Q(isin__in=trades.filter(
+            account_number__in=accounts).values('isin')) | Q(
+                isin__in=BlockAllocation.objects.filter(
+                    order__trade_date=trade_date,
+                    account_number__in=accounts).values('order__isin'))
+        trades = trades.filter(funds)
+        old = old.filter(funds)
+    rows = list(trades.values_list(
+        'id', 'account_number', 'isin', 'trade_date', 'isin__terms_currency',
+        'isin__flag_units_trading', 'isin__terms_sub_minimum',
+        'traded_amount', 'traded_shares'))
+
+    with transaction.atomic():
+        old.delete()
+        if not rows:
+            return 0
+        last_id = BlockOrder.objects.aggregate(Max('id'))['id__max'] or 0
+
+        (ids, accounts, isins, dates, currencies, units, minimums, amounts,
+         shares) = zip(*rows)
+        codes, keys = group_codes(zip(isins, dates, currencies))
+        groups = len(keys)
+        amounts = np.array(amounts, dtype=float)
+        shares = np.array(shares, dtype=float)
+        units = np.array(units, dtype=bool)
+
+        # Units funds net on shares, the others on amounts; a units trade
+        # without shares leaves its whole block unpriced
+        unpriced = np.bincount(
+            codes, units & (amounts != 0) & (shares == 0), groups) > 0
+        quantity = np.where(units, shares, amounts)
+        buys, sells, crossed = net_blocks(codes, groups, quantity)
+        crossed[unpriced[codes]] = 0
+        net_amount = np.bincount(codes, amounts, groups)
+        net_shares = np.bincount(codes, shares, groups)
+        gross_subscriptions = np.bincount(
+            codes, np.where(amounts > 0, amounts, 0), groups)
+        gross_redemptions = np.bincount(
+            codes, np.where(amounts < 0, amounts, 0), groups)
+        block_units = np.zeros(groups, dtype=bool)
+        block_units[codes] = units
+        minimum = np.zeros(groups)
+        minimum[codes] = minimums
+        accounts_per_block = np.bincount(
+            [code for code, _ in set(zip(codes.tolist(), accounts))],
+            minlength=groups)
+
+        net = np.where(unpriced, net_amount, buys - sells)
+        side = np.where(net > 0, 'Subscription',
+                        np.where(net < 0, 'Redemption', 'None'))
+        status = np.where(
+            unpriced, 'No price', np.where(
+                net == 0, 'Crossed',
+                np.where((net > 0) & (net_amount < minimum),
+                         'Below minimum', 'Open')))
+
+        BlockOrder.objects.bulk_create([
+            BlockOrder(
+                isin_id=isin, trade_date=date, currency=currency,
+                side=side[i], status=status[i],
+                units_trading=bool(block_units[i]),
+                gross_subscriptions=gross_subscriptions[i],
+                gross_redemptions=gross_redemptions[i],
+                net_amount=net_amount[i], net_shares=net_shares[i],
+                accounts=int(accounts_per_block[i]))
+            for i, (isin, date, currency) in enumerate(keys)])
+
+        # bulk_create does not return ids on every backend: read them back
+        order_ids = {
+            (isin, currency): pk for pk, isin, currency in
+            BlockOrder.objects.filter(
+                trade_date=trade_date, id__gt=last_id).values_list(
+                    'pk', 'isin', 'currency')}
+        blocks = [order_ids[(isin, currency)]
+                  for isin, _, currency in keys]
+
+        crossed_amounts = amounts * crossed
+        crossed_shares = shares * crossed
+        BlockAllocation.objects.bulk_create([
+            BlockAllocation(
+                order_id=blocks[code], trade_id=trade_id,
+                account_number_id=account, traded_amount=amount,
+                traded_shares=trade_shares, crossed_amount=crossed_amount,
+                crossed_shares=crossed_share,
+                external_amount=amount - crossed_amount,
+                external_shares=trade_shares - crossed_share)
+            for (trade_id, account, code, amount, trade_shares,
+                 crossed_amount, crossed_share) in zip(
+                ids, accounts, codes.tolist(), amounts.tolist(),
+                shares.tolist(), crossed_amounts.tolist(),
+                crossed_shares.tolist())])
+    return groups
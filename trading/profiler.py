@@ -0,0 +1,99 @@
+"""
+Opt-in profiling of single requests.
+
+A staff user adds ?_profile=1 to a URL (or sends an X-Profile: 1 header)
+and the request runs under cProfile. The profile is saved as a
+ProfileCapture with the view name, timings and query counts, and can be
+listed and downloaded (pstats format, e.g. for snakeviz) from the app.
+
+Requests without the switch only pay for one dictionary lookup, and the
+middleware removes itself when settings.TRADING_PROFILER is False.
+"""
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .instrumentation import Collector
+from .models import ProfileCapture
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_PARAM = '_profile'
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+
+# Switch values that leave profiling off
+OFF_VALUES = ('', '0')
+
+# Functions listed in the text summary of a capture
+SUMMARY_LINES = 60
+
+# Captures kept (older ones are deleted)
+DEFAULT_KEEP = 200
+
+
+def profile_requested(request):
+    # ?_profile=0 and X-Profile: 0 both leave profiling off
+    return (request.GET.get(PROFILE_PARAM, '') not in OFF_VALUES or
+            request.META.get(PROFILE_HEADER, '') not in OFF_VALUES)
+
+
+def save_capture(request, response, profiler, collector):
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+    match = getattr(request, 'resolver_match', None)
+    measured = collector.as_dict()
+    capture = ProfileCapture.objects.create(
+        user=request.user, method=request.method,
+        path=request.get_full_path()[:2000],
+        view_name=match.view_name if match else '',
+        status_code=response.status_code, wall_ms=measured['wall_ms'],
+        queries=measured['queries'], db_ms=measured['db_ms'],
+        render_ms=measured['render_ms'],
+        summary=stats.stream.getvalue(), stats=marshal.dumps(stats.stats))
+
+    keep = getattr(settings, 'TRADING_PROFILE_KEEP', DEFAULT_KEEP)
+    old = ProfileCapture.objects.order_by('-id').values_list(
+        'id', flat=True)[keep:keep + 1]
+    if old:
+        ProfileCapture.objects.filter(id__lte=old[0]).delete()
+    return capture
+
+
+class ProfilerMiddleware:
+    """
+    Run staff requests asking for it under cProfile and save the profile
+    (must come after AuthenticationMiddleware)
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'TRADING_PROFILER', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not profile_requested(request) or not request.user.is_staff:
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        with Collector() as collector:
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+
+        try:
+            capture = save_capture(request, response, profiler, collector)
+        except Exception:
+            # Never fail the request because of the profiler
+            logger.exception('Could not save the profile of %s',
+                             request.path)
+        else:
+            response['X-Profile-Id'] = str(capture.pk)
+        return response
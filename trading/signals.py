@@ -0,0 +1,63 @@
+"""
+Signal receivers keeping the in-process caches in line with the database
+"""
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .bbgstore import bbg_data_changed
+from .cache import CALENDARS, FUNDS, PORTFOLIOS, bump_on_commit
+from .calendars import clear_calendar_cache
+from .drift import mark_funds_dirty, sync_portfolio
+from .models import BBGData, Calendar, CalendarDate, Fund, Portfolio
+
+
+@receiver(post_save, sender=Calendar)
+@receiver(post_delete, sender=Calendar)
+@receiver(post_save, sender=CalendarDate)
+@receiver(post_delete, sender=CalendarDate)
+def calendars_changed(sender, **kwargs):
+    clear_calendar_cache()
+    bump_on_commit(CALENDARS)
+
+
+@receiver(post_save, sender=BBGData)
+def bbg_data_saved(sender, instance, created, **kwargs):
+    bbg_data_changed(created)
+    mark_funds_dirty([instance.isin_id] if instance.isin_id else [])
+
+
+@receiver(post_delete, sender=BBGData)
+def bbg_data_deleted(sender, instance, **kwargs):
+    bbg_data_changed(created=False)
+    mark_funds_dirty([instance.isin_id] if instance.isin_id else [])
+
+
+@receiver(post_save, sender=Fund)
+@receiver(post_delete, sender=Fund)
+def funds_changed(sender, instance, **kwargs):
+    mark_funds_dirty([instance.isin], [instance.index_isin])
+    bump_on_commit(FUNDS)
+
+
+@receiver(post_save, sender=Portfolio)
+@receiver(post_delete, sender=Portfolio)
+def portfolios_changed(sender, **kwargs):
+    bump_on_commit(PORTFOLIOS)
+
+
+# Portfolio fields the drift is computed from
+DRIFT_TERMS = ('target_model', 'drift_tolerance')
+
+
+@receiver(pre_save, sender=Portfolio)
+def portfolio_saving(sender, instance, **kwargs):
+    instance._saved_drift_terms = Portfolio.objects.filter(
+        pk=instance.pk).values_list(*DRIFT_TERMS).first()
+
+
+@receiver(post_save, sender=Portfolio)
+def portfolio_saved(sender, instance, **kwargs):
+    # Only a new target model or tolerance changes the drift
+    terms = (instance.target_model_id, instance.drift_tolerance)
+    if terms != getattr(instance, '_saved_drift_terms', None):
+        sync_portfolio(instance)
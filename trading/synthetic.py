@@ -0,0 +1,215 @@
+"""
+Synthetic data for benchmarks: a fund universe, portfolios, a custodian
+position file, BBG data and calendar holidays at a chosen scale.
+
+Files are produced in the upload formats, so loading them goes through the
+same ingest code as real uploads. Generation is seeded: the same scale and
+seed always give the same data.
+"""
+import csv
+import datetime
+import io
+
+import numpy as np
+
+from .ingest import FUND_COLUMNS
+from .models import Fund, Portfolio
+
+
+CASH_ISIN = 'CASH'
+CALENDAR_CODES = ('US', 'GB', 'IE', 'LU', 'KY')
+CUTOFF_TIMES = ('12:00', '16:00', '17:30')
+
+POSITION_HEADER = ('Fund', 'ISIN Number', 'Fund Asset Class',
+                   'Base Market Value', 'Shares/Par Value',
+                   'Base Price Amount', 'Period End Date')
+
+
+def to_csv(header, rows):
+    f = io.StringIO()
+    writer = csv.writer(f)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return f.getvalue()
+
+
+class SyntheticBook:
+    """
+    A generated book of `positions` positions: portfolios of
+    `per_portfolio` positions (one of them cash) in a universe of `funds`
+    funds with two share classes per index ISIN.
+    """
+
+    def __init__(self, positions=10000, per_portfolio=30, funds=None,
+                 bbg_months=12, valuation_date=datetime.date(2019, 8, 30),
+                 seed=1):
+        if per_portfolio < 2 or positions < per_portfolio:
+            raise ValueError('Need at least one portfolio of two or more '
+                             'positions')
+        self.portfolio_count = positions // per_portfolio
+        self.per_portfolio = per_portfolio
+        self.fund_count = max(funds or positions // 20, per_portfolio, 2)
+        self.bbg_months = bbg_months
+        self.valuation_date = valuation_date
+        self.seed = seed
+
+        rng = np.random.RandomState(seed)
+        count = self.fund_count
+        self.isins = np.array(['KY%09dS' % i for i in range(count)])
+        self.index_isins = np.array(['IX%09dS' % (i // 2)
+                                     for i in range(count)])
+        self.navs = np.round(rng.lognormal(5, 0.5, count), 4)
+        self.assets = np.round(rng.lognormal(19, 1.2, count), 2)
+        self._fund_rows = self._make_funds(rng)
+        self._holdings = [rng.choice(count, per_portfolio - 1, replace=False)
+                          for _ in range(self.portfolio_count)]
+        self._values = rng.lognormal(
+            13, 1, (self.portfolio_count, per_portfolio))
+
+    # Methods
+    @property
+    def positions(self):
+        return self.portfolio_count * self.per_portfolio
+
+    @property
+    def accounts(self):
+        return ['SYN%06d' % i for i in range(self.portfolio_count)]
+
+    def scale(self):
+        return {
+            'positions': self.positions,
+            'portfolios': self.portfolio_count,
+            'funds': self.fund_count,
+            'bbg_rows': self.fund_count * self.bbg_months,
+            'seed': self.seed,
+        }
+
+    def _make_funds(self, rng):
+        count = self.fund_count
+        styles = [code for code, _ in Fund.STYLES]
+        strategies = [code for code, _ in Fund.STRATEGIES]
+        calendars = [','.join(CALENDAR_CODES[:n]) for n in (1, 2, 3)] + \
+            list(CALENDAR_CODES[1:])
+        columns = {
+            'isin': self.isins,
+            'index_isin': self.index_isins,
+            'name': ['Synthetic Fund %d' % i for i in range(count)],
+            'firm': ['Manager %d' % i for i in rng.randint(0, max(
+                count // 10, 1), count)],
+            'style': rng.choice(styles, count),
+            'strategy': rng.choice(strategies, count),
+            'flag_restricted': rng.random_sample(count) < 0.02,
+            'flag_late_cutoff': rng.random_sample(count) < 0.1,
+            'flag_units_trading': rng.random_sample(count) < 0.1,
+            # First share class of each index ISIN ranks first
+            'terms_rank': 1 + np.arange(count) % 2,
+            'terms_rank_amount': np.zeros(count, dtype=int),
+            'terms_sub_notice': rng.choice([0, 1, 2, 5], count),
+            'terms_sub_settlement': rng.choice([0, 1, 2], count),
+            'terms_sub_minimum': rng.choice([0, 100000, 1000000], count),
+            'terms_red_notice': rng.choice([0, 5, 20, 45, 90], count),
+            'terms_red_settlement': rng.choice([2, 10, 20, 30], count),
+            'terms_cutoff_time': rng.choice(CUTOFF_TIMES, count),
+            'terms_calendars': rng.choice(calendars, count),
+            'terms_man_fee': rng.choice(['0.01500', '0.02000'], count),
+            'terms_perf_fee': rng.choice(['0.15000', '0.20000'], count),
+        }
+        rows = [list(row) for row in zip(*(columns[name]
+                                           for name in FUND_COLUMNS))]
+        # Second share classes are sometimes closed
+        inactive = (np.arange(count) % 2 == 1) & \
+            (rng.random_sample(count) < 0.2)
+        for row, closed in zip(rows, inactive.tolist()):
+            row.append('Inactive' if closed else 'Active')
+        rows.append([CASH_ISIN, CASH_ISIN, 'Cash', 'Cash', styles[0],
+                     strategies[0], False, False, False, 1, 0, 0, 0, 0, 0, 0,
+                     '17:30', CALENDAR_CODES[0], '0', '0', 'Active'])
+        return rows
+
+    def funds_csv(self):
+        """
+        Fund master file (upload-file format)
+        """
+        return to_csv(FUND_COLUMNS + ('status',), self._fund_rows)
+
+    def portfolios(self):
+        """
+        Unsaved Portfolio objects of the book
+        """
+        return [Portfolio(account_number=account, name='Synthetic %s' %
+                          account, guideline_max_weight=10,
+                          guideline_shares_owned=20,
+                          guideline_assets_owned=20)
+                for account in self.accounts]
+
+    def positions_csv(self, valuation_date=None):
+        """
+        Custodian position file (upload-positions format) of every
+        portfolio on `valuation_date` (default: the book's)
+        """
+        date = (valuation_date or self.valuation_date).isoformat()
+        rows = []
+        for account, holdings, values in zip(self.accounts, self._holdings,
+                                             self._values.tolist()):
+            for fund, value in zip(holdings.tolist(), values):
+                price = self.navs[fund]
+                rows.append((account, self.isins[fund], 'FUND',
+                             '{:,.2f}'.format(value),
+                             '%.4f' % (value / price), '%.4f' % price, date))
+            rows.append((account, CASH_ISIN, 'CURRENCY',
+                         '{:,.2f}'.format(values[-1]),
+                         '%.2f' % values[-1], '1', date))
+        return to_csv(POSITION_HEADER, rows)
+
+    def bbg_csv(self):
+        """
+        Month end BBG data of every fund (upload-bbg-data format)
+        """
+        months = np.arange(-self.bbg_months + 1, 1)
+        last = np.datetime64(self.valuation_date, 'M')
+        dates = ((last + months + 1).astype('datetime64[D]') - 1).astype(str)
+        rows = []
+        for isin, nav, assets in zip(self.isins.tolist(), self.navs.tolist(),
+                                     self.assets.tolist()):
+            for date in dates.tolist():
+                rows.append((isin, date, '%.2f' % assets,
+                             '%.4f' % (assets / nav)))
+        return to_csv(('isin', 'date', 'assets', 'shares_issued'), rows)
+
+    def calendars_csv(self, years=3):
+        """
+        Ten weekday holidays a year in every calendar, around the valuation
+        date (upload-calendars format)
+        """
+        rng = np.random.RandomState(self.seed)
+        first = np.datetime64('%d-01-01' % (self.valuation_date.year - 1))
+        days = np.arange(first, first + np.timedelta64(365 * years, 'D'))
+        weekdays = days[np.is_busday(days)]
+        rows = []
+        for code in CALENDAR_CODES:
+            for date in np.sort(rng.choice(weekdays, 10 * years,
+                                           replace=False)).astype(str):
+                rows.append((code, date, '%s holidays' % code))
+        return to_csv(('code', 'date', 'name'), rows)
+
+    def target_weights(self, count=50):
+        """
+        Target weights (percentages, 98% in total) over `count` index ISINs,
+        in the form read from a target weights file
+        """
+        rng = np.random.RandomState(self.seed)
+        indexes = np.unique(self.index_isins)
+        chosen = rng.choice(indexes, min(count, len(indexes)), replace=False)
+        weights = rng.uniform(1, 5, len(chosen))
+        weights = np.floor(98 * weights / weights.sum() * 1e4) / 1e4
+        return [{'index_isin': isin, 'target_weight': '%.4f' % weight}
+                for isin, weight in zip(chosen.tolist(), weights.tolist())]
+
+    def target_weights_csv(self, count=50):
+        """
+        Target weights file (ISIN and Weight columns, in percent) of
+        target_weights()
+        """
+        return to_csv(('ISIN', 'Weight'), [
+            (weight['index_isin'], weight['target_weight'])
+            for weight in self.target_weights(count)])
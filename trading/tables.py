@@ -0,0 +1,150 @@
+"""
+Server-side processing for the DataTables lists (one page of rows per
+request, see https://datatables.net/manual/server-side).
+"""
+from functools import reduce
+import operator
+
+from django.db.models import Q, Sum
+from django.http import JsonResponse
+from django.urls import reverse
+
+from .models import Fund, Portfolio
+
+
+# Rows per page when DataTables does not ask for a length, and the most a
+# single request may ask for
+DEFAULT_PAGE_LENGTH = 50
+MAX_PAGE_LENGTH = 500
+
+
+def to_int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class DataTable:
+    """
+    Paging, sorting, searching and filtering of a queryset from the
+    DataTables request parameters.
+
+    `columns` maps the DataTables column names (columns[i][data]) to the
+    ORM lookups they sort on, `search_columns` are matched by the search
+    box and `filters` maps extra request parameters to exact lookups.
+    """
+
+    columns = {}
+    search_columns = ()
+    filters = {}
+
+    # Methods
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def row(self, obj):
+        raise NotImplementedError
+
+    def filter(self, queryset, params):
+        for param, lookup in self.filters.items():
+            value = params.get(param, '').strip()
+            if value:
+                queryset = queryset.filter(**{lookup: value})
+
+        search = params.get('search[value]', '').strip()
+        if search and self.search_columns:
+            queryset = queryset.filter(reduce(operator.or_, (
+                Q(**{column + '__icontains': search})
+                for column in self.search_columns)))
+        return queryset
+
+    def order(self, queryset, params):
+        ordering = []
+        i = 0
+        while 'order[%d][column]' % i in params:
+            index = to_int(params['order[%d][column]' % i], -1)
+            column = params.get('columns[%d][data]' % index)
+            if column in self.columns:
+                prefix = '-' if params.get('order[%d][dir]' % i) == 'desc' \
+                    else ''
+                ordering.append(prefix + self.columns[column])
+            i += 1
+        # Primary key last, so pages are stable
+        return queryset.order_by(*ordering, 'pk')
+
+    def extra(self, queryset):
+        """
+        Additional response values computed over the filtered rows
+        """
+        return {}
+
+    def response(self, request):
+        params = request.GET
+        queryset = self.get_queryset()
+        filtered = self.filter(queryset, params)
+
+        start = max(to_int(params.get('start'), 0), 0)
+        length = to_int(params.get('length'), DEFAULT_PAGE_LENGTH)
+        if length < 0 or length > MAX_PAGE_LENGTH:
+            length = MAX_PAGE_LENGTH
+        page = self.order(filtered, params)[start:start + length]
+
+        data = {
+            'draw': to_int(params.get('draw'), 0),
+            'recordsTotal': queryset.count(),
+            'recordsFiltered': filtered.count(),
+            'data': [self.row(obj) for obj in page],
+        }
+        data.update(self.extra(filtered))
+        return JsonResponse(data)
+
+
+class FundTable(DataTable):
+    columns = {name: name for name in (
+        'isin', 'index_isin', 'name', 'firm', 'style', 'strategy', 'status')}
+    search_columns = ('isin', 'index_isin', 'name', 'firm')
+    filters = {name: name for name in ('status', 'style', 'strategy',
+                                       'firm')}
+
+    def get_queryset(self):
+        return Fund.objects.values(*self.columns)
+
+    def row(self, fund):
+        fund['url'] = reverse('fund-detail', args=[fund['isin']])
+        return fund
+
+
+class PortfolioTable(DataTable):
+    columns = {
+        'account_number': 'account_number',
+        'name': 'name',
+        'status': 'status',
+        'valuation_date': 'latest_valuation_date',
+        'positions': 'latest_positions',
+        'cash': 'latest_cash',
+        'invested': 'latest_invested',
+        'value': 'latest_value',
+    }
+    search_columns = ('account_number', 'name')
+    filters = {'status': 'status'}
+
+    def get_queryset(self):
+        return Portfolio.objects.with_latest_valuation()
+
+    def row(self, portfolio):
+        return {
+            'account_number': portfolio.account_number,
+            'name': portfolio.name,
+            'status': portfolio.status,
+            'valuation_date': portfolio.latest_valuation_date,
+            'positions': portfolio.latest_positions or 0,
+            'cash': portfolio.latest_cash or 0,
+            'invested': portfolio.latest_invested or 0,
+            'value': portfolio.latest_value or 0,
+        }
+
+    def extra(self, queryset):
+        # Sum of the latest values of the filtered portfolios (table footer)
+        total = queryset.aggregate(total=Sum('latest_value'))['total']
+        return {'total': total or 0}
@@ -0,0 +1,133 @@
+"""
+Target weight models.
+
+An uploaded target weights file is parsed and validated once: its weights
+are normalised (fractions of NAV, one per index ISIN) and stored in a
+TargetModel keyed by the SHA-256 of the file content and its weight unit.
+Uploading the same file again returns the stored model without parsing it,
+and the weight arrays of a model are kept per process (a model's content
+never changes).
+
+The unit of the weights (percent or fraction) is always given with the
+file: it cannot be told from the weights, as a percent file summing to
+1 or less reads as valid fractions.
+"""
+import csv
+import hashlib
+import io
+import json
+
+import numpy as np
+
+from .fundindex import get_fund_index
+from .models import TargetModel
+
+
+PERCENT = 'percent'
+FRACTION = 'fraction'
+WEIGHT_UNITS = (
+    (PERCENT, 'Percent (5 = 5%)'),
+    (FRACTION, 'Fraction of NAV (0.05 = 5%)'),
+)
+
+# Models whose weight arrays are kept in process memory
+MAX_CACHED_MODELS = 256
+
+_model_arrays = {}
+
+
+def normalise_weights(weights, unit):
+    """
+    Validate target weights given in `unit` (PERCENT or FRACTION) and
+    convert them to fractions of NAV.
+
+    Repeated index ISINs are summed. Returns (index_isins, weights) arrays.
+    """
+    if unit not in dict(WEIGHT_UNITS):
+        raise ValueError("Unknown target weight unit '%s'" % unit)
+    if not weights:
+        return np.array([], dtype=str), np.zeros(0)
+
+    index_isins = np.array([str(w['index_isin']).strip() for w in weights])
+    target = np.array([float(w['target_weight']) for w in weights])
+
+    if (target < 0).any():
+        raise ValueError('Target weights cannot be negative')
+    if unit == PERCENT:
+        target = target / 100
+    if target.sum() > 1 + 1e-6:
+        raise ValueError('Target weights sum to more than 100%')
+
+    index_isins, inverse = np.unique(index_isins, return_inverse=True)
+    return index_isins, np.bincount(inverse, weights=target)
+
+
+def read_weights_csv(f):
+    """
+    Weight dicts (index_isin, target_weight) of a target weights file with
+    ISIN and Weight columns
+    """
+    data = []
+    for line in csv.DictReader(f):
+        try:
+            data.append({'index_isin': line['ISIN'],
+                         'target_weight': line['Weight']})
+        except KeyError as e:
+            raise ValueError('Target weights file has no %s column' % e)
+    return data
+
+
+def get_target_model(content, unit, name=''):
+    """
+    TargetModel of a target weights file (`content` as bytes) with weights
+    in `unit`, parsed, validated and stored the first time the content is
+    seen.
+
+    Raises ValueError for invalid weights or index ISINs no fund tracks.
+    """
+    if unit not in dict(WEIGHT_UNITS):
+        raise ValueError("Unknown target weight unit '%s'" % unit)
+    digest = hashlib.sha256(unit.encode() + b'\n' + content).hexdigest()
+    model = TargetModel.objects.filter(content_hash=digest).first()
+    if model is not None:
+        return model
+
+    index_isins, weights = normalise_weights(read_weights_csv(
+        io.StringIO(content.decode('utf-8-sig'))), unit)
+    missing = get_fund_index().missing(index_isins)
+    if len(missing):
+        raise ValueError('No fund found for index ISIN(s): %s' % ', '.join(
+            missing))
+
+    model, _ = TargetModel.objects.get_or_create(
+        content_hash=digest, defaults={
+            'name': name[:200],
+            'weights': json.dumps(list(zip(index_isins.tolist(),
+                                           weights.tolist()))),
+        })
+    return model
+
+
+def model_arrays(model):
+    """
+    (index_isins, weights) arrays of a TargetModel
+    """
+    arrays = _model_arrays.get(model.content_hash)
+    if arrays is None:
+        pairs = model.get_weights()
+        arrays = (np.array([isin for isin, _ in pairs], dtype=str),
+                  np.array([weight for _, weight in pairs], dtype=float))
+        if len(_model_arrays) >= MAX_CACHED_MODELS:
+            _model_arrays.clear()
+        _model_arrays[model.content_hash] = arrays
+    return arrays
+
+
+def target_arrays(rebalance_weights):
+    """
+    (index_isins, weights) of a TargetModel or of a list of weight dicts
+    whose weights are fractions of NAV
+    """
+    if isinstance(rebalance_weights, TargetModel):
+        return model_arrays(rebalance_weights)
+    return normalise_weights(rebalance_weights, FRACTION)
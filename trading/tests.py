@@ -1,3 +1,1025 @@
-from django.test import TestCase
+import csv
+import datetime
+import io
+import shutil
+import tempfile
+from unittest import mock, skipIf
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models import Count, Q, Sum
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from .bbgstore import build_store, current_version, get_bbg_store, store_dir
+from .cache import CALENDARS, adopt_versions, get_versions
+from .calendars import CalendarIndex, clear_calendar_cache
+from .calendars import get_calendar_index, to_dates
+from .compliance import ASSETS_OWNED, MAX_WEIGHT, RESTRICTED, SHARES_OWNED
+from .compliance import SUB_MINIMUM, breach_codes, check_scenarios
+from .compliance import check_trades
+from .drift import refresh_drift
+from .export import DATASETS, export, pyarrow
+from .fundindex import clear_fund_index
+from .ingest import APPEND, DIFF, REPLACE, ingest_bbg_data
+from .ingest import ingest_calendar_dates, ingest_funds, ingest_positions
+from .instrumentation import BudgetExceeded, assert_budget, request_stats
+from .jobs import submit_job
+from .models import BBGData, BlockAllocation, BlockOrder, Calendar
+from .models import CalendarDate, Fund, FundHolding, Portfolio, PortfolioDrift
+from .models import PortfolioValuation, Position, ProfileCapture, TradeItem
+from .models import TradeJob
+from .orders import build_block_orders
+from .synthetic import SyntheticBook
+from .targets import FRACTION, PERCENT, get_target_model, model_arrays
+from .targets import normalise_weights
+from .trading import Book, FundTerms, TargetCandidates, calculate_scenarios
+from .trading import calculate_trades, compute_trades, portfolio_arrays
+
+
+# A Friday
+DEALING_DAY = datetime.date(2019, 8, 30)
+
+
+class TradingTestCase(TestCase):
+    """
+    Logged in client and a small SyntheticBook, with the BBG store in a
+    temporary directory
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.store_dir = tempfile.mkdtemp()
+        cls.store_settings = override_settings(BBG_STORE_DIR=cls.store_dir)
+        cls.store_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.store_settings.disable()
+        shutil.rmtree(cls.store_dir, ignore_errors=True)
+
+    def setUp(self):
+        # No FUNDS/CALENDARS bump without a commit: drop the indexes built
+        # by an earlier test
+        clear_fund_index()
+        clear_calendar_cache()
+        self.book = SyntheticBook(positions=60, per_portfolio=6, funds=20,
+                                  bbg_months=2)
+        self.user = User.objects.create_superuser(
+            'tester', 'tester@example.com', 'password')
+        self.client.force_login(self.user)
+
+    def upload(self, name, data, **fields):
+        fields['file'] = SimpleUploadedFile('%s.csv' % name, data.encode())
+        return self.client.post(reverse(name), fields)
+
+
+def create_fund(isin, **fields):
+    """
+    Fund with the terms a test does not care about filled in
+    """
+    values = {
+        'index_isin': 'INDEX_' + isin, 'name': isin, 'firm': 'Firm',
+        'style': 'Equity Hedge', 'strategy': 'Activist',
+        'terms_rank_amount': 0, 'terms_sub_notice': 0,
+        'terms_sub_settlement': 0, 'terms_sub_minimum': 0,
+        'terms_red_notice': 0, 'terms_red_settlement': 0,
+        'terms_man_fee': 0, 'terms_perf_fee': 0,
+    }
+    values.update(fields)
+    return Fund.objects.create(isin=isin, **values)
+
+
+class StoreTestCase(TestCase):
+    """
+    TestCase with the BBG store in a temporary directory of its own
+    """
+
+    def setUp(self):
+        store_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store_dir, ignore_errors=True)
+        store_settings = override_settings(BBG_STORE_DIR=store_dir)
+        store_settings.enable()
+        self.addCleanup(store_settings.disable)
+
+
+class UploadViewTests(TradingTestCase):
+
+    def test_upload_funds(self):
+        response = self.upload('upload-file', self.book.funds_csv())
+        self.assertRedirects(response, reverse('funds'))
+        self.assertEqual(Fund.objects.count(), self.book.fund_count + 1)
+
+    def test_upload_positions(self):
+        self.upload('upload-file', self.book.funds_csv())
+        Portfolio.objects.bulk_create(self.book.portfolios())
+        response = self.upload('upload-positions', self.book.positions_csv(),
+                               mode='replace')
+        self.assertRedirects(response, reverse('index'),
+                             fetch_redirect_response=False)
+        self.assertEqual(Position.objects.count(), self.book.positions)
+
+    def test_upload_bbg_data(self):
+        self.upload('upload-file', self.book.funds_csv())
+        response = self.upload('upload-bbg-data', self.book.bbg_csv())
+        self.assertRedirects(response, reverse('concentration'),
+                             fetch_redirect_response=False)
+        self.assertEqual(BBGData.objects.count(),
+                         self.book.fund_count * self.book.bbg_months)
+
+    def test_upload_calendars(self):
+        response = self.upload('upload-calendars', self.book.calendars_csv(),
+                               create_calendars='on')
+        self.assertRedirects(response, reverse('calendars'),
+                             fetch_redirect_response=False)
+        self.assertEqual(CalendarDate.objects.count(), 5 * 10 * 3)
+
+    def test_upload_rejects_lines(self):
+        self.upload('upload-file', self.book.funds_csv())
+        Portfolio.objects.bulk_create(self.book.portfolios())
+        data = self.book.positions_csv().replace('SYN000000', 'UNKNOWN')
+        response = self.upload('upload-positions', data, mode='replace')
+        messages = [str(m) for m in response.wsgi_request._messages]
+        self.assertTrue(any("unknown account 'UNKNOWN'" in m
+                            for m in messages))
+        self.assertEqual(Position.objects.count(),
+                         self.book.positions - self.book.per_portfolio)
+
+
+class CalendarCacheTests(TestCase):
+
+    def test_calendar_index_follows_adopted_version(self):
+        # A pool worker only learns of a holiday upload through the cache
+        # versions handed over with each job
+        calendar = Calendar.objects.create(code='US', name='US')
+        index = get_calendar_index()
+        with self.assertLogs('trading.calendars', 'WARNING'):
+            self.assertEqual(index.for_calendars('US').add(DEALING_DAY, 0),
+                             DEALING_DAY)
+
+        CalendarDate.objects.bulk_create([
+            CalendarDate(code=calendar, date=DEALING_DAY)])
+        version, = get_versions([CALENDARS])
+        adopt_versions({CALENDARS: version + 1})
+        self.assertEqual(
+            get_calendar_index().for_calendars('US').add(DEALING_DAY, 0),
+            datetime.date(2019, 9, 2))
+
+
+class CalendarTests(SimpleTestCase):
+
+    def setUp(self):
+        # US Labor Day and the UK August bank holiday of 2019
+        self.holidays = {'US': to_dates([datetime.date(2019, 9, 2)]),
+                         'GB': to_dates([datetime.date(2019, 8, 26)])}
+        self.index = CalendarIndex(self.holidays)
+
+    def test_add_business_days_skips_holidays(self):
+        us = self.index.for_calendars('US')
+        self.assertEqual(us.add(DEALING_DAY, 1), datetime.date(2019, 9, 3))
+        self.assertEqual(us.add(datetime.date(2019, 9, 3), -1), DEALING_DAY)
+        # Weekends and holidays roll forward for offsets >= 0, back for < 0
+        self.assertEqual(us.add(datetime.date(2019, 8, 31), 0),
+                         datetime.date(2019, 9, 3))
+        self.assertEqual(us.add(datetime.date(2019, 9, 2), -1),
+                         datetime.date(2019, 8, 29))
+
+    def test_add_business_days_matches_numpy(self):
+        dates = np.arange(np.datetime64('2019-08-01'),
+                          np.datetime64('2019-10-01'))
+        offsets = np.arange(len(dates)) % 11 - 5
+        holidays = self.holidays['US']
+        expected = np.where(
+            offsets >= 0,
+            np.busday_offset(dates, offsets, 'following', holidays=holidays),
+            np.busday_offset(dates, offsets, 'preceding', holidays=holidays))
+        np.testing.assert_array_equal(
+            self.index.for_calendars('US').add_business_days(dates, offsets),
+            expected)
+
+    def test_next_dealing_day_cutoff(self):
+        us = self.index.for_calendars('US')
+        cutoff = datetime.time(17, 30)
+        friday = datetime.datetime.combine(DEALING_DAY, cutoff)
+        self.assertEqual(us.next_dealing_day(friday, cutoff), DEALING_DAY)
+        # Past the cut-off: Monday is a holiday, so Tuesday
+        self.assertEqual(
+            us.next_dealing_day(friday + datetime.timedelta(minutes=1),
+                                cutoff),
+            datetime.date(2019, 9, 3))
+        self.assertEqual(us.next_dealing_day(DEALING_DAY, cutoff),
+                         DEALING_DAY)
+        self.assertEqual(us.next_dealing_day(datetime.date(2019, 8, 31)),
+                         datetime.date(2019, 9, 3))
+
+    def test_merged_calendars(self):
+        merged = self.index.for_calendars('US,GB')
+        self.assertIs(self.index.for_calendars('gb; us'), merged)
+        friday = datetime.date(2019, 8, 23)
+        self.assertEqual(self.index.for_calendars('US').add(friday, 1),
+                         datetime.date(2019, 8, 26))
+        self.assertEqual(merged.add(friday, 1), datetime.date(2019, 8, 27))
+        self.assertEqual(merged.add(friday, 5), datetime.date(2019, 9, 3))
+        with self.assertLogs('trading.calendars', 'WARNING'):
+            self.assertEqual(self.index.for_calendars('GB/XX').add(
+                friday, 1), datetime.date(2019, 8, 27))
+
+        np.testing.assert_array_equal(
+            self.index.add_business_days(['US', 'GB', 'GB US', ''],
+                                         [friday] * 4, 1),
+            to_dates(['2019-08-26', '2019-08-27', '2019-08-27',
+                      '2019-08-26']))
+
+
+class IngestTests(TradingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        ingest_funds(io.StringIO(self.book.funds_csv()))
+        Portfolio.objects.bulk_create(self.book.portfolios())
+        self.positions = self.book.positions_csv()
+
+    def load(self, data, mode):
+        return ingest_positions(io.StringIO(data), mode=mode)
+
+    def assert_aggregates(self):
+        """
+        PortfolioValuation and FundHolding agree with a full recount
+        """
+        valuations = {
+            (v.account_number_id, v.valuation_date):
+            (round(v.total_value, 2), round(v.cash_value, 2),
+             v.position_count)
+            for v in PortfolioValuation.objects.exclude(position_count=0)}
+        expected = {
+            (row['account_number'], row['valuation_date']):
+            (round(row['total'], 2), round(row['cash'] or 0, 2),
+             row['count'])
+            for row in Position.objects.values(
+                'account_number', 'valuation_date').annotate(
+                    total=Sum('value'), count=Count('id'),
+                    cash=Sum('value', filter=Q(flag_cash=True)))}
+        self.assertEqual(valuations, expected)
+
+        holdings = {
+            (h.isin_id, h.valuation_date):
+            (round(h.total_value, 2), h.position_count)
+            for h in FundHolding.objects.exclude(position_count=0)}
+        expected = {
+            (row['isin'], row['valuation_date']):
+            (round(row['total'], 2), row['count'])
+            for row in Position.objects.filter(flag_cash=False).values(
+                'isin', 'valuation_date').annotate(
+                    total=Sum('value'), count=Count('id'))}
+        self.assertEqual(holdings, expected)
+
+    def test_append_adds_rows(self):
+        self.load(self.positions, APPEND)
+        result = self.load(self.positions, APPEND)
+        self.assertEqual(result.inserted, self.book.positions)
+        self.assertEqual(Position.objects.count(), 2 * self.book.positions)
+        self.assert_aggregates()
+
+    def test_replace_swaps_partitions(self):
+        self.load(self.positions, APPEND)
+        self.load(self.positions, APPEND)
+        result = self.load(self.positions, REPLACE)
+        self.assertEqual(result.deleted, 2 * self.book.positions)
+        self.assertEqual(result.inserted, self.book.positions)
+        self.assertEqual(Position.objects.count(), self.book.positions)
+        self.assert_aggregates()
+
+    def test_replace_keeps_other_dates(self):
+        self.load(self.positions, REPLACE)
+        self.load(self.book.positions_csv(DEALING_DAY.replace(day=29)),
+                  REPLACE)
+        self.load(self.positions, REPLACE)
+        self.assertEqual(Position.objects.count(), 2 * self.book.positions)
+        self.assert_aggregates()
+
+    def test_diff_writes_changed_rows_only(self):
+        self.load(self.positions, REPLACE)
+        # New price on the first line, second line dropped
+        lines = self.positions.splitlines(True)
+        header, first, second, rest = lines[0], lines[1], lines[2], lines[3:]
+        first = first.split(',')
+        first[-2] = '2'
+        data = header + ','.join(first) + ''.join(rest)
+
+        result = self.load(data, DIFF)
+        self.assertEqual(
+            (result.inserted, result.updated, result.deleted,
+             result.unchanged),
+            (0, 1, 1, self.book.positions - 2))
+        self.assertEqual(Position.objects.count(), self.book.positions - 1)
+        self.assertFalse(Position.objects.filter(
+            isin=second.split(',')[1]).filter(
+                account_number=second.split(',')[0]).exists())
+        self.assert_aggregates()
+
+    def test_short_line_rejected(self):
+        # Truncated after the account number
+        account = self.book.accounts[0]
+        result = self.load(self.positions + account + '\n', APPEND)
+        self.assertEqual((result.inserted, result.rejected),
+                         (self.book.positions, 1))
+        self.assertEqual(result.rejects,
+                         [(self.book.positions + 2, "unknown ISIN ''")])
+        self.assert_aggregates()
+
+    def test_diff_of_unchanged_file_writes_nothing(self):
+        self.load(self.positions, REPLACE)
+        result = self.load(self.positions, DIFF)
+        self.assertEqual(result.unchanged, self.book.positions)
+        self.assertEqual(result.inserted + result.updated + result.deleted,
+                         0)
+
+    def test_fund_counts_and_rejects(self):
+        rows = list(csv.DictReader(io.StringIO(self.book.funds_csv())))
+        result = ingest_funds(io.StringIO(self.book.funds_csv()))
+        self.assertEqual(
+            (result.inserted, result.updated, result.unchanged),
+            (0, 0, len(rows)))
+
+        for row in rows:
+            row['terms_currency'] = 'USD'
+        rows[0]['name'] = 'Renamed'
+        new = dict(rows[1], isin='NEW', terms_calendars='')
+        long_currency = dict(rows[1], isin='LONG', terms_currency='USDX')
+        bad_style = dict(rows[1], isin='STYLE', style='Macro')
+        data = io.StringIO()
+        writer = csv.DictWriter(data, list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows + [new, long_currency, bad_style])
+        result = ingest_funds(io.StringIO(data.getvalue()))
+        self.assertEqual(
+            (result.inserted, result.updated, result.unchanged,
+             result.rejected), (1, 1, len(rows) - 1, 2))
+        self.assertEqual(result.rejects, [
+            (len(rows) + 3, "invalid terms_currency 'USDX': Ensure this "
+             "value has at most 3 characters (it has 4)."),
+            (len(rows) + 4, "invalid style 'Macro': Value 'Macro' is not a "
+             "valid choice.")])
+        self.assertEqual(Fund.objects.get(isin=rows[0]['isin']).name,
+                         'Renamed')
+        self.assertEqual(Fund.objects.get(isin='NEW').terms_calendars, '')
+        self.assertFalse(Fund.objects.filter(
+            isin__in=['LONG', 'STYLE']).exists())
+
+
+class ComputeTradesTests(SimpleTestCase):
+
+    def setUp(self):
+        self.current = np.array([60.0, 40.0])
+        self.target = np.array([0.5, 0.3])
+
+    def test_cash_subscription_follows_target_weights(self):
+        trades = compute_trades(self.current, self.target, 0, 'Cash', 100)
+        np.testing.assert_allclose(trades, [50, 30])
+
+    def test_cash_redemption_is_pro_rata(self):
+        trades = compute_trades(self.current, self.target, 0, 'Cash', -50)
+        np.testing.assert_allclose(trades, [-30, -20])
+
+    def test_rebalance_ignores_flows(self):
+        trades = compute_trades(self.current, np.array([0.5, 0.5]), 0,
+                                'Rebalance', 1000)
+        np.testing.assert_allclose(trades, [-10, 10])
+
+    def test_both_rebalances_to_post_flow_nav(self):
+        trades = compute_trades(self.current, np.array([0.5, 0.5]), 0,
+                                'Both', 100)
+        np.testing.assert_allclose(trades, [40, 60])
+
+    def test_sells_never_exceed_holding(self):
+        trades = compute_trades(self.current, np.array([0.5, 0.5]), 0,
+                                'Both', -150)
+        np.testing.assert_allclose(trades, [-60, -40])
+
+    def test_flow_scenarios(self):
+        trades = compute_trades(self.current, self.target, 0, 'Cash',
+                                [100, -50])
+        np.testing.assert_allclose(trades, [[50, 30], [-30, -20]])
+
+    def test_unknown_trade_type(self):
+        with self.assertRaises(ValueError):
+            compute_trades(self.current, self.target, 0, 'Other', 0)
+
+
+class ComplianceTests(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Portfolio.objects.create(
+            account_number='ACC1', name='Limits', guideline_max_weight=25,
+            guideline_shares_owned=5, guideline_assets_owned=10)
+        Portfolio.objects.create(account_number='ACC2', name='No limits')
+        fund = create_fund('FUND1')
+        create_fund('FUND2', flag_restricted=True, terms_sub_minimum=1000)
+        create_fund('FUND3')
+        BBGData.objects.create(isin=fund, date=DEALING_DAY, assets=10000,
+                               shares_issued=1000)
+        # Published after the trade date
+        BBGData.objects.create(
+            isin=fund, date=DEALING_DAY + datetime.timedelta(days=1),
+            assets=1, shares_issued=1)
+
+    def trade(self, isin, amount, shares, value=0, held=0, weight=0,
+              account='ACC1'):
+        return {'account_number': account, 'isin': isin,
+                'traded_amount': amount, 'traded_shares': shares,
+                'current_value': value, 'current_shares': held,
+                'post_trade_weight': weight}
+
+    def test_breach_bits(self):
+        flags = check_trades([
+            self.trade('FUND1', 100, 1, weight=0.3),
+            # 55 of 1000 shares
+            self.trade('FUND1', 100, 10, held=45),
+            # 1100 of 10000 assets
+            self.trade('FUND1', 500, 5, value=600),
+            self.trade('FUND2', 500, 5),
+            self.trade('FUND2', -500, -5, value=800, held=8),
+        ], DEALING_DAY)
+        self.assertEqual(flags.tolist(), [
+            MAX_WEIGHT, SHARES_OWNED, ASSETS_OWNED, RESTRICTED | SUB_MINIMUM,
+            0])
+        self.assertEqual(breach_codes(flags[3]), 'RESTRICTED,SUB_MINIMUM')
+
+    def test_missing_limits_never_breach(self):
+        # No guidelines on ACC2 and no BBG data for FUND3
+        flags = check_trades([
+            self.trade('FUND1', 5000, 500, weight=0.9, account='ACC2'),
+            self.trade('FUND3', 5000, 500, value=1000, held=1000),
+        ], DEALING_DAY)
+        self.assertEqual(flags.tolist(), [0, 0])
+
+    def test_no_trades(self):
+        self.assertEqual(len(check_trades([], DEALING_DAY)), 0)
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        for account in ('ACC1', 'ACC2'):
+            Portfolio.objects.create(account_number=account, name=account)
+        fund = create_fund('FUND1')
+        positions = [
+            Position(account_number_id=account, isin=fund, value=100.5 * i,
+                     shares=i, price=100.5,
+                     valuation_date=DEALING_DAY - datetime.timedelta(days=i))
+            for i in range(1, 6) for account in ('ACC1', 'ACC2')]
+        positions.append(Position(account_number_id='ACC1', flag_cash=True,
+                                  value=250, shares=250, price=1,
+                                  valuation_date=DEALING_DAY))
+        Position.objects.bulk_create(positions)
+        self.expected = list(Position.objects.filter(
+            account_number='ACC1').order_by(
+                'valuation_date', 'pk').values_list(
+                    'valuation_date', 'account_number', 'isin', 'flag_cash',
+                    'value', 'shares', 'price'))
+
+    @mock.patch('trading.export.CHUNK_SIZE', 2)
+    def test_csv_round_trip(self):
+        chunks, content_type, filename = export('positions', 'csv',
+                                                account='ACC1')
+        chunks = list(chunks)
+        self.assertEqual((content_type, filename),
+                         ('text/csv', 'positions.csv'))
+        # Header and three chunks of two rows
+        self.assertEqual(len(chunks), 4)
+
+        header, *rows = csv.reader(io.StringIO(''.join(chunks)))
+        self.assertEqual(header, DATASETS['positions'].names)
+        self.assertEqual([
+            (datetime.date.fromisoformat(date), account, isin or None,
+             cash == 'True', float(value), float(shares), float(price))
+            for date, account, isin, cash, value, shares, price in rows],
+            self.expected)
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    @mock.patch('trading.export.ROW_GROUP_SIZE', 2)
+    def test_parquet_round_trip(self):
+        chunks, content_type, filename = export('positions', 'parquet',
+                                                account='ACC1')
+        self.assertEqual(filename, 'positions.parquet')
+        parquet = pyarrow.parquet.ParquetFile(
+            pyarrow.BufferReader(b''.join(chunks)))
+        self.assertEqual(parquet.metadata.num_row_groups, 3)
+
+        table = parquet.read()
+        self.assertEqual(table.schema.names, DATASETS['positions'].names)
+        self.assertEqual(list(zip(*table.to_pydict().values())),
+                         self.expected)
+
+    def test_invalid_requests(self):
+        with self.assertRaises(ValueError):
+            export('funds')
+        with self.assertRaises(ValueError):
+            export('positions', 'xlsx')
+        with self.assertRaises(ValueError):
+            export('bbg', account='ACC1')
+
+
+class BBGStoreTests(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for isin in ('FUND1', 'FUND2', 'FUND3'):
+            create_fund(isin)
+
+    def add(self, isin, days, assets, shares_issued=10):
+        BBGData.objects.create(
+            isin_id=isin, date=DEALING_DAY + datetime.timedelta(days=days),
+            assets=assets, shares_issued=shares_issued)
+
+    def test_as_of(self):
+        self.add('FUND1', -10, 100)
+        self.add('FUND1', 0, 200)
+        self.add('FUND2', -5, 50)
+        store, added = build_store()
+        self.assertEqual(added, 3)
+
+        day = np.datetime64(DEALING_DAY, 'D')
+        dates, assets, _ = store.as_of(
+            ['FUND1', 'FUND1', 'FUND1', 'FUND2', 'FUND3'],
+            [day - 20, day - 1, day + 3, day, day])
+        np.testing.assert_array_equal(assets, [np.nan, 100, 200, 50, np.nan])
+        np.testing.assert_array_equal(dates, np.array(
+            ['NaT', day - 10, day, day - 5, 'NaT'], dtype='datetime64[D]'))
+
+        # One date for every ISIN
+        _, assets, shares_issued = store.as_of(['FUND2', 'FUND1'], day)
+        np.testing.assert_array_equal(assets, [50, 200])
+        np.testing.assert_array_equal(shares_issued, [10, 10])
+
+    def test_incremental_build_matches_full_build(self):
+        self.add('FUND1', -10, 100)
+        self.add('FUND2', -5, 50)
+        store, _ = build_store()
+
+        # A correction of a stored day, a new day and a new fund
+        self.add('FUND2', -5, 60)
+        self.add('FUND1', -3, 150)
+        self.add('FUND3', -1, 30)
+        merged, added = build_store(store)
+        self.assertEqual(added, 3)
+
+        full, _ = build_store()
+        for column in ('isins', 'keys', 'assets', 'shares_issued'):
+            np.testing.assert_array_equal(getattr(merged, column),
+                                          getattr(full, column))
+        self.assertEqual((merged.last_id, merged.source_rows),
+                         (full.last_id, full.source_rows))
+        _, assets, _ = merged.as_of(['FUND2'], DEALING_DAY)
+        self.assertEqual(assets.tolist(), [60])
+
+    def test_deleted_rows_rebuild(self):
+        self.add('FUND1', -10, 100)
+        self.add('FUND2', -5, 50)
+        store, _ = build_store()
+
+        BBGData.objects.filter(isin='FUND2').delete()
+        with self.assertLogs('trading.bbgstore', 'INFO'):
+            store, added = build_store(store)
+        self.assertEqual(added, 1)
+        self.assertEqual(store.isins.tolist(), ['FUND1'])
+
+    def test_saved_store_follows_new_rows(self):
+        self.add('FUND1', -10, 100)
+        store = get_bbg_store()
+        self.assertEqual(current_version(store_dir()), store.version)
+        self.assertIs(get_bbg_store(), store)
+
+        self.add('FUND1', 0, 200)
+        refreshed = get_bbg_store()
+        self.assertNotEqual(refreshed.version, store.version)
+        self.assertEqual(refreshed.rows, 2)
+        _, assets, _ = refreshed.as_of(['FUND1'], DEALING_DAY)
+        self.assertEqual(assets.tolist(), [200])
+
+
+class ScenarioTests(StoreTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.portfolio = Portfolio.objects.create(
+            account_number='ACC1', name='Scenarios', guideline_max_weight=55)
+        fund = create_fund('FUND1', index_isin='INDEX1')
+        restricted = create_fund('FUND2', index_isin='INDEX2',
+                                 flag_restricted=True)
+        # Funds saved in a test never commit, so the FUNDS version stays
+        # the same: rebuild the fund index with these funds
+        clear_fund_index()
+        # NAV per share of 50
+        BBGData.objects.create(isin=restricted, date=DEALING_DAY,
+                               assets=1000, shares_issued=20)
+        Position.objects.bulk_create([
+            Position(account_number=self.portfolio, isin=fund, value=6000,
+                     shares=60, price=100, valuation_date=DEALING_DAY),
+            Position(account_number=self.portfolio, flag_cash=True,
+                     value=4000, shares=4000, price=1,
+                     valuation_date=DEALING_DAY),
+        ])
+        self.positions = Position.objects.filter(
+            account_number=self.portfolio)
+        self.weights = [{'index_isin': 'INDEX1', 'target_weight': 0.5},
+                        {'index_isin': 'INDEX2', 'target_weight': 0.4}]
+        self.flows = [-2000, 0, 5000]
+
+    def scenarios(self, trade_type):
+        return calculate_scenarios(self.portfolio, self.positions,
+                                   self.weights, trade_type, self.flows,
+                                   DEALING_DAY)
+
+    def test_sweep(self):
+        scenarios = self.scenarios('Both')
+        self.assertEqual(scenarios['isins'].tolist(), ['FUND1', 'FUND2'])
+        np.testing.assert_allclose(scenarios['amounts'], [
+            [-2000, 3200], [-1000, 4000], [1500, 6000]])
+        np.testing.assert_allclose(scenarios['shares'], [
+            [-20, 64], [-10, 80], [15, 120]])
+        np.testing.assert_allclose(scenarios['post_weights'][2], [0.5, 0.4])
+
+    def test_rows_match_single_calculations(self):
+        scenarios = self.scenarios('Cash')
+        for flow, amounts in zip(self.flows, scenarios['amounts']):
+            trades = {t['isin']: t['traded_amount'] for t in calculate_trades(
+                self.portfolio, self.positions, self.weights, 'Cash', flow,
+                DEALING_DAY)}
+            np.testing.assert_allclose(
+                amounts, [trades.get(isin, 0) for isin in scenarios['isins']])
+
+    def test_breaches_only_where_traded(self):
+        # FUND1 stays at 60% of NAV when the flow is 0, but is not traded
+        flags = check_scenarios('ACC1', self.scenarios('Cash'), DEALING_DAY)
+        self.assertEqual(flags.tolist(), [
+            [MAX_WEIGHT, 0], [0, 0], [MAX_WEIGHT, RESTRICTED]])
+
+
+@override_settings(TRADING_JOBS_EAGER=True)
+class JobTests(TradingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        book = self.book
+        ingest_funds(io.StringIO(book.funds_csv()))
+        ingest_calendar_dates(io.StringIO(book.calendars_csv()),
+                              create_calendars=True)
+        ingest_bbg_data(io.StringIO(book.bbg_csv()))
+        Portfolio.objects.bulk_create(book.portfolios())
+        ingest_positions(io.StringIO(book.positions_csv()), mode=REPLACE)
+        self.model = get_target_model(book.target_weights_csv(5).encode(),
+                                      PERCENT)
+
+    def submit(self, kind, **params):
+        params.update({'trade_type': 'Both',
+                       'trade_date': DEALING_DAY.isoformat(),
+                       'model': self.model.pk})
+        return submit_job(kind, params)
+
+    def test_trades_job(self):
+        account = self.book.accounts[0]
+        job = self.submit('trades', account=account, net_flows=100000)
+        self.assertEqual(job.status, 'Done', job.error)
+
+        items = TradeItem.objects.filter(run=job)
+        result = job.get_result()
+        self.assertEqual(items.count(), result['trades'])
+        self.assertGreater(result['trades'], 0)
+        self.assertEqual(set(items.values_list('account_number', flat=True)),
+                         {account})
+        self.assertAlmostEqual(
+            sum(items.values_list('traded_amount', flat=True)),
+            result['subscriptions'] + result['redemptions'], places=2)
+
+    def test_batch_job(self):
+        job = self.submit('batch', accounts=self.book.accounts,
+                          net_flows=0)
+        self.assertEqual(job.status, 'Done', job.error)
+        result = job.get_result()
+        self.assertEqual(set(result['portfolios']), set(self.book.accounts))
+        self.assertEqual(TradeItem.objects.filter(run=job).count(),
+                         result['trades'])
+
+    def test_failed_job(self):
+        with self.assertLogs('trading.jobs', 'ERROR'):
+            job = self.submit('trades', account='MISSING', net_flows=0)
+        self.assertEqual(job.status, 'Failed')
+        self.assertTrue(job.error)
+        self.assertIsNotNone(job.finished_at)
+
+
+class BudgetTests(TradingTestCase):
+    """
+    Pages stay within their request budgets (settings
+    .TRADING_REQUEST_BUDGETS) over a loaded book
+    """
+
+    def setUp(self):
+        super().setUp()
+        book = self.book
+        ingest_funds(io.StringIO(book.funds_csv()))
+        ingest_calendar_dates(io.StringIO(book.calendars_csv()),
+                              create_calendars=True)
+        Portfolio.objects.bulk_create(book.portfolios())
+        ingest_positions(io.StringIO(book.positions_csv()), mode=REPLACE)
+        request_stats.clear()
+
+    def test_views_within_budget(self):
+        urls = [
+            ('index', reverse('index')),
+            ('funds', reverse('funds')),
+            ('funds-json', reverse('funds-json') + '?draw=1&start=0'
+             '&length=50'),
+            ('portfolios', reverse('portfolios')),
+            ('portfolios-json', reverse('portfolios-json') + '?draw=1'
+             '&start=0&length=50'),
+            ('trades', reverse('trades')),
+            ('liquidity', reverse('liquidity')),
+            ('block-orders', reverse('block-orders')),
+            ('drift', reverse('drift') + '?all=1'),
+        ]
+        for view_name, url in urls:
+            with self.subTest(view_name):
+                with assert_budget(view_name):
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+
+    def test_assert_budget_raises_over_budget(self):
+        with self.assertRaises(BudgetExceeded):
+            with assert_budget(queries=1):
+                list(Fund.objects.all())
+                list(Portfolio.objects.all())
+
+    def test_middleware_records_requests(self):
+        response = self.client.get(reverse('portfolios'))
+        self.assertIn('total;dur=', response['Server-Timing'])
+
+        row, = [row for row in request_stats.summary()
+                if row['view'] == 'portfolios']
+        self.assertEqual(row['requests'], 1)
+        self.assertEqual(row['over_budget'], 0)
+        self.assertGreater(row['stats']['queries']['max'], 0)
+        self.assertGreater(row['stats']['wall_ms']['max'], 0)
+        self.assertGreater(row['stats']['render_ms']['max'], 0)
+
+    def test_middleware_warns_over_budget(self):
+        budgets = {'portfolios': {'queries': 0}}
+        with override_settings(TRADING_REQUEST_BUDGETS=budgets):
+            with self.assertLogs('trading.instrumentation', 'WARNING'):
+                self.client.get(reverse('portfolios'))
+        row, = [row for row in request_stats.summary()
+                if row['view'] == 'portfolios']
+        self.assertEqual(row['over_budget'], 1)
+
+
+class BlockOrderTests(TradingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        ingest_funds(io.StringIO(self.book.funds_csv()))
+        Portfolio.objects.bulk_create(self.book.portfolios())
+        self.amount_fund, self.units_fund = Fund.objects.filter(
+            terms_sub_minimum=0).exclude(isin='CASH')[:2]
+        Fund.objects.filter(pk=self.amount_fund.pk).update(
+            flag_units_trading=False)
+        Fund.objects.filter(pk=self.units_fund.pk).update(
+            flag_units_trading=True)
+
+    def trade(self, run, account, fund, amount, shares):
+        return TradeItem.objects.create(
+            run=run, account_number_id=account, isin=fund,
+            notice_date=DEALING_DAY, trade_date=DEALING_DAY,
+            settlement_date=DEALING_DAY, traded_amount=amount,
+            traded_shares=shares,
+            trade_note='Subscription' if amount > 0 else 'Redemption')
+
+    def test_nets_and_crosses(self):
+        run = TradeJob.objects.create()
+        accounts = self.book.accounts
+        self.trade(run, accounts[0], self.amount_fund, 300, 3)
+        self.trade(run, accounts[1], self.amount_fund, -100, -1)
+        self.trade(run, accounts[0], self.units_fund, 200, 2)
+        self.trade(run, accounts[1], self.units_fund, -100, -2)
+
+        self.assertEqual(build_block_orders(DEALING_DAY), 2)
+        amounts = BlockOrder.objects.get(isin=self.amount_fund)
+        self.assertEqual((amounts.status, amounts.side, amounts.net_amount),
+                         ('Open', 'Subscription', 200))
+        self.assertEqual(amounts.accounts, 2)
+        # Netted on shares: 2 bought, 2 sold
+        units = BlockOrder.objects.get(isin=self.units_fund)
+        self.assertEqual(units.status, 'Crossed')
+        self.assertEqual(
+            set(units.allocations.values_list('external_shares', flat=True)),
+            {0})
+
+    def test_units_trade_without_shares_is_flagged(self):
+        run = TradeJob.objects.create()
+        self.trade(run, self.book.accounts[0], self.units_fund, 500, 0)
+        self.trade(run, self.book.accounts[1], self.units_fund, -100, -1)
+
+        build_block_orders(DEALING_DAY)
+        order = BlockOrder.objects.get(isin=self.units_fund)
+        self.assertEqual((order.status, order.side), ('No price',
+                                                      'Subscription'))
+        self.assertEqual(
+            set(order.allocations.values_list('crossed_amount', flat=True)),
+            {0})
+
+    def test_rebuild_of_runs_keeps_other_blocks(self):
+        first, second = TradeJob.objects.create(), TradeJob.objects.create()
+        self.trade(first, self.book.accounts[0], self.amount_fund, 100, 1)
+        self.trade(second, self.book.accounts[1], self.units_fund, 100, 1)
+        build_block_orders(DEALING_DAY, runs=[first.pk])
+        build_block_orders(DEALING_DAY, runs=[second.pk])
+
+        build_block_orders(DEALING_DAY, runs=[second.pk])
+        self.assertEqual(
+            set(BlockOrder.objects.values_list('isin', flat=True)),
+            {self.amount_fund.pk, self.units_fund.pk})
+        self.assertEqual(BlockAllocation.objects.count(), 2)
+
+    def test_rerun_replaces_earlier_trades(self):
+        accounts = self.book.accounts
+        batch = TradeJob.objects.create()
+        self.trade(batch, accounts[0], self.amount_fund, 300, 3)
+        self.trade(batch, accounts[1], self.amount_fund, -100, -1)
+        # The first portfolio run again on its own
+        single = TradeJob.objects.create()
+        self.trade(single, accounts[0], self.amount_fund, 500, 5)
+
+        self.assertEqual(build_block_orders(DEALING_DAY), 1)
+        order = BlockOrder.objects.get()
+        self.assertEqual((order.net_amount, order.accounts), (400, 2))
+        self.assertEqual(
+            set(order.allocations.values_list('trade__run', flat=True)),
+            {batch.pk, single.pk})
+
+    def test_rebuild_of_runs_nets_whole_blocks(self):
+        accounts = self.book.accounts
+        first = TradeJob.objects.create()
+        self.trade(first, accounts[0], self.amount_fund, 300, 3)
+        build_block_orders(DEALING_DAY)
+
+        second = TradeJob.objects.create()
+        self.trade(second, accounts[1], self.amount_fund, -100, -1)
+        self.assertEqual(build_block_orders(DEALING_DAY, runs=[second.pk]),
+                         1)
+        order = BlockOrder.objects.get()
+        self.assertEqual((order.net_amount, order.accounts), (200, 2))
+
+        # The first portfolio run again, now only trading the units fund
+        third = TradeJob.objects.create()
+        self.trade(third, accounts[0], self.units_fund, 100, 1)
+        self.assertEqual(build_block_orders(DEALING_DAY, runs=[third.pk]),
+                         2)
+        self.assertEqual(
+            BlockOrder.objects.get(isin=self.amount_fund).net_amount, -100)
+        self.assertEqual(
+            BlockOrder.objects.get(isin=self.units_fund).net_amount, 100)
+        self.assertEqual(BlockAllocation.objects.count(), 2)
+
+
+class TargetWeightTests(TradingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        ingest_funds(io.StringIO(self.book.funds_csv()))
+        self.index_isins = sorted(set(self.book.index_isins.tolist()))[:2]
+        self.data = 'ISIN,Weight\n%s,0.5\n%s,0.25\n' % tuple(
+            self.index_isins)
+
+    def test_percent_weights_summing_under_one(self):
+        weights = [{'index_isin': isin, 'target_weight': weight}
+                   for isin, weight in zip(self.index_isins, (0.5, 0.25))]
+        _, percent = normalise_weights(weights, PERCENT)
+        _, fraction = normalise_weights(weights, FRACTION)
+        np.testing.assert_allclose(percent, [0.005, 0.0025])
+        np.testing.assert_allclose(fraction, [0.5, 0.25])
+
+    def test_fractions_over_one_rejected(self):
+        weights = [{'index_isin': isin, 'target_weight': 60}
+                   for isin in self.index_isins]
+        with self.assertRaises(ValueError):
+            normalise_weights(weights, FRACTION)
+        with self.assertRaises(ValueError):
+            normalise_weights(weights, 'auto')
+
+    def test_model_per_content_and_unit(self):
+        percent = get_target_model(self.data.encode(), PERCENT)
+        fraction = get_target_model(self.data.encode(), FRACTION)
+        self.assertNotEqual(percent.pk, fraction.pk)
+        self.assertEqual(get_target_model(self.data.encode(), PERCENT).pk,
+                         percent.pk)
+
+    def test_form_requires_unit(self):
+        Portfolio.objects.bulk_create(self.book.portfolios())
+        response = self.client.post(reverse('generate-trades'), {
+            'account': self.book.accounts[0],
+            'trade_date': DEALING_DAY.isoformat(), 'net_flows': 0,
+            'trade_type': 'Both',
+            'target_weights_file': SimpleUploadedFile(
+                'weights.csv', self.data.encode())})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('weight_unit', response.context['form'].errors)
+
+    def test_inactive_funds_not_targeted(self):
+        create_fund('CLOSED', index_isin='INDEX_NEW', status='Inactive')
+        clear_fund_index()
+        data = b'ISIN,Weight\nINDEX_NEW,0.5\n'
+        with self.assertRaisesMessage(ValueError, 'INDEX_NEW'):
+            get_target_model(data, FRACTION)
+
+        create_fund('OPEN', index_isin='INDEX_NEW', terms_rank=2)
+        clear_fund_index()
+        model = get_target_model(data, FRACTION)
+        index_isins, weights = model_arrays(model)
+        candidates = TargetCandidates.load(index_isins)
+        # The held Inactive class is redeemed into the Active one
+        book = Book(np.array(['CLOSED']), np.array([1000.0]),
+                    np.array([10.0]), np.array([100.0]), 0.0)
+        universe, _, _, _, target = portfolio_arrays(
+            book, index_isins, weights, candidates,
+            FundTerms.load(np.array(['CLOSED', 'OPEN']), DEALING_DAY))
+        self.assertEqual(universe.tolist(), ['CLOSED', 'OPEN'])
+        self.assertEqual(target.tolist(), [0, 0.5])
+
+
+class DriftTests(TradingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        book = self.book
+        ingest_funds(io.StringIO(book.funds_csv()))
+        ingest_calendar_dates(io.StringIO(book.calendars_csv()),
+                              create_calendars=True)
+        Portfolio.objects.bulk_create(book.portfolios())
+        ingest_positions(io.StringIO(book.positions_csv()), mode=REPLACE)
+        self.model = get_target_model(book.target_weights_csv(5).encode(),
+                                      PERCENT)
+        self.portfolio = Portfolio.objects.get(pk=book.accounts[0])
+        self.portfolio.target_model = self.model
+        self.portfolio.save()
+        refresh_drift()
+
+    def drift(self):
+        return PortfolioDrift.objects.get(pk=self.portfolio.pk)
+
+    def test_refresh_clears_dirty(self):
+        drift = self.drift()
+        self.assertFalse(drift.dirty)
+        self.assertEqual(drift.target_model, self.model)
+        self.assertGreater(drift.max_drift, 0)
+
+    def test_name_change_keeps_row_clean(self):
+        self.portfolio.name = 'Renamed'
+        self.portfolio.save()
+        self.assertFalse(self.drift().dirty)
+
+    def test_tolerance_change_marks_dirty(self):
+        self.portfolio.drift_tolerance = 5
+        self.portfolio.save()
+        self.assertTrue(self.drift().dirty)
+
+    def test_model_removed_drops_row(self):
+        self.portfolio.target_model = None
+        self.portfolio.save()
+        self.assertFalse(PortfolioDrift.objects.filter(
+            pk=self.portfolio.pk).exists())
+
+    def test_unchanged_reload_keeps_row_clean(self):
+        ingest_positions(io.StringIO(self.book.positions_csv()),
+                         mode=REPLACE)
+        self.assertFalse(self.drift().dirty)
+        self.assertEqual(refresh_drift(), 0)
+
+
+class ProfilerTests(TradingTestCase):
+
+    def test_profile_switch(self):
+        url = reverse('portfolios')
+        cases = [
+            ({'_profile': '1'}, {}, True),
+            ({}, {'HTTP_X_PROFILE': '1'}, True),
+            ({'_profile': '0'}, {}, False),
+            ({'_profile': ''}, {}, False),
+            ({}, {'HTTP_X_PROFILE': '0'}, False),
+            ({}, {}, False),
+        ]
+        for params, headers, profiled in cases:
+            with self.subTest(params=params, headers=headers):
+                response = self.client.get(url, params, **headers)
+                self.assertEqual('X-Profile-Id' in response, profiled)
+        self.assertEqual(ProfileCapture.objects.count(), 2)
+
+    def test_staff_only(self):
+        user = User.objects.create_user('viewer', password='password')
+        self.client.force_login(user)
+        response = self.client.get(reverse('portfolios'), {'_profile': '1'})
+        self.assertNotIn('X-Profile-Id', response)
+        self.assertFalse(ProfileCapture.objects.exists())
@@ -1,2 +1,505 @@
-def calculate_trades():
-    pass
+"""
+Trade calculation engine.
+
+Positions and target weights are loaded once into NumPy arrays aligned on a
+single fund universe (funds held + funds targeted) and the trades for the
+whole portfolio are computed in one vectorized pass.
+
+Database access (load_books, TargetCandidates.load, FundTerms.load) is kept
+apart from the calculation (portfolio_trades), which only needs picklable
+arrays so batches of portfolios can be fanned out over a process pool.
+"""
+import time
+
+import numpy as np
+
+from .bbgstore import get_bbg_store
+from .calendars import get_calendar_index
+from .fundindex import get_fund_index
+from .models import Fund, Position
+from .targets import target_arrays
+
+
+TRADE_TYPES = ('Cash', 'Rebalance', 'Both')
+
+# Trades smaller than this (in portfolio currency) are not generated
+MIN_TRADE_AMOUNT = 0.01
+
+POSITION_COLUMNS = ('account_number', 'isin', 'flag_cash', 'value', 'shares',
+                    'price', 'valuation_date')
+
+
+class Book:
+    """
+    Current (non-cash) holdings of a portfolio as parallel arrays, one entry
+    per fund, plus the cash balance.
+    """
+
+    def __init__(self, isins, values, shares, prices, cash,
+                 valuation_date=None):
+        self.isins = isins
+        self.values = values
+        self.shares = shares
+        self.prices = prices
+        self.cash = cash
+        self.valuation_date = valuation_date
+
+    # Methods
+    @property
+    def nav(self):
+        return float(self.values.sum()) + self.cash
+
+    @classmethod
+    def empty(cls):
+        return cls(np.array([], dtype=str), np.zeros(0), np.zeros(0),
+                   np.zeros(0), 0.0)
+
+
+def _build_book(isins, flag_cash, values, shares, prices, dates):
+    """
+    Book from the position arrays of one portfolio (latest date only)
+    """
+    latest = dates.max()
+    current = dates == latest
+    cash = float(values[current & flag_cash].sum())
+
+    held = current & ~flag_cash & (isins != None)  # noqa: E711
+    fund_isins, inverse = np.unique(isins[held].astype(str),
+                                    return_inverse=True)
+    fund_prices = np.zeros(len(fund_isins))
+    fund_prices[inverse] = prices[held]
+
+    return Book(
+        fund_isins,
+        np.bincount(inverse, weights=values[held],
+                    minlength=len(fund_isins)),
+        np.bincount(inverse, weights=shares[held],
+                    minlength=len(fund_isins)),
+        fund_prices,
+        cash,
+        latest.item())
+
+
+def load_books(positions):
+    """
+    Build a Book per account number from a Position queryset (one query).
+
+    Only the latest valuation_date of each account is used, and lines for
+    the same fund are summed.
+    """
+    rows = list(positions.values_list(*POSITION_COLUMNS))
+    if not rows:
+        return {}
+
+    accounts, isins, flag_cash, values, shares, prices, dates = zip(*rows)
+    accounts = np.array(accounts, dtype=object).astype(str)
+    isins = np.array(isins, dtype=object)
+    flag_cash = np.array(flag_cash, dtype=bool)
+    values = np.array(values, dtype=float)
+    shares = np.array(shares, dtype=float)
+    prices = np.array(prices, dtype=float)
+    dates = np.array(dates, dtype='datetime64[D]')
+
+    # Group the rows by account: sort once, then slice
+    order = np.argsort(accounts, kind='stable')
+    sorted_accounts = accounts[order]
+    starts = np.flatnonzero(
+        np.r_[True, sorted_accounts[1:] != sorted_accounts[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+
+    books = {}
+    for start, end in zip(starts, ends):
+        rows = order[start:end]
+        books[sorted_accounts[start]] = _build_book(
+            isins[rows], flag_cash[rows], values[rows], shares[rows],
+            prices[rows], dates[rows])
+    return books
+
+
+def load_book(positions):
+    """
+    Build a Book from the Position queryset of a single portfolio
+    """
+    books = load_books(positions)
+    return next(iter(books.values())) if books else Book.empty()
+
+
+class TargetCandidates:
+    """
+    Funds (share classes) tracking a set of index ISINs
+    """
+
+    def __init__(self, isins, index_isins, inactive, ranks):
+        self.isins = isins
+        self.index_isins = index_isins
+        self.inactive = inactive
+        self.ranks = ranks
+
+    @classmethod
+    def load(cls, index_isins):
+        return cls(*get_fund_index().candidates(index_isins))
+
+    # Methods
+    def resolve(self, index_isins, held_isins):
+        """
+        Map each index ISIN to the fund that should be traded.
+
+        Only Active funds are traded into: an Active fund already held in
+        the portfolio is preferred, then the others by terms_rank. A held
+        Inactive share class is never a target, so it stays in the
+        portfolio's universe with no target weight and is only redeemed.
+        Returns an array of fund ISINs aligned on `index_isins` (None where
+        no Active fund tracks the index ISIN).
+        """
+        resolved = np.full(len(index_isins), None, dtype=object)
+        active = ~self.inactive
+        if not active.any() or not len(index_isins):
+            return resolved
+
+        isins, ranks = self.isins[active], self.ranks[active]
+        tracked = self.index_isins[active]
+        not_held = ~np.isin(isins, held_isins)
+
+        # Best candidate first within each index ISIN, then keep the first
+        order = np.lexsort((isins, ranks, not_held, tracked))
+        idx_sorted = tracked[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = idx_sorted[1:] != idx_sorted[:-1]
+        best_idx, best_isin = idx_sorted[first], isins[order][first]
+
+        wanted = np.isin(best_idx, index_isins)
+        resolved[np.searchsorted(index_isins, best_idx[wanted])] = \
+            best_isin[wanted]
+        return resolved
+
+
+def resolve_index_isins(index_isins, held_isins):
+    """
+    Map each index ISIN to the fund (share class) that should be traded
+    """
+    return TargetCandidates.load(index_isins).resolve(index_isins, held_isins)
+
+
+class FundTerms:
+    """
+    Subscription and redemption notice, dealing and settlement dates of a
+    set of funds for one trade date, sorted by ISIN.
+
+    The dealing date is the trade date rolled to a business day of each
+    fund's calendars; notice and settlement dates are offset from it by the
+    fund's terms in business days. `prices` are the funds' NAV per share
+    (BBG assets / shares issued as of the trade date, NaN when unknown).
+    """
+
+    def __init__(self, isins, subscription_dates, redemption_dates,
+                 prices=None):
+        self.isins = isins
+        self.subscription_dates = subscription_dates
+        self.redemption_dates = redemption_dates
+        self.prices = (np.full(len(isins), np.nan) if prices is None
+                       else prices)
+
+    @classmethod
+    def load(cls, isins, trade_date):
+        terms = list(Fund.objects.filter(isin__in=list(isins)).order_by(
+            'isin').values_list(
+                'isin', 'terms_calendars', 'terms_sub_notice',
+                'terms_sub_settlement', 'terms_red_notice',
+                'terms_red_settlement'))
+        if not terms:
+            empty = np.array([], dtype='datetime64[D]')
+            return cls(np.array([], dtype=str), (empty,) * 3, (empty,) * 3)
+
+        isins, calendars, sub_notice, sub_settle, red_notice, red_settle = (
+            np.array(column) for column in zip(*terms))
+
+        index = get_calendar_index()
+        dealing = index.roll_forward(calendars,
+                                     np.full(len(terms), trade_date))
+        isins = isins.astype(str)
+        _, assets, shares_issued = get_bbg_store().as_of(isins, trade_date)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prices = np.where(shares_issued > 0, assets / shares_issued,
+                              np.nan)
+        return cls(
+            isins,
+            (index.add_business_days(calendars, dealing, -sub_notice),
+             dealing,
+             index.add_business_days(calendars, dealing, sub_settle)),
+            (index.add_business_days(calendars, dealing, -red_notice),
+             dealing,
+             index.add_business_days(calendars, dealing, red_settle)),
+            prices)
+
+    # Methods
+    def dates(self, isins, subscription):
+        """
+        (notice, dealing, settlement) date arrays for trades in `isins`
+        """
+        rows = np.searchsorted(self.isins, isins)
+        return tuple(np.where(subscription, sub[rows], red[rows])
+                     for sub, red in zip(self.subscription_dates,
+                                         self.redemption_dates))
+
+    def nav_prices(self, isins):
+        """
+        NAV per share of `isins` (0 when unknown)
+        """
+        if not len(self.isins):
+            return np.zeros(len(isins))
+        rows = np.minimum(np.searchsorted(self.isins, isins),
+                          len(self.isins) - 1)
+        prices = np.where(self.isins[rows] == isins, self.prices[rows], 0)
+        return np.nan_to_num(prices)
+
+
+def trade_dates(isins, subscription, trade_date):
+    """
+    Notice, dealing and settlement dates for trades in `isins`
+    """
+    return FundTerms.load(isins, trade_date).dates(isins, subscription)
+
+
+def compute_trades(current, target_weights, cash, trade_type, net_flows):
+    """
+    Vectorized trade amounts for one portfolio.
+
+    `current` and `target_weights` are aligned arrays over the fund
+    universe. Cash only invests/raises `net_flows` (subscriptions along the
+    target weights, redemptions pro-rata to current weights), Rebalance
+    moves the current NAV to the target weights and Both rebalances to the
+    post-flow NAV. Sells never exceed the current holding.
+
+    `net_flows` may also be an array of S scenarios, the result is then an
+    S x funds matrix.
+    """
+    if trade_type not in TRADE_TYPES:
+        raise ValueError("Unknown trade type '%s'" % trade_type)
+
+    nav = current.sum() + cash
+    flows = np.asarray(net_flows, dtype=float)[..., np.newaxis]
+    if trade_type == 'Cash':
+        redemptions = (current / nav if nav > 0
+                       else np.zeros_like(current))
+        trades = np.where(flows >= 0, flows * target_weights,
+                          flows * redemptions)
+    elif trade_type == 'Rebalance':
+        trades = target_weights * nav - current + np.zeros_like(flows)
+    else:
+        trades = target_weights * (nav + flows) - current
+
+    return np.maximum(trades, -current)
+
+
+def portfolio_arrays(book, index_isins, weights, candidates, terms):
+    """
+    Fund universe of a portfolio (funds held + funds targeted) and the
+    current values, shares held, prices and target weights aligned on it
+    """
+    target_isins = candidates.resolve(index_isins, book.isins)
+
+    unmapped = target_isins == None  # noqa: E711 (element-wise)
+    if unmapped.any():
+        raise ValueError('No fund found for index ISIN(s): %s' % ', '.join(
+            index_isins[unmapped]))
+
+    target_isins = target_isins.astype(str)
+    universe = np.union1d(book.isins, target_isins)
+    held = np.searchsorted(universe, book.isins)
+    current = np.zeros(len(universe))
+    current[held] = book.values
+    held_shares = np.zeros(len(universe))
+    held_shares[held] = book.shares
+    # Position prices, or the BBG NAV per share for funds not held
+    prices = terms.nav_prices(universe)
+    prices[held] = np.where(book.prices > 0, book.prices, prices[held])
+    target = np.zeros(len(universe))
+    np.add.at(target, np.searchsorted(universe, target_isins), weights)
+    return universe, current, held_shares, prices, target
+
+
+def portfolio_trades(account_number, book, index_isins, weights, candidates,
+                     terms, trade_type, trade_amount):
+    """
+    Generate the trades of one portfolio from preloaded arrays (no queries).
+
+    Returns a list of trade dicts (JSON serialisable), one per fund with a
+    non-zero trade.
+    """
+    universe, current, held_shares, prices, target = portfolio_arrays(
+        book, index_isins, weights, candidates, terms)
+
+    amounts = compute_trades(current, target, book.cash, trade_type,
+                             trade_amount)
+    shares = np.divide(amounts, prices, out=np.zeros(len(universe)),
+                       where=prices > 0)
+
+    nav = book.nav
+    post_nav = nav + (trade_amount if trade_type != 'Rebalance' else 0)
+    current_weights = current / nav if nav else np.zeros(len(universe))
+    post_weights = ((current + amounts) / post_nav if post_nav
+                    else np.zeros(len(universe)))
+    traded = np.abs(amounts) >= MIN_TRADE_AMOUNT
+    notice_dates, dealing_dates, settlement_dates = terms.dates(
+        universe[traded], amounts[traded] > 0)
+
+    return [
+        {
+            'account_number': account_number,
+            'isin': isin,
+            'current_value': round(value, 2),
+            'current_shares': current_shares,
+            'current_weight': weight,
+            'target_weight': target_weight,
+            'post_trade_weight': post_weight,
+            'traded_amount': round(amount, 2),
+            'traded_shares': traded_shares,
+            'notice_date': notice_date.isoformat(),
+            'trade_date': dealing_date.isoformat(),
+            'settlement_date': settlement_date.isoformat(),
+            'trade_note': 'Subscription' if amount > 0 else 'Redemption',
+        }
+        for (isin, value, current_shares, weight, target_weight,
+             post_weight, amount, traded_shares, notice_date, dealing_date,
+             settlement_date) in zip(
+            universe[traded].tolist(), current[traded].tolist(),
+            held_shares[traded].tolist(), current_weights[traded].tolist(),
+            target[traded].tolist(), post_weights[traded].tolist(),
+            amounts[traded].tolist(), shares[traded].tolist(),
+            notice_dates.tolist(), dealing_dates.tolist(),
+            settlement_dates.tolist())
+    ]
+
+
+def calculate_trades(portfolio, positions, rebalance_weights, trade_type,
+                     trade_amount, trade_date):
+    """
+    Generate the trades for a portfolio.
+
+    `rebalance_weights` is a TargetModel or a list of weight dicts
+    (index_isin, target_weight as a fraction of NAV). Returns a list of
+    trade dicts (JSON serialisable so they can be kept in the session), one
+    per fund with a non-zero trade.
+    """
+    book = load_book(positions)
+    index_isins, weights = target_arrays(rebalance_weights)
+    candidates = TargetCandidates.load(index_isins)
+    terms = FundTerms.load(np.union1d(book.isins, candidates.isins),
+                           trade_date)
+
+    return portfolio_trades(str(portfolio), book, index_isins, weights,
+                            candidates, terms, trade_type, trade_amount)
+
+
+def calculate_scenarios(portfolio, positions, rebalance_weights, trade_type,
+                        flows, trade_date):
+    """
+    Trades of a portfolio for every net flow of the `flows` grid, computed
+    in one batched pass over a single position snapshot.
+
+    Returns a dict of arrays: 'flows' (S), 'isins', 'current' and
+    'held_shares' (F funds), and the S x F matrices 'amounts', 'shares' and
+    'post_weights'.
+    """
+    book = load_book(positions)
+    index_isins, weights = target_arrays(rebalance_weights)
+    candidates = TargetCandidates.load(index_isins)
+    terms = FundTerms.load(np.union1d(book.isins, candidates.isins),
+                           trade_date)
+    universe, current, held_shares, prices, target = portfolio_arrays(
+        book, index_isins, weights, candidates, terms)
+
+    flows = np.asarray(flows, dtype=float)
+    amounts = compute_trades(current, target, book.cash, trade_type, flows)
+    amounts[np.abs(amounts) < MIN_TRADE_AMOUNT] = 0
+    shares = np.divide(amounts, prices, out=np.zeros(amounts.shape),
+                       where=prices > 0)
+    post_nav = book.nav + (flows if trade_type != 'Rebalance'
+                           else np.zeros(len(flows)))
+    post_nav = post_nav[:, np.newaxis]
+    post_weights = np.divide(current + amounts, post_nav,
+                             out=np.zeros(amounts.shape), where=post_nav != 0)
+
+    return {
+        'flows': flows,
+        'isins': universe,
+        'current': current,
+        'held_shares': held_shares,
+        'amounts': amounts,
+        'shares': shares,
+        'post_weights': post_weights,
+    }
+
+
+def batch_chunk_trades(args):
+    """
+    Trades for a chunk of portfolios (runs in the batch process pool).
+
+    Errors are reported per portfolio instead of failing the whole chunk.
+    """
+    books, index_isins, weights, candidates, terms, trade_type, flows = args
+
+    results = []
+    for account_number, book in books:
+        started = time.perf_counter()
+        try:
+            trades = portfolio_trades(account_number, book, index_isins,
+                                      weights, candidates, terms, trade_type,
+                                      flows.get(account_number, 0.0))
+            error = ''
+        except ValueError as e:
+            trades, error = [], str(e)
+        results.append((account_number, trades, error,
+                        time.perf_counter() - started))
+    return results
+
+
+def calculate_batch_trades(portfolios, rebalance_weights, trade_type,
+                           net_flows, trade_date, map_chunks=map, chunks=1):
+    """
+    Generate the trades of many portfolios against one set of weights.
+
+    Positions, target candidates and fund terms are loaded once for the
+    whole batch; the per-portfolio calculation is split into `chunks`
+    chunks run through `map_chunks` (e.g. a process pool's map).
+    `net_flows` maps account numbers to their net flows.
+
+    Returns (trades, per-portfolio results, timings).
+    """
+    started = time.perf_counter()
+    accounts = [str(p) for p in portfolios]
+    books = load_books(Position.objects.as_of(trade_date, accounts))
+    index_isins, weights = target_arrays(rebalance_weights)
+    candidates = TargetCandidates.load(index_isins)
+    held = [book.isins for book in books.values()]
+    terms = FundTerms.load(
+        np.union1d(np.concatenate(held or [np.array([], dtype=str)]),
+                   candidates.isins), trade_date)
+    loaded = time.perf_counter()
+
+    # Interleave the portfolios so the chunks get similar sized books
+    work = [(account, books.get(account, Book.empty()))
+            for account in accounts]
+    chunks = max(min(chunks, len(work)), 1)
+    chunk_args = [(work[i::chunks], index_isins, weights, candidates, terms,
+                   trade_type, net_flows) for i in range(chunks)]
+
+    trades, results = [], {}
+    for chunk in map_chunks(batch_chunk_trades, chunk_args):
+        for account_number, account_trades, error, seconds in chunk:
+            trades.extend(account_trades)
+            results[account_number] = {
+                'trades': len(account_trades),
+                'traded_amount': sum(abs(t['traded_amount'])
+                                     for t in account_trades),
+                'seconds': seconds,
+                'error': error,
+            }
+
+    timings = {
+        'portfolios': len(accounts),
+        'chunks': chunks,
+        'load_seconds': loaded - started,
+        'calculate_seconds': time.perf_counter() - loaded,
+    }
+    return trades, results, timings
@@ -3,14 +3,46 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('plotly-<str:version>.min.js', views.plotly_js, name='plotly-js'),
     path('funds/', views.FundView.as_view(), name='funds'),
+    path('funds.json', views.fund_list_json, name='funds-json'),
     path('fund/<str:pk>', views.FundDetailView.as_view(), name='fund-detail'),
     path('portfolios/', views.PortfoliosView.as_view(), name='portfolios'),
+    path('portfolios.json', views.portfolio_list_json,
+         name='portfolios-json'),
     path('upload-file/', views.FundUploaderView.as_view(), name='upload-file'),
     path('generate-trades/', views.GenerateTradesView.as_view(),
          name='generate-trades'),
+    path('generate-batch-trades/', views.BatchGenerateTradesView.as_view(),
+         name='generate-batch-trades'),
     path('upload-positions/', views.PositionUploaderView.as_view(),
          name='upload-positions'),
     path('calendars/', views.CalendarView.as_view(), name='calendars'),
-    path('generated-trades/', views.generated_trades, name="generated_trades"),
+    path('upload-calendars/', views.CalendarUploaderView.as_view(),
+         name='upload-calendars'),
+    path('upload-bbg-data/', views.BBGDataUploaderView.as_view(),
+         name='upload-bbg-data'),
+    path('scenarios/', views.ScenarioView.as_view(), name='scenarios'),
+    path('scenarios/<int:pk>', views.scenario_results,
+         name='scenario-results'),
+    path('scenarios/<int:pk>.csv', views.scenario_csv, name='scenario-csv'),
+    path('generated-trades/<int:pk>', views.generated_trades,
+         name="generated_trades"),
+    path('stats/', views.request_stats_view, name='request-stats'),
+    path('profiles/', views.ProfileListView.as_view(), name='profiles'),
+    path('profiles/<int:pk>', views.ProfileDetailView.as_view(),
+         name='profile-detail'),
+    path('profiles/<int:pk>.prof', views.profile_download,
+         name='profile-download'),
+    path('jobs/<int:pk>/status', views.job_status, name="job-status"),
+    path('trades/', views.TradeListView.as_view(), name='trades'),
+    path('liquidity/', views.LiquidityView.as_view(), name='liquidity'),
+    path('block-orders/', views.BlockOrderView.as_view(),
+         name='block-orders'),
+    path('drift/', views.DriftView.as_view(), name='drift'),
+    path('drift/<str:pk>', views.DriftDetailView.as_view(),
+         name='drift-detail'),
+    path('export/', views.ExportView.as_view(), name='export'),
+    path('concentration/', views.ConcentrationView.as_view(),
+         name='concentration'),
 ]
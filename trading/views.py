@@ -1,73 +1,146 @@
-from django.shortcuts import render
+import csv
+
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import Http404, HttpResponse, JsonResponse
+from django.http import StreamingHttpResponse
 from django.views import generic
-from trading.models import Fund, Portfolio, Position, Calendar
+from trading.models import Fund, Portfolio, Calendar, TradeItem, TradeJob
+from trading.models import STATUSES, BlockOrder, PortfolioDrift
+from trading.models import ProfileCapture
 from .forms import UploadFileForm, GenerateTradesForm, UploadDailyPositionForm
-from django.urls import reverse_lazy
+from .forms import UploadBBGDataForm, UploadCalendarDatesForm
+from .forms import BatchGenerateTradesForm, TradeFilterForm, ExportForm
+from .forms import ScenarioForm
+from django.urls import reverse, reverse_lazy
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.mixins import UserPassesTestMixin
 from django.contrib.auth.decorators import login_required
-from django.db.models import Sum
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib import messages
+from django.utils.dateparse import parse_date, parse_time
+from django.views.decorators.cache import cache_control
+from .cache import FUNDS, PORTFOLIOS, POSITIONS, cached
+from .concentration import ownership_report
+from .drift import refresh_drift
+from .instrumentation import BUDGET_KEYS, request_stats
+from .liquidity import liquidity_ladder
+from .orders import build_block_orders
+from .tables import FundTable, PortfolioTable
 import plotly.offline as opy
 import plotly.graph_objs as go
 
 
-# Create index/homepage view (functions-based)
-@login_required(login_url='login')
-def index(request):
+def fund_counts():
+    """
+    Record counts shown on the dashboard
+    """
+    return {
+        # Generate count of all funds
+        "num_funds": Fund.objects.all().count(),
 
-    # Generate count of all funds
-    num_funds = Fund.objects.all().count()
+        # Generate count of all 'Active' num_funds
+        "num_active_funds": Fund.objects.filter(
+            status__exact='Active').count(),
 
-    # Generate count of all 'Active' num_funds
-    num_active_funds = Fund.objects.filter(status__exact='Active').count()
+        # Generate count of all unique Index ISINs
+        "num_unique_index_funds": Fund.objects.all().values('index_isin')
+        .distinct().count(),
+    }
 
-    # Generate count of all unique Index ISINs
-    num_index_isin_unique = Fund.objects.all().values('index_isin')\
-        .distinct().count()
 
-    # graph example
-    portfolios = Portfolio.objects.all()
-    labels = [x['name'] for x in portfolios.values()]
-    values = [x.get_position_sum() for x in portfolios]
+def assets_chart():
+    """
+    Pie chart div of the latest valuation of every portfolio (plotly.js is
+    loaded separately, see plotly_js)
+    """
+    portfolios = Portfolio.objects.with_latest_valuation()
+    labels, values = [], []
+    for name, value in portfolios.values_list('name', 'latest_value'):
+        labels.append(name)
+        values.append(value or 0)
 
     fig = go.Figure(data=[go.Pie(labels=labels, values=values)])
-    div = opy.plot(fig, auto_open=False, output_type='div', config={
-        'displayModeBar': False})
+    return opy.plot(fig, auto_open=False, output_type='div',
+                    include_plotlyjs=False, config={'displayModeBar': False})
 
-    # Generate context (aka output data)
-    context = {
-        "num_funds": num_funds,
-        "num_active_funds": num_active_funds,
-        "num_unique_index_funds": num_index_isin_unique,
-        "graph": div
-    }
+
+# Create index/homepage view (functions-based)
+@login_required(login_url='login')
+def index(request):
+
+    # Counts and chart are cached until funds/portfolios/positions change
+    context = dict(cached('dashboard-counts', [FUNDS], fund_counts))
+    context["graph"] = cached('dashboard-chart', [PORTFOLIOS, POSITIONS],
+                              assets_chart)
+    context["plotly_version"] = opy.get_plotlyjs_version()
 
     # Render request with context data
     return render(request, 'index.html', context)
 
 
-# Create Fund List page (class-based)
-class FundView(LoginRequiredMixin, generic.ListView):
-    model = Fund
+_plotly_js = None
+
+
+@cache_control(public=True, max_age=365 * 24 * 60 * 60, immutable=True)
+def plotly_js(request, version):
+    """
+    The plotly.js bundle of the installed plotly package. The URL carries
+    the version, so browsers can cache it for good.
+    """
+    global _plotly_js
+    if version != opy.get_plotlyjs_version():
+        raise Http404("Unknown plotly.js version")
+    if _plotly_js is None:
+        _plotly_js = opy.get_plotlyjs()
+    return HttpResponse(_plotly_js, content_type='application/javascript')
+
+
+# Create Fund List page (class-based), rows are loaded page by page from
+# fund_list_json
+class FundView(LoginRequiredMixin, generic.TemplateView):
+    template_name = 'trading/fund_list.html'
     login_url = 'login'
     redirect_field_name = 'redirect_to'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['statuses'] = [s for s, _ in STATUSES]
+        context['styles'] = [s for s, _ in Fund.STYLES]
+        context['strategies'] = [s for s, _ in Fund.STRATEGIES]
+        context['firms'] = Fund.objects.order_by('firm').values_list(
+            'firm', flat=True).distinct()
+        return context
+
 
-# Create Portfolio List page (class-based)
-class PortfoliosView(LoginRequiredMixin, generic.ListView):
-    model = Portfolio
+@login_required(login_url='login')
+def fund_list_json(request):
+    """
+    One page of the fund list (DataTables server-side processing)
+    """
+    return FundTable().response(request)
+
+
+# Create Portfolio List page (class-based), rows are loaded page by page
+# from portfolio_list_json
+class PortfoliosView(LoginRequiredMixin, generic.TemplateView):
+    template_name = 'trading/portfolio_list.html'
     login_url = 'login'
     redirect_field_name = 'redirect_to'
 
     def get_context_data(self, **kwargs):
-        # Call the base implementation first to get a context
         context = super().get_context_data(**kwargs)
-
-        # Add in a QuerySet of all the portfolio sum
-        context['portfolios_sum'] = "%.2f" % list(
-            Position.objects.aggregate(Sum('value')).values())[0]
+        context['statuses'] = [s for s, _ in STATUSES]
         return context
 
 
+@login_required(login_url='login')
+def portfolio_list_json(request):
+    """
+    One page of the portfolio list (DataTables server-side processing)
+    """
+    return PortfolioTable().response(request)
+
+
 class CalendarView(LoginRequiredMixin, generic.ListView):
     """
     Create Calendar list page
@@ -84,49 +157,390 @@ class FundDetailView(LoginRequiredMixin, generic.DetailView):
     redirect_field_name = 'redirect_to'
 
 
-class FundUploaderView(LoginRequiredMixin, generic.FormView):
-    template_name = 'upload-file.html'
-    form_class = UploadFileForm
-    success_url = reverse_lazy('funds')
+class UploaderMixin(LoginRequiredMixin):
+    """
+    File upload page: loads the file and reports the load summary (and the
+    first rejected lines) to the user
+    """
     login_url = 'login'
     redirect_field_name = 'redirect_to'
 
     def form_valid(self, form):
-        form.processs_data()
+        result = form.processs_data()
+
+        messages.info(self.request, result.summary())
+        for line_number, reason in result.rejects[:10]:
+            messages.warning(self.request,
+                             "Line %d rejected: %s" % (line_number, reason))
         return super().form_valid(form)
 
 
-class PositionUploaderView(LoginRequiredMixin, generic.FormView):
+class FundUploaderView(UploaderMixin, generic.FormView):
+    template_name = 'upload-file.html'
+    form_class = UploadFileForm
+    success_url = reverse_lazy('funds')
+
+
+class PositionUploaderView(UploaderMixin, generic.FormView):
     template_name = 'upload-positions.html'
     form_class = UploadDailyPositionForm
     success_url = reverse_lazy('index')
-    login_url = 'login'
-    redirect_field_name = 'redirect_to'
 
-    def form_valid(self, form):
-        form.processs_data()
-        return super().form_valid(form)
+
+class BBGDataUploaderView(UploaderMixin, generic.FormView):
+    template_name = 'upload-bbg-data.html'
+    form_class = UploadBBGDataForm
+    success_url = reverse_lazy('concentration')
+
+
+class CalendarUploaderView(UploaderMixin, generic.FormView):
+    template_name = 'upload-calendars.html'
+    form_class = UploadCalendarDatesForm
+    success_url = reverse_lazy('calendars')
 
 
 class GenerateTradesView(LoginRequiredMixin, generic.FormView):
     template_name = 'generate-trades-form.html'
     form_class = GenerateTradesForm
-    success_url = reverse_lazy('generated_trades')
     login_url = 'login'
     redirect_field_name = 'redirect_to'
 
     def form_valid(self, form):
-        generated_trades = form.process_data()
-        self.request.session['trades'] = generated_trades
+        try:
+            self.job = form.process_data()
+        except ValueError as e:
+            # Invalid target weights (e.g. unknown index ISIN)
+            form.add_error('target_weights_file', str(e))
+            return self.form_invalid(form)
         return super().form_valid(form)
 
+    def get_success_url(self):
+        return reverse_lazy('generated_trades', args=[self.job.pk])
+
+
+class BatchGenerateTradesView(GenerateTradesView):
+    form_class = BatchGenerateTradesForm
+
+
+class ScenarioView(GenerateTradesView):
+    template_name = 'trading/scenario-form.html'
+    form_class = ScenarioForm
+
 
 @login_required(login_url='login')
-def generated_trades(request):
+def generated_trades(request, pk):
+
+    job = get_object_or_404(TradeJob, pk=pk)
+
+    # Finished runs are shown in the trade blotter (or scenario results)
+    if job.status == 'Done':
+        if job.kind == 'scenario':
+            return redirect('scenario-results', pk=job.pk)
+        return redirect('%s?run=%d' % (reverse('trades'), job.pk))
 
     context = {
-        "trades": request.session['trades']
+        "job": job,
     }
 
     # Render request with context data
     return render(request, 'generated_trades.html', context)
+
+
+class TradeListView(LoginRequiredMixin, generic.ListView):
+    """
+    Trade blotter: TradeItem paginated server-side, with filters and sort
+    """
+    model = TradeItem
+    paginate_by = 50
+    login_url = 'login'
+    redirect_field_name = 'redirect_to'
+
+    def get_queryset(self):
+        self.filter_form = TradeFilterForm(self.request.GET or None)
+        return self.filter_form.filter(TradeItem.objects.all())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['filter_form'] = self.filter_form
+
+        # Summary (per-portfolio results and timings) of the selected run
+        form = self.filter_form
+        if form.is_valid() and form.cleaned_data['run']:
+            job = TradeJob.objects.filter(pk=form.cleaned_data['run']).first()
+            context['job'] = job
+            context['job_result'] = job.get_result() if job else None
+
+        # Query string without the page, for the pagination links
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context['query'] = query.urlencode()
+        return context
+
+
+class ConcentrationView(LoginRequiredMixin, generic.TemplateView):
+    """
+    Firm-wide ownership of each fund against its as-of BBG data
+    """
+    template_name = 'trading/concentration.html'
+    login_url = 'login'
+    redirect_field_name = 'redirect_to'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        valuation_date = parse_date(self.request.GET.get('date', ''))
+        context['valuation_date'], context['rows'], context['limits'] = \
+            ownership_report(valuation_date)
+        return context
+
+
+class LiquidityView(LoginRequiredMixin, generic.TemplateView):
+    """
+    Cash each portfolio would raise over time by redeeming all positions
+    """
+    template_name = 'trading/liquidity.html'
+    login_url = 'login'
+    redirect_field_name = 'redirect_to'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        ladder = liquidity_ladder(
+            parse_date(self.request.GET.get('date', '')),
+            parse_time(self.request.GET.get('time', '')))
+        context['ladder'] = ladder
+        if ladder is not None:
+            context['rows'] = ladder.rows()
+        return context
+
+
+class BlockOrderView(LoginRequiredMixin, generic.TemplateView):
+    """
+    Block orders of a dealing date; posting a date (re)builds them from the
+    latest trades of each portfolio on that date
+    """
+    template_name = 'trading/block_orders.html'
+    login_url = 'login'
+    redirect_field_name = 'redirect_to'
+
+    def post(self, request, *args, **kwargs):
+        trade_date = parse_date(request.POST.get('date', ''))
+        if trade_date is None:
+            messages.error(request, 'Enter a valid dealing date')
+            return redirect('block-orders')
+        orders = build_block_orders(trade_date)
+        messages.success(request, '%d block orders for %s' % (orders,
+                                                              trade_date))
+        return redirect('%s?date=%s' % (reverse('block-orders'), trade_date))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        trade_date = parse_date(self.request.GET.get('date', '')) or \
+            BlockOrder.objects.order_by('-trade_date').values_list(
+                'trade_date', flat=True).first()
+        context['trade_date'] = trade_date
+        context['orders'] = BlockOrder.objects.filter(
+            trade_date=trade_date).select_related('isin').order_by(
+                'isin', 'currency')
+        return context
+
+
+class DriftView(LoginRequiredMixin, generic.TemplateView):
+    """
+    Portfolios outside their drift tolerance, largest drift first (?all=1
+    for every monitored portfolio); posting refreshes the dirty ones
+    """
+    template_name = 'trading/drift.html'
+    login_url = 'login'
+    redirect_field_name = 'redirect_to'
+
+    def post(self, request, *args, **kwargs):
+        refreshed = refresh_drift()
+        messages.success(request, 'Drift of %d portfolios refreshed' %
+                         refreshed)
+        return redirect('drift')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        drifts = PortfolioDrift.objects.select_related(
+            'account_number', 'target_model').order_by('-max_drift')
+        context['show_all'] = bool(self.request.GET.get('all'))
+        if not context['show_all']:
+            drifts = drifts.filter(outside_tolerance=True)
+        context['drifts'] = drifts
+        context['dirty'] = PortfolioDrift.objects.filter(dirty=True).count()
+        return context
+
+
+class DriftDetailView(LoginRequiredMixin, generic.DetailView):
+    """
+    Drift of one portfolio and its Rebalance trades back to the model
+    """
+    model = PortfolioDrift
+    template_name = 'trading/drift_detail.html'
+    login_url = 'login'
+    redirect_field_name = 'redirect_to'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        trades = self.object.get_trades()
+        for trade in trades:
+            # Weights are fractions of NAV, shown in %
+            for key in ('current_weight', 'target_weight',
+                        'post_trade_weight'):
+                trade[key] *= 100
+        context['trades'] = trades
+        return context
+
+
+class ExportView(LoginRequiredMixin, generic.TemplateView):
+    """
+    Export form; a valid request (GET parameters) streams the file back
+    """
+    template_name = 'trading/export.html'
+    login_url = 'login'
+    redirect_field_name = 'redirect_to'
+
+    def get(self, request, *args, **kwargs):
+        form = ExportForm(request.GET or None)
+        if form.is_valid():
+            try:
+                chunks, content_type, filename = form.export()
+            except ValueError as e:
+                form.add_error(None, str(e))
+            else:
+                response = StreamingHttpResponse(chunks,
+                                                 content_type=content_type)
+                response['Content-Disposition'] = \
+                    'attachment; filename="%s"' % filename
+                return response
+        return self.render_to_response(self.get_context_data(form=form))
+
+
+def get_scenario_job(pk):
+    return get_object_or_404(TradeJob, pk=pk, kind='scenario')
+
+
+@login_required(login_url='login')
+def scenario_results(request, pk):
+    """
+    Totals and breach counts of each scenario of a net flow sweep
+    """
+    job = get_scenario_job(pk)
+    if job.status != 'Done':
+        return redirect('generated_trades', pk=job.pk)
+
+    result = job.get_result()
+    context = {
+        "job": job,
+        "params": job.get_params(),
+        "funds": len(result['isins']),
+        "scenarios": [
+            dict(zip(('flow', 'subscriptions', 'redemptions', 'trades',
+                      'breaches'), row))
+            for row in result['summary']],
+        "timings": result['timings'],
+    }
+    return render(request, 'trading/scenario_results.html', context)
+
+
+@login_required(login_url='login')
+def scenario_csv(request, pk):
+    """
+    Scenarios x funds matrix of a net flow sweep as CSV: traded amounts, or
+    breach flags with ?matrix=flags
+    """
+    job = get_scenario_job(pk)
+    matrix = request.GET.get('matrix', 'amounts')
+    if job.status != 'Done' or matrix not in ('amounts', 'flags'):
+        raise Http404
+
+    result = job.get_result()
+    response = HttpResponse(content_type='text/csv')
+    response['Content-Disposition'] = \
+        'attachment; filename="scenarios-%d-%s.csv"' % (job.pk, matrix)
+    writer = csv.writer(response)
+    writer.writerow(['net_flows'] + result['isins'])
+    writer.writerows([flow] + row
+                     for flow, row in zip(result['flows'], result[matrix]))
+    return response
+
+
+@staff_member_required(login_url='login')
+def request_stats_view(request):
+    """
+    Percentiles of the query count and timings of the latest requests of
+    each view (this process); posting clears them
+    """
+    if request.method == 'POST':
+        request_stats.clear()
+        return redirect('request-stats')
+
+    views = request_stats.summary()
+    for view in views:
+        view['cells'] = [(view['stats'][key], view['budget'].get(key))
+                         for key in BUDGET_KEYS]
+    context = {
+        "keys": BUDGET_KEYS,
+        "views": views,
+        "window": request_stats.window,
+    }
+    return render(request, 'trading/request_stats.html', context)
+
+
+class StaffRequiredMixin(LoginRequiredMixin, UserPassesTestMixin):
+    login_url = 'login'
+    redirect_field_name = 'redirect_to'
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+
+class ProfileListView(StaffRequiredMixin, generic.ListView):
+    """
+    Saved request profiles, newest first
+    """
+    template_name = 'trading/profile_list.html'
+    paginate_by = 50
+
+    def get_queryset(self):
+        return ProfileCapture.objects.defer(
+            'summary', 'stats').select_related('user').order_by('-id')
+
+
+class ProfileDetailView(StaffRequiredMixin, generic.DetailView):
+    template_name = 'trading/profile_detail.html'
+
+    def get_queryset(self):
+        return ProfileCapture.objects.defer('stats').select_related('user')
+
+
+@staff_member_required(login_url='login')
+def profile_download(request, pk):
+    """
+    Profile in pstats format (pstats.Stats(path), snakeviz...)
+    """
+    capture = get_object_or_404(ProfileCapture, pk=pk)
+    response = HttpResponse(bytes(capture.stats),
+                            content_type='application/octet-stream')
+    response['Content-Disposition'] = \
+        'attachment; filename="profile-%d.prof"' % capture.pk
+    return response
+
+
+@login_required(login_url='login')
+def job_status(request, pk):
+    """
+    Status of a background job (polled by the generated trades page)
+    """
+    job = get_object_or_404(TradeJob, pk=pk)
+    return JsonResponse({
+        "id": job.pk,
+        "kind": job.kind,
+        "status": job.status,
+        "finished": job.is_finished,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "queued_seconds": job.queued_seconds,
+        "run_seconds": job.run_seconds,
+        "error": job.error,
+    })
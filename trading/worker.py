@@ -0,0 +1,22 @@
+"""
+Entry points executed inside the background job pool processes.
+
+Workers are spawned, so this module is imported before Django is set up
+and must not import models at module level.
+"""
+import django
+from django.db import connections
+
+
+def init():
+    django.setup()
+
+
+def run(job_id):
+    from .jobs import run_job
+
+    try:
+        return run_job(job_id)
+    finally:
+        # Don't keep idle connections open in the pool processes
+        connections.close_all()